@@ -1,10 +1,28 @@
-from casatasks import split
 from craco_vis import SimpleMeasurementSet
 import argparse
 
 from craco_vis import SimpleMeasurementSet
 
-def process(vis, outvis, timebin, freqbin, datacolumn = 'data'):
+### data columns in casa `split` to measurement set columns
+DATA_COLUMNS = {"data": "DATA", "corrected": "CORRECTED_DATA", "model": "MODEL_DATA"}
+
+def process(vis, outvis, timebin, freqbin, datacolumn = 'data', engine = 'casa'):
+    """
+    average `vis` to `timebin` (in seconds, "10s" works as well) and `freqbin` MHz
+
+    Params
+    ----------
+    engine: str, "casa" by default
+        "casa" - casatasks `split`, "numpy" - flag and weight aware averaging in chunks without CASA
+        (see `stream_average.process_ms`), the output keeps the polarisations of `vis`.
+        "casa" stays the default until the numpy output is validated against `split` on real data
+    """
+    if engine == "numpy":
+        from stream_average import process_ms
+        timebin = float(str(timebin).rstrip("s"))
+        return process_ms(vis, outvis, timebin=timebin, freqbin=freqbin, npol=None, column=DATA_COLUMNS[datacolumn])
+
+    from casatasks import split # casatasks is slow to import, only load it when averaging
     # add function to determine the frequency bin width
     cracovis = SimpleMeasurementSet(vis)
     width = int(freqbin*1e6 // cracovis.foff)
@@ -23,7 +41,7 @@ def main(args):
 
     timebin = str(args.timebin) + 's'
 
-    process(vis, outvis, timebin)
+    process(vis, outvis, timebin, args.freqbin, engine=args.engine)
 
 if __name__== '__main__':
     a = argparse.ArgumentParser()
@@ -31,6 +49,7 @@ if __name__== '__main__':
     a.add_argument("-outvis", type=str, help="Output visibility ms", default=None)
     a.add_argument("-timebin", type=float, help="Sampling time (in seconds) of the output vis ms (def:10)", default=10)
     a.add_argument("-freqbin", type=int, help="frequency resolution (in MHz) of the output vis ms (def: 1 MHz)", default=1)
+    a.add_argument("-engine", type=str, help="averaging engine - casa or numpy (def: casa)", default="casa", choices=["numpy", "casa"])
 
     args = a.parse_args()
     main(args)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# compare the batched slope-trial search in UnWrapFit with the original per-trial loop
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from smooth_cal import UnWrapFit
+
+def _make_phase(nchan, rng, nanfrac=0.1, noise=0.3):
+    """
+    make a wrapped phase vector with a random delay, noise and nan channels
+    """
+    x = np.arange(nchan)
+    slope = rng.uniform(-0.1, 0.1)
+    y = (slope * x + rng.normal(0, noise, nchan) + rng.uniform(-np.pi, np.pi)) % (2 * np.pi) - np.pi
+    y[rng.random(nchan) < nanfrac] = np.nan
+    return y
+
+def _time_fit(phases, batch):
+    start = time.perf_counter()
+    fits = []
+    for y in phases:
+        fit = UnWrapFit(y)
+        fit.estimate_optimal_fit(batch=batch)
+        fits.append((fit.slopebest, fit.interbest))
+    return time.perf_counter() - start, fits
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    phases = [_make_phase(args.nchan, rng) for i in range(args.nvec)]
+
+    tloop, fitloop = _time_fit(phases, batch=False)
+    tbatch, fitbatch = _time_fit(phases, batch=True)
+
+    nsame = sum([a == b for a, b in zip(fitloop, fitbatch)])
+    print(f"vectors: {args.nvec}, channels: {args.nchan}")
+    print(f"loop  : {tloop:.3f} s ({tloop / args.nvec * 1e3:.2f} ms per vector)")
+    print(f"batch : {tbatch:.3f} s ({tbatch / args.nvec * 1e3:.2f} ms per vector)")
+    print(f"speed up: {tloop / tbatch:.1f}x, identical (slopebest, interbest): {nsame}/{args.nvec}")
+
+if __name__ == "__main__":
+    a = argparse.ArgumentParser()
+    a.add_argument("-nvec", type=int, help="number of phase vectors to fit (def: 72, i.e., 36 antennas x 2 pols)", default=72)
+    a.add_argument("-nchan", type=int, help="number of channels per vector (def: 288)", default=288)
+    a.add_argument("-seed", type=int, help="random seed (def: 42)", default=42)
+
+    args = a.parse_args()
+    main(args)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# benchmark the calibration hot paths on synthetic data at several array sizes
+# reports the run time, throughput and peak (numpy/python) memory of each case,
+# results can be saved as json and compared with an earlier run to catch regressions
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import io
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import make_bin, make_gains, make_ms
+
+import logging
+logging.disable(logging.WARNING)
+
+### array sizes of each case - antennas, integrations (for measurement sets) and channels
+SIZES = {
+    "small": dict(nant=12, nt=10, nchan=96),
+    "medium": dict(nant=24, nt=20, nchan=192),
+    "large": dict(nant=36, nt=30, nchan=288),
+}
+
+def _measure(func, repeat=3):
+    """
+    best run time of `func` in `repeat` runs, and the peak memory traced by tracemalloc in a separate run
+    """
+    times = []
+    for i in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak / 1024**2
+
+### benchmark cases, each returns a list of (name, func, amount of work, unit of the work)
+def case_unwrapfit(workdir, nant, nchan, **kwargs):
+    from smooth_cal import UnWrapFit, BatchUnWrapFit
+    gains, _ = make_gains(nant=nant, nchan=nchan, npol=2, nbadant=0)
+    phases = np.angle(gains[0]).transpose(0, 2, 1).reshape(-1, nchan) # (nant * npol, nchan)
+
+    def _loop():
+        for y in phases:
+            UnWrapFit(y).estimate_optimal_fit(batch=False)
+    def _batch():
+        for y in phases:
+            UnWrapFit(y).estimate_optimal_fit(batch=True)
+    def _vector():
+        BatchUnWrapFit(phases).estimate_optimal_fit()
+
+    nvec = phases.shape[0]
+    return [
+        ("unwrapfit.loop", _loop, nvec, "vec"),
+        ("unwrapfit.batch", _batch, nvec, "vec"),
+        ("unwrapfit.vectorised", _vector, nvec, "vec"),
+    ]
+
+def case_bandpass(workdir, nant, nchan, **kwargs):
+    from smooth_cal import CracoBandPass
+    binname = f"{workdir}/bandpass.bin"
+    make_bin(binname, nant=nant, nchan=nchan)
+
+    def _smooth(batch):
+        bp = CracoBandPass(binname, flagfile=None)
+        bp.smooth_sol(plot=False, batch=batch)
+    return [
+        ("bandpass.load", lambda: CracoBandPass(binname, flagfile=None), nant, "ant"),
+        ("bandpass.smooth_loop", lambda: _smooth(False), nant, "ant"),
+        ("bandpass.smooth_batch", lambda: _smooth(True), nant, "ant"),
+    ]
+
+def _vis_mb(nant, nt, nchan, npol=4):
+    return nt * nant * (nant + 1) // 2 * nchan * npol * 8 / 1024**2
+
+def case_measurement_set(workdir, nant, nt, nchan, **kwargs):
+    from craco_vis import SimpleMeasurementSet
+    msname = f"{workdir}/synthetic.ms"
+    make_ms(msname, nant=nant, nt=nt, nchan=nchan)
+    solname = f"{workdir}/synthetic.smooth.npy"
+    np.save(solname, make_gains(nant=nant, nchan=nchan, nanfrac=0., nbadant=0)[0])
+    vismb = _vis_mb(nant, nt, nchan)
+
+    def _load(cal=None, inplace=False):
+        ms = SimpleMeasurementSet(msname)
+        ms.load_vis()
+        if cal is not None: ms.apply_cal(cal, inplace=inplace)
+    def _iter():
+        ms = SimpleMeasurementSet(msname)
+        for it, vis in ms.iter_vis(cal=solname): pass
+    def _summary():
+        ms = SimpleMeasurementSet(msname)
+        return ms.nant, ms.nbl, ms.nt, ms.nchan, ms.freqs
+    return [
+        ("ms.summary", _summary, 1, "open"),
+        ("ms.load_vis", _load, vismb, "MB"),
+        ("ms.apply_cal", lambda: _load(solname), vismb, "MB"),
+        ("ms.apply_cal_inplace", lambda: _load(solname, inplace=True), vismb, "MB"),
+        ("ms.iter_vis_cal", _iter, vismb, "MB"),
+    ]
+
+def case_convert(workdir, nant, nt, nchan, **kwargs):
+    from convert import process as convert
+    msname = f"{workdir}/synthetic.2pol.ms"
+    make_ms(msname, nant=nant, nt=nt, nchan=nchan, npol=2, corrected=False)
+    return [
+        ("convert.make_4pol", lambda: convert(msname, f"{workdir}/synthetic.4pol.ms"), _vis_mb(nant, nt, nchan), "MB"),
+    ]
+
+def case_average(workdir, nant, nt, nchan, **kwargs):
+    from average_the_ms import process as average
+    from stream_average import process_ms
+    msname = f"{workdir}/synthetic.2pol.ms"
+    make_ms(msname, nant=nant, nt=nt, nchan=nchan, npol=2, corrected=False)
+    vismb = _vis_mb(nant, nt, nchan, npol=2)
+    return [
+        ("average.numpy", lambda: average(msname, f"{workdir}/synthetic.aver.ms", timebin="20s", freqbin=2, engine="numpy"), vismb, "MB"),
+        ("average.numpy_4pol", lambda: process_ms(msname, f"{workdir}/synthetic.aver.4pol.ms", timebin=20., freqbin=2), vismb, "MB"),
+    ]
+
+def case_stefcal(workdir, nant, nt, nchan, **kwargs):
+    from stefcal import solve_gains
+    gains, _ = make_gains(nant=nant, nchan=nchan, npol=2, nanfrac=0., nbadant=1)
+    ant1, ant2 = np.triu_indices(nant)
+    rng = np.random.default_rng(42)
+    shape = (nt, ant1.shape[0], nchan, 2)
+    model = rng.normal(size=shape) + 1j * rng.normal(size=shape)
+    vis = gains[0][ant1] * model * np.conj(gains[0][ant2]) + 0.01 * (rng.normal(size=shape) + 1j * rng.normal(size=shape))
+
+    ### agreement with the true gains, only phases relative to the first antenna can be solved
+    solved = solve_gains(vis, model, ant1, ant2, refant=0)
+    truth = gains[0] * np.exp(-1j * np.angle(gains[0][0]))[None]
+    error = np.nanmax(np.abs(solved - truth) / np.abs(truth))
+    print(f"stefcal agreement with the true gains - max relative error {error:.1e}")
+    return [
+        ("stefcal.solve", lambda: solve_gains(vis, model, ant1, ant2), _vis_mb(nant, nt, nchan, npol=2), "MB"),
+    ]
+
+def case_predict(workdir, nant, nt, nchan, nsrc=100, **kwargs):
+    from predict import VisPredictor
+    rng = np.random.default_rng(42)
+    ### components within a few degrees of the phase centre, a third of them gaussians
+    model = dict(
+        RA=100. + rng.uniform(-3., 3., nsrc), Dec=-30. + rng.uniform(-3., 3., nsrc),
+        I=rng.uniform(0.01, 1., nsrc), alpha=np.full((nsrc, 1), -0.83), logsi=np.ones(nsrc, dtype=bool),
+        reffreq=np.full(nsrc, 887.5e6), DC_Maj=rng.uniform(10., 60., nsrc), DC_Min=rng.uniform(5., 10., nsrc),
+        DC_PA=rng.uniform(0., 180., nsrc), is_point=rng.random(nsrc) > 1. / 3,
+    )
+    nrow = nt * nant * (nant + 1) // 2
+    uvw = rng.normal(size=(nrow, 3)) * 2000.
+    predictor = VisPredictor(model, 743.5e6 + np.arange(nchan) * 1e6, (100., -30.), nthreads=1)
+    threaded = VisPredictor(model, 743.5e6 + np.arange(nchan) * 1e6, (100., -30.))
+    nterm = nrow * nchan * nsrc / 1e6
+    return [
+        ("predict.dft", lambda: predictor.predict(uvw), nterm, "Mterm"),
+        ("predict.dft_threaded", lambda: threaded.predict(uvw), nterm, "Mterm"),
+    ]
+
+def case_flag(workdir, nant, nt, nchan, **kwargs):
+    from flag import process as flag
+    msname = f"{workdir}/synthetic.flag.ms"
+    make_ms(msname, nant=nant, nt=nt, nchan=nchan)
+    vismb = _vis_mb(nant, nt, nchan)
+    return [
+        ("flag.process", lambda: flag(msname), vismb, "MB"),
+        ("flag.rfi_mad", lambda: flag(msname, rfi="mad"), vismb, "MB"),
+        ("flag.rfi_sumthreshold", lambda: flag(msname, rfi="sumthreshold"), vismb, "MB"),
+    ]
+
+CASES = dict(
+    unwrapfit=case_unwrapfit, bandpass=case_bandpass, ms=case_measurement_set,
+    convert=case_convert, average=case_average, flag=case_flag, stefcal=case_stefcal,
+    predict=case_predict,
+)
+
+def run(sizes, cases, repeat=3, workdir=None):
+    """
+    run benchmark `cases` for all `sizes`
+
+    Returns
+    ----------
+    results: list of dict
+        case, size, seconds, throughput (work per second), unit and peak_mb of each benchmark
+    """
+    results = []
+    for size in sizes:
+        for case in cases:
+            tmpdir = tempfile.mkdtemp(dir=workdir)
+            try:
+                for name, func, work, unit in CASES[case](tmpdir, **SIZES[size]):
+                    seconds, peak = _measure(func, repeat=repeat)
+                    result = dict(case=name, size=size, seconds=seconds, throughput=work / seconds, unit=unit, peak_mb=peak)
+                    print(f"""{name:<24}{size:<8}{seconds:>10.4f} s{result["throughput"]:>12.1f} {unit}/s{peak:>10.1f} MB""")
+                    results.append(result)
+            except ImportError as error:
+                print(f"{case:<24}{size:<8}skipped... {error}")
+            finally:
+                shutil.rmtree(tmpdir)
+    return results
+
+def compare(results, baseline, tolerance=1.2):
+    """
+    compare the run time with `baseline` results, return the cases slower than `tolerance` times the baseline
+    """
+    reference = {(result["case"], result["size"]): result for result in baseline}
+    regressions = []
+    for result in results:
+        ref = reference.get((result["case"], result["size"]))
+        if ref is None: continue
+        ratio = result["seconds"] / ref["seconds"]
+        if ratio > tolerance:
+            regressions.append(result)
+            print(f"""REGRESSION {result["case"]} ({result["size"]}): {ratio:.2f}x slower than the baseline""")
+    return regressions
+
+def main(args):
+    sizes = args.sizes.split(",")
+    cases = list(CASES) if args.cases is None else args.cases.split(",")
+    for value, allowed in ((sizes, SIZES), (cases, CASES)):
+        unknown = [item for item in value if item not in allowed]
+        if unknown:
+            raise ValueError(f"unknown values {unknown}... should be in {list(allowed)}")
+
+    print(f"""{"case":<24}{"size":<8}{"time":>12}{"throughput":>18}{"peak mem":>13}""")
+    results = run(sizes, cases, repeat=args.repeat, workdir=args.workdir)
+
+    if args.json is not None:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if compare(results, baseline, tolerance=args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    a = argparse.ArgumentParser()
+    a.add_argument("-sizes", type=str, help=f"comma separated sizes from {list(SIZES)} (def: small,medium)", default="small,medium")
+    a.add_argument("-cases", type=str, help=f"comma separated cases from {list(CASES)} (def: all)", default=None)
+    a.add_argument("-repeat", type=int, help="number of runs, the best time is reported (def: 3)", default=3)
+    a.add_argument("-workdir", type=str, help="directory for the synthetic data (def: system temporary directory)", default=None)
+    a.add_argument("-json", type=str, help="save the results to a json file", default=None)
+    a.add_argument("-baseline", type=str, help="json results of an earlier run to compare with", default=None)
+    a.add_argument("-tolerance", type=float, help="slow down factor reported as a regression (def: 1.2)", default=1.2)
+
+    args = a.parse_args()
+    main(args)
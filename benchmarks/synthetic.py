@@ -0,0 +1,110 @@
+# normal python script - not command line executable
+# synthetic calibration products for benchmarks - Emil/calibrate `.bin` bandpasses and small measurement sets
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ms_writer import MeasurementSetWriter
+from binsol import write_gains
+
+def make_gains(nant=36, nchan=288, npol=4, nsol=1, maxdelay=0.1, noise=0.05, nanfrac=0.05, nbadant=1, seed=42):
+    """
+    make antenna gains with linear phase (delay), noise and nan channels
+
+    Params
+    ----------
+    maxdelay: float, 0.1 by default
+        maximum phase slope in radian per channel, the delay of each antenna/pol is drawn uniformly
+    noise: float, 0.05 by default
+        relative noise added to the gains
+    nanfrac: float, 0.05 by default
+        fraction of nan channels (the same for all antennas, like RFI flags)
+    nbadant: int, 1 by default
+        number of antennas with all channels being nan
+
+    Returns
+    ----------
+    gains: numpy.ndarray, (nsol, nant, nchan, npol)
+    delays: numpy.ndarray, (nant, npol)
+        phase slope in radian per channel
+    """
+    rng = np.random.default_rng(seed)
+    chans = np.arange(nchan)
+    delays = rng.uniform(-maxdelay, maxdelay, (nant, npol))
+    phase0 = rng.uniform(-np.pi, np.pi, (nant, npol))
+    amp = rng.uniform(0.5, 2., (nant, npol))
+
+    gains = amp[:, None, :] * np.exp(1j * (delays[:, None, :] * chans[None, :, None] + phase0[:, None, :]))
+    gains = gains[None, ...] * (1 + noise * (rng.normal(size=(nsol, nant, nchan, npol)) + 1j * rng.normal(size=(nsol, nant, nchan, npol))))
+    if npol == 4: # leakage terms are much smaller
+        gains[..., 1:3] *= 0.01
+
+    gains[:, :, rng.random(nchan) < nanfrac, :] = np.nan
+    gains[:, rng.choice(nant, size=min(nbadant, nant), replace=False), :, :] = np.nan
+    return gains, delays
+
+def write_bin(fname, gains):
+    """
+    write `gains` (nsol, nant, nchan, npol) as a calibrate `.bin` file, i.e., sqrt(2) / gains is saved
+    """
+    write_gains(fname, gains)
+
+def make_bin(fname, nant=36, nchan=288, npol=4, nsol=1, freqs=None, **kwargs):
+    """
+    write a synthetic `.bin` file (and the `.freq.npy` next to it), see `make_gains` for other parameters
+
+    Returns
+    ----------
+    gains, delays: see `make_gains`
+    """
+    gains, delays = make_gains(nant=nant, nchan=nchan, npol=npol, nsol=nsol, **kwargs)
+    write_bin(fname, gains)
+    if freqs is None: freqs = 743.5e6 + np.arange(nchan) * 1e6
+    np.save(fname.replace(".bin", ".freq.npy"), freqs)
+    return gains, delays
+
+def make_ms(msname, nant=12, nt=20, nchan=96, npol=4, autos=True, tsamp=10., corrected=True, seed=42):
+    """
+    write a small measurement set with random visibilities, time ordered with `nbl` rows per integration
+
+    Params
+    ----------
+    corrected: bool, True by default
+        add a CORRECTED_DATA column (copy of DATA) as `flag.process` works on it
+
+    Returns
+    ----------
+    nrow: int
+        number of rows written
+    """
+    rng = np.random.default_rng(seed)
+    ant1, ant2 = np.triu_indices(nant, k=0 if autos else 1)
+    nbl = ant1.shape[0]
+    antpos = rng.normal(size=(nant, 3)) * 1000. + np.array([-2556109., 5097388., -2848440.]) # near ASKAP
+
+    writer = MeasurementSetWriter(
+        msname, freqs=743.5e6 + np.arange(nchan) * 1e6, chanwidth=1e6,
+        antnames=[f"ak{ia+1:02d}" for ia in range(nant)], antpos=antpos,
+        phase_dir=(0.1, -0.5), source="SYNTHETIC", npol=npol,
+    )
+    uvw = (antpos[ant1] - antpos[ant2])
+    for it in range(nt):
+        vis = (rng.normal(size=(nbl, nchan, npol)) + 1j * rng.normal(size=(nbl, nchan, npol))).astype(np.complex64)
+        writer.write(
+            time=np.ones(nbl) * (5e9 + it * tsamp), ant1=ant1, ant2=ant2, uvw=uvw,
+            data=vis, flag=np.zeros(vis.shape, dtype=bool), weight=np.ones(vis.shape, dtype=np.float32),
+            interval=np.ones(nbl) * tsamp,
+        )
+    writer.close()
+
+    if corrected:
+        from casacore.tables import table, makecoldesc
+        t = table(msname, readonly=False, ack=False)
+        t.addcols(makecoldesc("CORRECTED_DATA", t.getcoldesc("DATA")))
+        for startrow in range(0, t.nrows(), nbl):
+            t.putcol("CORRECTED_DATA", t.getcol("DATA", startrow, nbl), startrow, nbl)
+        t.close()
+    return nt * nbl
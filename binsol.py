@@ -0,0 +1,159 @@
+# normal python script - not command line executable
+# memory-mapped reader for the `.bin` calibration solutions written by `calibrate` (Emil's script)
+# the file stores sqrt(2) / gain as complex128 in (nsol, nant, nchan, npol) order after a 48 bytes header
+
+import os
+import glob
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+BIN_HEADER = np.dtype([
+    ("magic", "S8"),
+    ("filetype", "<i4"), ("structuretype", "<i4"),
+    ("nsol", "<i4"), ("nant", "<i4"), ("nchan", "<i4"), ("npol", "<i4"),
+    ("tstart", "<f8"), ("tend", "<f8"),
+])
+BIN_DTYPE = np.dtype("<c16")
+BIN_MAGIC = b"MWAOCAL\0"
+
+def read_header(fname):
+    """
+    read the header of a `.bin` file, `ValueError` is raised if `fname` is not a `.bin` solution
+    (no `BIN_MAGIC`) or the payload size does not match the shape in the header
+
+    Returns
+    ----------
+    header: dict
+        nsol, nant, nchan, npol, tstart, tend, filetype and structuretype
+    """
+    header = np.fromfile(fname, dtype=BIN_HEADER, count=1)
+    if header.shape[0] == 0 or header[0]["magic"] != BIN_MAGIC.rstrip(b"\0"):
+        raise ValueError(f"{fname} is not a calibrate .bin solution... no {BIN_MAGIC} magic found")
+    header = {name: header[0][name].item() for name in BIN_HEADER.names if name != "magic"}
+
+    shape = tuple(header[key] for key in ("nsol", "nant", "nchan", "npol"))
+    if min(shape) < 0:
+        raise ValueError(f"{fname} has an invalid solution shape {shape} in the header")
+    expected = BIN_HEADER.itemsize + int(np.prod(shape)) * BIN_DTYPE.itemsize
+    if os.path.getsize(fname) != expected:
+        raise ValueError(
+            f"{fname} has {os.path.getsize(fname)} bytes... expect {expected} bytes for solution with shape {shape}"
+        )
+    return header
+
+def invert(raw, out=None):
+    """
+    convert the values saved in the `.bin` file to gains, i.e., sqrt(2) / raw, `out` can be `raw` itself
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.divide(np.sqrt(2.), raw, out=out)
+
+class BinSolution:
+    """
+    calibration solution in a `.bin` file, the payload is memory-mapped and only read when needed
+
+    Params
+    ----------
+    fname: str
+        path to the `.bin` file
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.header = read_header(fname)
+        self.shape = tuple(self.header[key] for key in ("nsol", "nant", "nchan", "npol"))
+        self._gains = None
+
+    @property
+    def raw(self):
+        """
+        memory-mapped payload, i.e., sqrt(2) / gains, read-only
+        """
+        return np.memmap(self.fname, dtype=BIN_DTYPE, mode="r", offset=BIN_HEADER.itemsize, shape=self.shape)
+
+    @property
+    def gains(self):
+        """
+        gains (nsol, nant, nchan, npol), computed once at the first access
+        """
+        if self._gains is None:
+            self._gains = invert(self.raw)
+        return self._gains
+
+    def load(self, out=None, isol=None):
+        """
+        read the gains into `out` (allocated if None) without any intermediate copy
+
+        Params
+        ----------
+        isol: int, optional
+            only load one solution interval, i.e., `out` is (nant, nchan, npol)
+        """
+        raw = self.raw if isol is None else self.raw[isol]
+        return invert(raw, out=out)
+
+def load_gains(fname, isol=None, out=None):
+    """
+    load gains from a `.bin` file, see `BinSolution.load`
+    """
+    return BinSolution(fname).load(out=out, isol=isol)
+
+def write_gains(fname, gains, tstart=0., tend=0.):
+    """
+    write `gains` (nsol, nant, nchan, npol) as a `.bin` file, i.e., sqrt(2) / gains is saved,
+    the same format as the output of `calibrate`
+
+    Params
+    ----------
+    tstart, tend: float
+        start and end time (MJD seconds) of the solutions, saved in the header
+    """
+    nsol, nant, nchan, npol = gains.shape
+    header = np.zeros(1, dtype=BIN_HEADER)
+    header["magic"] = BIN_MAGIC
+    header["nsol"], header["nant"], header["nchan"], header["npol"] = nsol, nant, nchan, npol
+    header["tstart"], header["tend"] = tstart, tend
+    with open(fname, "wb") as fp:
+        header.tofile(fp)
+        invert(np.asarray(gains, dtype=BIN_DTYPE)).tofile(fp)
+
+def find_sbid_bins(sbid, basedir="/data/big/craco/calibration"):
+    """
+    find all `.bin` solutions of an SBID, following the output structure of `calib_allbeam.py`,
+    i.e., <basedir>/SB<sbid>/scans/<scan>/<timestamp>/<beam>/b<beam>.aver.4pol.bin
+    """
+    sbid = "SB{:0>6}".format(str(sbid).replace("SB", ""))
+    return sorted(glob.glob(f"{basedir}/{sbid}/scans/*/*/*/b??.aver.4pol.bin"))
+
+def load_sbid(fnames, out=None):
+    """
+    load solutions from many `.bin` files (e.g., all beams and scans of an SBID) into one array
+
+    Params
+    ----------
+    fnames: list of str
+        `.bin` files, all of them should have the same shape, see `find_sbid_bins`
+    out: numpy.ndarray, optional
+        preallocated complex array with shape (nbin, nsol, nant, nchan, npol)
+
+    Returns
+    ----------
+    gains: numpy.ndarray, (nbin, nsol, nant, nchan, npol)
+    """
+    sols = [BinSolution(fname) for fname in fnames]
+    if len(sols) == 0:
+        raise ValueError("no solution file to load...")
+    shape = sols[0].shape
+    for sol in sols:
+        if sol.shape != shape:
+            raise ValueError(f"solution shape {sol.shape} of {sol.fname} is different from {shape}")
+
+    if out is None:
+        out = np.empty((len(sols), *shape), dtype=complex)
+    elif out.shape != (len(sols), *shape):
+        raise ValueError(f"output array shape {out.shape} does not match {(len(sols), *shape)}")
+
+    for ibin, sol in enumerate(sols):
+        sol.load(out=out[ibin])
+    return out
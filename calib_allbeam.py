@@ -1,10 +1,19 @@
 #!/usr/bin/env python
 # python scripts for calibration for all beams
 import os
+import sys
 import glob
+import time
 import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 from craft.cmdline import strrange
+from flag import RFI_MODES
+
+import logging
+log = logging.getLogger(__name__)
 
 def _check_file(file, dir):
     """
@@ -16,14 +25,14 @@ def _check_file(file, dir):
         return True
     return False
 
-def execute_calibration(
+def prepare_calibration(
     craco_input, work_dir="./",
     build_dir="/data/craco/wan342/scripts/craco_calib/scripts",
-    catalog="racs-low.fits", catfreq=887.5, flagchan=None
+    catalog="racs-low.fits", catfreq=887.5, flagchan=None, model=None, rfi=None,
 ):
 # TODO: change catalog, build_dir, catfreq when moving to seren...
     """
-    execute calibration process and save the output to a specific directory...
+    prepare the working directory and return the calibration command for a beam
     """
     if craco_input is None:
         raise ValueError("no craco uvfits file found... use -h flag to see all available parameter")
@@ -40,8 +49,123 @@ def execute_calibration(
     calcmd = f"gen_calibration_soln.py -vis_uvfits {work_dir}/{craco_fitsfname} -build_dir {build_dir}"
     calcmd += f" -catalog {catalog} -catfreq {catfreq}"
     if flagchan is not None: calcmd += f" -flagchan {flagchan}"
+    if model is not None: calcmd += f" -model {model}"
+    if rfi is not None: calcmd += f" -rfi {rfi}"
+    return calcmd
+
+def execute_calibration(
+    craco_input, work_dir="./",
+    build_dir="/data/craco/wan342/scripts/craco_calib/scripts",
+    catalog="racs-low.fits", catfreq=887.5, flagchan=None, model=None, rfi=None,
+):
+    """
+    execute calibration process and save the output to a specific directory...
+    """
+    calcmd = prepare_calibration(
+        craco_input, work_dir=work_dir, build_dir=build_dir,
+        catalog=catalog, catfreq=catfreq, flagchan=flagchan, model=model, rfi=rfi,
+    )
     # print(calcmd)
-    os.system(calcmd)
+    return os.system(calcmd)
+
+def _estimate_memory(uvfitspath, memfactor=1.0):
+    """
+    rough peak memory (in GB) needed to calibrate a beam, scaled from the size of the uvfits file
+    """
+    return os.path.getsize(os.path.realpath(uvfitspath)) / 1024**3 * memfactor
+
+class BeamScheduler:
+    """
+    run calibration commands of many beams concurrently
+
+    Params
+    ----------
+    njobs: int, 1 by default
+        maximum number of beams running at the same time
+    maxmem: float, optional
+        memory budget in GB, a beam only starts when the estimated memory of all running beams fits in it.
+        A beam larger than the budget runs on its own. No limit if None
+    jobdir: str, optional
+        run the commands with warm workers serving this job directory (see `worker.py`)
+        instead of starting a new process for each beam
+    jobtimeout: float, optional
+        seconds to wait for each beam submitted to `jobdir` (including the time in the queue), no limit if None.
+        Beams are failed anyway if no worker is alive or their worker dies, see `worker.wait`
+    """
+    def __init__(self, njobs=1, maxmem=None, jobdir=None, jobtimeout=None):
+        self.njobs = max(1, njobs)
+        self.maxmem = maxmem
+        self.jobdir = jobdir
+        self.jobtimeout = jobtimeout
+
+        self._cond = threading.Condition()
+        self._usedmem = 0.
+        self._nrunning = 0
+
+    def _admit(self, mem):
+        with self._cond:
+            while self.maxmem is not None and self._nrunning > 0 and self._usedmem + mem > self.maxmem:
+                self._cond.wait()
+            self._usedmem += mem
+            self._nrunning += 1
+
+    def _release(self, mem):
+        with self._cond:
+            self._usedmem -= mem
+            self._nrunning -= 1
+            self._cond.notify_all()
+
+    def _run_job(self, job):
+        self._admit(job["mem"])
+        log.info(f"""starting {job["name"]} (~{job["mem"]:.1f} GB), log in {job["logfile"]}""")
+        tstart = time.time()
+        try:
+            if self.jobdir is not None:
+                from worker import run_job
+                returncode = run_job(
+                    self.jobdir, job["cmd"], name=job["name"], logfile=job["logfile"], timeout=self.jobtimeout,
+                )
+            else:
+                with open(job["logfile"], "w") as logfp:
+                    proc = subprocess.run(job["cmd"], shell=True, stdout=logfp, stderr=subprocess.STDOUT)
+                returncode = proc.returncode
+        except Exception as error:
+            log.error(f"""failed to run {job["name"]}... {error}""")
+            returncode = -1
+        finally:
+            self._release(job["mem"])
+
+        result = dict(name=job["name"], logfile=job["logfile"], returncode=returncode, elapsed=time.time() - tstart)
+        status = "finished" if returncode == 0 else f"FAILED (exit code {returncode})"
+        log.info(f"""{job["name"]} {status} in {result["elapsed"]:.1f} s""")
+        return result
+
+    def run(self, jobs):
+        """
+        run all `jobs` and wait for them to finish
+
+        Params
+        ----------
+        jobs: list of dict
+            each with name, cmd (shell command), logfile and mem (estimated memory in GB)
+
+        Returns
+        ----------
+        results: list of dict
+            name, logfile, returncode and elapsed (in seconds) of each job, in the same order as `jobs`
+        """
+        with ThreadPoolExecutor(max_workers=self.njobs) as executor:
+            results = list(executor.map(self._run_job, jobs))
+        self.summary(results)
+        return results
+
+    @staticmethod
+    def summary(results):
+        failed = [result for result in results if result["returncode"] != 0]
+        log.info(f"{len(results) - len(failed)}/{len(results)} beams calibrated successfully")
+        for result in failed:
+            log.error(f"""{result["name"]} failed with exit code {result["returncode"]}, see {result["logfile"]}""")
+        return failed
 
 
 ### functions for running one SBID as a whole
@@ -93,25 +217,112 @@ def _construct_workdir(path, basedir="./"):
     finfo = _extract_uvfits_info(path)
     return f'''{basedir}/{finfo["sbid"]}/scans/{finfo["scan"]}/{finfo["timestamp"]}/{finfo["beam"]}/'''
 
+def _model_path(path, basedir="./"):
+    """
+    path of the sky model made by `gen_calibration_soln.py` for the uvfits file
+    """
+    beamname = os.path.basename(path).replace(".uvfits", "")
+    return os.path.join(_construct_workdir(path, basedir=basedir), f"{beamname}.aver.4pol.model")
+
+def extract_sbid_models(uvfitspaths, basedir="./", catalog="racs-low.fits", catfreq=887.5):
+    """
+    make sky models for all beams, with one catalogue query per scan footprint
+
+    Returns
+    ----------
+    models: dict
+        path to the sky model for each uvfits file
+    """
+    from extract_model_for_ms import beam_from_uvfits, process_footprint
+
+    scans = {}
+    for uvfitspath in uvfitspaths:
+        finfo = _extract_uvfits_info(uvfitspath)
+        scans.setdefault((finfo["sbid"], finfo["scan"], finfo["timestamp"]), []).append(uvfitspath)
+
+    models = {}
+    for scanpaths in scans.values():
+        beams = []
+        for uvfitspath in scanpaths:
+            work_dir = _construct_workdir(uvfitspath, basedir=basedir)
+            if not os.path.exists(work_dir):
+                os.makedirs(work_dir)
+            models[uvfitspath] = _model_path(uvfitspath, basedir=basedir)
+            beams.append((models[uvfitspath], *beam_from_uvfits(uvfitspath)))
+        process_footprint(
+            beams, pb_radii=2.0, flux_cutoff=0.005, spectral_index=-0.83,
+            catalog_file=catalog, freq_cat=catfreq*1e6,
+        )
+    return models
+
 def calibrate_sbid(
         sbid, basedir="./", build_dir="/data/craco/wan342/scripts/craco_calib/scripts",
         catalog="/data/big/craco/calibration/dat/racs-low.fits", catfreq=887.5,
-        runname="results", flagchan=None,
+        runname="results", flagchan=None, footprint=False,
+        njobs=1, maxmem=None, memfactor=1.0, archive=False, rfi=None, jobdir=None, jobtimeout=None,
     ):
     """
     produce calibration solution based on a given sbid.
     All relevant outputs are saving under the given base directory
+
+    Params
+    ----------
+    footprint: bool, False by default
+        make sky models of all beams together before the calibration (see `extract_sbid_models`),
+        instead of extracting it in each beam
+    njobs: int, 1 by default
+        number of beams to calibrate at the same time
+    maxmem: float, optional
+        memory budget (in GB) for all running beams, see `BeamScheduler`
+    memfactor: float, 1.0 by default
+        estimated memory of a beam in the unit of its uvfits file size
+    archive: bool, False by default
+        save all solutions of the SBID to a single archive (see `solarchive.py`) when all beams are done
+    rfi: str, optional
+        statistical RFI flagging mode before the calibration, see `flag.flag_rfi`
+    jobdir: str, optional
+        job directory of warm workers to run the beams with, see `BeamScheduler`
+    jobtimeout: float, optional
+        seconds to wait for each beam submitted to `jobdir`, see `BeamScheduler`
+
+    Returns
+    ----------
+    results: list of dict
+        exit status and log file of each beam, see `BeamScheduler.run`
     """
     uvfitspaths = _find_uvfits(sbid, runname=runname)
+    models = {}
+    if footprint:
+        models = extract_sbid_models(uvfitspaths, basedir=basedir, catalog=catalog, catfreq=catfreq)
+
+    jobs = []
     for uvfitspath in uvfitspaths:
         work_dir = _construct_workdir(uvfitspath, basedir=basedir)
-        execute_calibration(
+        calcmd = prepare_calibration(
             craco_input=uvfitspath,
             work_dir=work_dir,
             build_dir=build_dir,
             catalog=catalog, catfreq=catfreq,
-            flagchan=flagchan,
+            flagchan=flagchan, model=models.get(uvfitspath), rfi=rfi,
         )
+        finfo = _extract_uvfits_info(uvfitspath)
+        jobs.append(dict(
+            name=f"""{finfo["sbid"]}/scan{finfo["scan"]}/{finfo["timestamp"]}/b{finfo["beam"]}""",
+            cmd=calcmd, logfile=os.path.join(work_dir, "calib.log"),
+            mem=_estimate_memory(uvfitspath, memfactor=memfactor),
+        ))
+
+    scheduler = BeamScheduler(njobs=njobs, maxmem=maxmem, jobdir=jobdir, jobtimeout=jobtimeout)
+    results = scheduler.run(jobs)
+
+    if archive:
+        from binsol import find_sbid_bins
+        from solarchive import write_archive
+        sbid = "{:0>6}".format(sbid)
+        binfnames = find_sbid_bins(sbid, basedir=basedir)
+        if len(binfnames) > 0:
+            write_archive(f"{basedir}/SB{sbid}/SB{sbid}.calsol", binfnames, sbid=sbid)
+    return results
 
 def _main():
     args = argparse.ArgumentParser()
@@ -133,13 +344,53 @@ def _main():
         default=None
     )
 
+    args.add_argument(
+        "--rfi", type=str, help="statistical RFI flagging mode before calibration (def: none)",
+        default=None, choices=RFI_MODES,
+    )
+
+    args.add_argument(
+        "--footprint", action="store_true",
+        help="extract sky models of all beams in a scan with one catalogue query",
+    )
+
+    args.add_argument(
+        "-j", "--njobs", type=int, help="number of beams to calibrate at the same time (def: 1)", default=1,
+    )
+    args.add_argument(
+        "-m", "--maxmem", type=float, help="memory budget in GB for all running beams (def: no limit)", default=None,
+    )
+    args.add_argument(
+        "--memfactor", type=float, help="estimated memory of a beam in the unit of its uvfits size (def: 1.0)", default=1.0,
+    )
+
+    args.add_argument(
+        "--jobdir", type=str, default=None,
+        help="submit beams to warm workers serving this job directory (see worker.py) instead of new processes",
+    )
+    args.add_argument(
+        "--jobtimeout", type=float, default=None,
+        help="seconds to wait for each beam submitted to --jobdir before failing it (def: no limit, "
+        "beams still fail if no worker is alive or their worker dies)",
+    )
+
+    args.add_argument(
+        "--archive", action="store_true",
+        help="save all solutions to <dir>/SB<sbid>/SB<sbid>.calsol when all beams are done",
+    )
+
     values = args.parse_args()
 
-    calibrate_sbid(
+    results = calibrate_sbid(
         sbid=values.sbid, basedir=values.dir, build_dir=values.build_dir,
         catalog="/data/big/craco/calibration/dat/racs-low.fits", catfreq=887.5,
-        runname=values.runname, flagchan=values.flagchan
+        runname=values.runname, flagchan=values.flagchan, footprint=values.footprint,
+        njobs=values.njobs, maxmem=values.maxmem, memfactor=values.memfactor,
+        archive=values.archive, rfi=values.rfi, jobdir=values.jobdir, jobtimeout=values.jobtimeout,
     )
+    if any(result["returncode"] != 0 for result in results):
+        sys.exit(1)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     _main()
\ No newline at end of file
@@ -4,6 +4,7 @@
 ### this is designed for skadi cluster
 
 import os
+import sys
 import re
 import glob
 import argparse
@@ -29,7 +30,7 @@ class BeamCalibrator:
         caldir="/data/craco/craco/calibration", #="/CRACO/DATA_00/craco/calibration", # make it store in separate node
         build_dir="/CRACO/SOFTWARE/craco/wan342/Software/craco_calib/scripts",
         catalog="/CRACO/DATA_00/craco/calibration/data/racs-low.fits", 
-        catfreq=887.5, overwrite=True
+        catfreq=887.5, overwrite=True, jobdir=None, jobtimeout=None,
     ):
         self.uvfitspath = os.path.abspath(uvfitspath)
         self.caldir = caldir
@@ -37,6 +38,9 @@ class BeamCalibrator:
         self.catalog = catalog
         self.catfreq = catfreq
         self.overwrite = overwrite
+        ### run `gen_calibration_soln.py` with warm workers serving `jobdir` (see `worker.py`) if provided
+        self.jobdir = jobdir
+        self.jobtimeout = jobtimeout
 
         ### extract information based on uvfitspath
         self.obsinfo = self.extract_uvfits_info(self.uvfitspath)
@@ -59,12 +63,13 @@ class BeamCalibrator:
         """
         return f"""{caldir}/SB{obsinfo["sbid"]}/{obsinfo["beam"]}"""
 
-    def prepare_calib(self, overwrite):
+    def prepare_calib(self, overwrite, resume=False):
         """
         function to prepare for following calibration
         - check if there is folder created
         - check if there is solution existed
         - remove old files if solution existed and overwrite is True
+        - keep all files if resume is True, stages with valid outputs are skipped (see `manifest.py`)
         """
         self.workdir = self.__get_workdir(self.caldir, self.obsinfo)
         ### create new folders
@@ -78,10 +83,17 @@ class BeamCalibrator:
                 log.warning("file exists... no further action needed...")
                 raise ValueError("calibration exists without overwriting... aborted...")
 
-        ### clean up the directory
-        rmcmd = f"rm -r {self.workdir}/*"
-        log.info(f"clean up work directory with {rmcmd}")
-        os.system(rmcmd)
+        uvfitslink = f"""{self.workdir}/b{self.obsinfo["beam"]}.uvfits"""
+        if resume:
+            log.info(f"resume calibration in {self.workdir}...")
+            if os.path.islink(uvfitslink) and os.path.realpath(uvfitslink) == os.path.realpath(self.uvfitspath):
+                return
+            if os.path.lexists(uvfitslink): os.remove(uvfitslink)
+        else:
+            ### clean up the directory
+            rmcmd = f"rm -r {self.workdir}/*"
+            log.info(f"clean up work directory with {rmcmd}")
+            os.system(rmcmd)
 
         ### link uvfits file to the work directory
         lncmd = f"""ln -s {self.uvfitspath} {self.workdir}/b{self.obsinfo["beam"]}.uvfits"""
@@ -91,21 +103,43 @@ class BeamCalibrator:
     def execute_calib(self, ):
         calcmd = f"""gen_calibration_soln.py -vis_uvfits {self.workdir}/b{self.obsinfo["beam"]}.uvfits"""
         calcmd += f""" -build_dir {self.build_dir} -catalog {self.catalog} -catfreq {self.catfreq}"""
+        if self.jobdir is not None:
+            from worker import run_job
+            log.info(f"submitting `gen_calibration_soln.py` command to {self.jobdir} - {calcmd}")
+            return run_job(
+                self.jobdir, calcmd, name=self.uvfitspath, logfile=f"{self.workdir}/calib.log", cwd=self.workdir,
+                timeout=self.jobtimeout,
+            )
         log.info(f"executing `gen_calibration_soln.py` command - {calcmd}")
-        os.system(calcmd)
+        return os.waitstatus_to_exitcode(os.system(calcmd))
 
-    def run(self, overwrite=True):
-        self.prepare_calib(overwrite=overwrite)
-        self.execute_calib()
+    def run(self, overwrite=True, resume=False):
+        self.prepare_calib(overwrite=overwrite, resume=resume)
+        return self.execute_calib()
 
 def main():
     args = argparse.ArgumentParser()
     args.add_argument("-uv", "--uvfits", type=str, help="uvfits file to run calibration on")
+    args.add_argument(
+        "-resume", "--resume", action="store_true",
+        help="keep the work directory and only redo the stages that are out of date",
+    )
+    args.add_argument(
+        "-jobdir", "--jobdir", type=str, default=None,
+        help="submit the calibration to warm workers serving this job directory (see worker.py)",
+    )
+    args.add_argument(
+        "-jobtimeout", "--jobtimeout", type=float, default=None,
+        help="seconds to wait for the job submitted to -jobdir before failing it (def: no limit, "
+        "it still fails if no worker is alive or its worker dies)",
+    )
     
     values = args.parse_args()
 
-    beamcal = BeamCalibrator(uvfitspath=values.uvfits)
-    beamcal.run(overwrite=True)
+    beamcal = BeamCalibrator(uvfitspath=values.uvfits, jobdir=values.jobdir, jobtimeout=values.jobtimeout)
+    returncode = beamcal.run(overwrite=True, resume=values.resume)
+    if returncode != 0:
+        sys.exit(returncode)
 
 
 if __name__ == "__main__":
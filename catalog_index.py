@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# on-disk spatial index of the sky catalogue (e.g., racs-low.fits) used for making sky models
+# the catalogue is split into declination zones, sources are sorted by RA within each zone,
+# and the needed columns are saved as numpy arrays that are memory-mapped when querying
+
+import os
+import json
+import fcntl
+import shutil
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+### columns used in `extract_model_for_ms`
+CATALOG_COLUMNS = ["Gaussian_ID", "RA", "Dec", "Total_flux_Gaussian", "DC_Maj", "DC_Min", "DC_PA"]
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """
+    angular separation (Vincenty formula, same as astropy) between two directions, all in radian
+    """
+    sdra, cdra = np.sin(ra2 - ra1), np.cos(ra2 - ra1)
+    sdec1, cdec1 = np.sin(dec1), np.cos(dec1)
+    sdec2, cdec2 = np.sin(dec2), np.cos(dec2)
+
+    num1 = cdec2 * sdra
+    num2 = cdec1 * sdec2 - sdec1 * cdec2 * cdra
+    denominator = sdec1 * sdec2 + cdec1 * cdec2 * cdra
+    return np.arctan2(np.hypot(num1, num2), denominator)
+
+def default_indexdir(catalog_file):
+    """
+    index directory next to the catalogue, i.e., racs-low.fits -> racs-low.index
+    """
+    return os.path.splitext(catalog_file)[0] + ".index"
+
+@contextlib.contextmanager
+def _index_lock(indexdir):
+    """
+    exclusive lock (<indexdir>.lock) held while building an index, e.g., by parallel beams or several workers
+    """
+    lockfile = os.path.abspath(indexdir).rstrip("/") + ".lock"
+    os.makedirs(os.path.dirname(lockfile), exist_ok=True)
+    with open(lockfile, "a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+def _is_current(catalog_file, indexdir):
+    metafile = f"{indexdir}/index.json"
+    return os.path.exists(metafile) and os.path.getmtime(metafile) >= os.path.getmtime(catalog_file)
+
+def build_index(catalog_file, indexdir=None, zoneheight=1.0, columns=CATALOG_COLUMNS):
+    """
+    build a zone index for `catalog_file` and save it under `indexdir`.
+    The index is written to a temporary directory next to `indexdir` (metadata last) and moved into place,
+    so that readers never memory-map a partially written index
+
+    Params
+    ----------
+    catalog_file: str
+        path to the fits catalogue
+    indexdir: str, optional
+        directory to save the index, see `default_indexdir` for the default value
+    zoneheight: float, 1.0 by default
+        height of each declination zone in degree
+
+    Returns
+    ----------
+    indexdir: str
+    """
+    if indexdir is None: indexdir = default_indexdir(catalog_file)
+    with _index_lock(indexdir):
+        return _build_index(catalog_file, indexdir, zoneheight=zoneheight, columns=columns)
+
+def _build_index(catalog_file, indexdir, zoneheight=1.0, columns=CATALOG_COLUMNS):
+    """
+    `build_index` without taking the lock
+    """
+    indexdir = os.path.abspath(indexdir).rstrip("/")
+    tmpdir = tempfile.mkdtemp(prefix=f".{os.path.basename(indexdir)}.", dir=os.path.dirname(indexdir))
+    os.chmod(tmpdir, 0o755) # shared with other users of the catalogue
+    try:
+        _write_index(catalog_file, tmpdir, zoneheight=zoneheight, columns=columns)
+        ### a directory can not replace a non-empty one, move the old index away first
+        ### (files memory-mapped from it stay valid until they are closed)
+        olddir = f"{tmpdir}.old"
+        if os.path.exists(indexdir): os.rename(indexdir, olddir)
+        os.rename(tmpdir, indexdir)
+        shutil.rmtree(olddir, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return indexdir
+
+def _write_index(catalog_file, indexdir, zoneheight=1.0, columns=CATALOG_COLUMNS):
+    log.info(f"building catalogue index for {catalog_file} in {indexdir}...")
+    from astropy.table import Table # only needed when building the index
+    cat = Table.read(catalog_file)
+    ra = np.asarray(cat["RA"], dtype=float) % 360.
+    dec = np.asarray(cat["Dec"], dtype=float)
+
+    nzone = int(np.ceil(180. / zoneheight))
+    zone = np.clip(np.floor((dec + 90.) / zoneheight).astype(int), 0, nzone - 1)
+    order = np.lexsort((ra, zone))
+    zoneoffsets = np.searchsorted(zone[order], np.arange(nzone + 1))
+
+    np.save(f"{indexdir}/ROW.npy", order)
+    np.save(f"{indexdir}/ZONE_OFFSET.npy", zoneoffsets)
+    for column in columns:
+        value = ra if column == "RA" else np.asarray(cat[column])
+        np.save(f"{indexdir}/{column}.npy", value[order])
+
+    with open(f"{indexdir}/index.json", "w") as fp:
+        json.dump(dict(
+            catalog=os.path.abspath(catalog_file), nrow=len(cat),
+            zoneheight=zoneheight, columns=list(columns),
+        ), fp, indent=2)
+
+class CatalogIndex:
+    """
+    cone search on a catalogue index built with `build_index`,
+    only the sources in the zones (and RA ranges) overlapping with the cone are read from the disk
+
+    Params
+    ----------
+    indexdir: str
+        directory of the index
+    """
+    def __init__(self, indexdir):
+        self.indexdir = indexdir
+        with open(f"{indexdir}/index.json") as fp:
+            self.meta = json.load(fp)
+        self.zoneheight = self.meta["zoneheight"]
+        self.zoneoffsets = np.load(f"{indexdir}/ZONE_OFFSET.npy")
+        self.nzone = self.zoneoffsets.shape[0] - 1
+        self._columns = {}
+
+    @classmethod
+    def from_catalog(cls, catalog_file, indexdir=None):
+        """
+        load the index of `catalog_file`, (re)build it if it does not exist or it is older than the catalogue
+        """
+        if indexdir is None: indexdir = default_indexdir(catalog_file)
+        if not _is_current(catalog_file, indexdir):
+            with _index_lock(indexdir):
+                ### another process may have built it while waiting for the lock
+                if not _is_current(catalog_file, indexdir):
+                    _build_index(catalog_file, indexdir)
+        return cls(indexdir)
+
+    @property
+    def columns(self):
+        return self.meta["columns"]
+
+    def column(self, name):
+        """
+        memory-mapped column in the index order
+        """
+        if name not in self._columns:
+            self._columns[name] = np.load(f"{self.indexdir}/{name}.npy", mmap_mode="r")
+        return self._columns[name]
+
+    def _ra_ranges(self, ra, dec, radius):
+        """
+        RA range(s) in degree covered by the cone, split into two if wrapping around 0/360
+        """
+        if abs(dec) + radius >= 90.:
+            return [(0., 360.)]
+        dra = np.degrees(np.arcsin(np.sin(np.radians(radius)) / np.cos(np.radians(dec))))
+        ramin, ramax = (ra - dra) % 360., (ra + dra) % 360.
+        if ramin <= ramax:
+            return [(ramin, ramax)]
+        return [(0., ramax), (ramin, 360.)]
+
+    def _candidates(self, ra, dec, radius):
+        """
+        index of all sources in the bounding zones and RA ranges of the cone
+        """
+        zonemin = max(int(np.floor((dec - radius + 90.) / self.zoneheight)), 0)
+        zonemax = min(int(np.floor((dec + radius + 90.) / self.zoneheight)), self.nzone - 1)
+        racol = self.column("RA")
+
+        candidates = []
+        for zone in range(zonemin, zonemax + 1):
+            start, end = self.zoneoffsets[zone], self.zoneoffsets[zone + 1]
+            if start == end: continue
+            zonera = racol[start:end]
+            for ramin, ramax in self._ra_ranges(ra, dec, radius):
+                istart = np.searchsorted(zonera, ramin, side="left")
+                iend = np.searchsorted(zonera, ramax, side="right")
+                candidates.append(np.arange(start + istart, start + iend))
+        if len(candidates) == 0:
+            return np.zeros(0, dtype=int)
+        return np.concatenate(candidates)
+
+    def query(self, ra, dec, radius, columns=None):
+        """
+        find all sources within `radius` of (`ra`, `dec`), all in degree
+
+        Returns
+        ----------
+        sources: dict
+            requested columns (all by default) of the sources in the original catalogue order,
+            together with `ROW` (row number in the catalogue) and `SEP` (separation in radian)
+        """
+        if columns is None: columns = self.columns
+        candidates = self._candidates(ra, dec, radius)
+
+        sep = angular_separation(
+            np.radians(ra), np.radians(dec),
+            np.radians(self.column("RA")[candidates]), np.radians(self.column("Dec")[candidates]),
+        )
+        within = sep < np.radians(radius)
+        candidates, sep = candidates[within], sep[within]
+
+        ### keep the catalogue order
+        rows = self.column("ROW")[candidates]
+        order = np.argsort(rows, kind="stable")
+        candidates = candidates[order]
+
+        sources = {column: np.asarray(self.column(column)[candidates]) for column in columns}
+        sources["ROW"] = rows[order]
+        sources["SEP"] = sep[order]
+        return sources
+
+### indices loaded in this process, see `cached_index`
+_INDEX_CACHE = {}
+
+def cached_index(catalog_file, indexdir=None):
+    """
+    `CatalogIndex.from_catalog` kept in memory for later calls in the same process (e.g., `worker.py`),
+    it is reloaded if the catalogue is changed
+    """
+    key = (os.path.abspath(catalog_file), indexdir)
+    mtime = os.path.getmtime(catalog_file)
+    if key not in _INDEX_CACHE or _INDEX_CACHE[key][0] != mtime:
+        _INDEX_CACHE[key] = (mtime, CatalogIndex.from_catalog(catalog_file, indexdir=indexdir))
+    return _INDEX_CACHE[key][1]
+
+def main(args):
+    if args.catalog is None:
+        raise ValueError("Need to provide a catalogue to index")
+    build_index(args.catalog, indexdir=args.indexdir, zoneheight=args.zoneheight)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    a = argparse.ArgumentParser()
+    a.add_argument("-catalog", type=str, help="Path to the fits catalogue")
+    a.add_argument("-indexdir", type=str, help="Directory to save the index (def: <catalog>.index)", default=None)
+    a.add_argument("-zoneheight", type=float, help="Height of declination zones in degree (def: 1.0)", default=1.0)
+
+    args = a.parse_args()
+    main(args)
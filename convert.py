@@ -4,7 +4,24 @@ import numpy as np
 import argparse
 
 
-def make_4pol(t, column, zero=False):
+### polarisations used to fill the 4 output polarisations (XX, XY, YX, YY) for a given input npol
+POL_EXPAND = {1: [0, 0, 0, 0], 2: [0, 1, 0, 1], 4: [0, 1, 2, 3]}
+
+def expand_pol(arr, zero=False):
+    """
+    expand the last (polarisation) axis of `arr` to 4 polarisations in the same way as `make_4pol`,
+    cross-pols (i.e., 1 and 2) are zeroed if `zero` is True
+    """
+    out = arr[..., POL_EXPAND[arr.shape[-1]]]
+    if zero:
+        out[..., 1:3] = 0
+    return out
+
+def make_4pol(t, column, zero=False, chunksize=10000):
+    """
+    expand `column` of table `t` to 4 polarisations in place,
+    the column is processed `chunksize` rows at a time, so that the peak memory is bounded by the chunk size
+    """
     print("Expanding %s" %(column))
     # Rename the original column
     column_cp = "%s_OLD" %(column)
@@ -16,13 +33,8 @@ def make_4pol(t, column, zero=False):
     coldmi['NAME'] = column
     # Get a cell from the source to work out the approxiate dimensions
     cell = t.getcell(column_cp, 0)
-    # How many polarisations?
-    in_pol = cell.shape[-1]
     # Make space for all polarisations
-    if in_pol == 2:
-        out_cell = np.concatenate([cell,cell], axis=len(cell.shape)-1)
-    elif in_pol == 1:
-        out_cell = np.concatenate([cell,cell,cell,cell], axis=len(cell.shape)-1)
+    out_cell = expand_pol(cell)
     # Get the new shape of the cell
     out_shape = out_cell.shape
     # Add the updated column
@@ -32,20 +44,25 @@ def make_4pol(t, column, zero=False):
         t.addcols(maketabdesc(makearrcoldesc(column, 0., valuetype=colddesc['desc']["valueType"], shape=out_shape, options=4, keywords=kw)), coldmi)
     else:
         t.addcols(maketabdesc(makearrcoldesc(column, 0., valuetype=colddesc['desc']["valueType"], shape=out_shape)), coldmi)
-        
-    # Get the original data
-    msdata = t.getcol(column_cp)
-    # Create the new column data by copying polarisation data
-    if in_pol == 2:
-        msdata2 = np.concatenate([msdata,msdata], axis=len(out_shape))
-    elif in_pol == 1:
-        msdata2 = np.concatenate([msdata,msdata,msdata,msdata], axis=len(out_shape))
-    # Check if data needs to be zeroed
-    if zero:
-        msdata2[:,:,1] -= msdata2[:,:,1]
-        msdata2[:,:,2] -= msdata2[:,:,2]
-    # Save the new column data
-    t.putcol(column, msdata2)
+
+    # Preallocate buffers for one chunk, reused for all chunks
+    nrow = t.nrows()
+    chunksize = max(1, min(chunksize, nrow))
+    inbuf = np.empty((chunksize, ) + cell.shape, dtype=cell.dtype)
+    outbuf = np.empty((chunksize, ) + out_shape, dtype=cell.dtype)
+    polidx = POL_EXPAND[cell.shape[-1]]
+    for startrow in range(0, nrow, chunksize):
+        nchunk = min(chunksize, nrow - startrow)
+        msdata, msdata2 = inbuf[:nchunk], outbuf[:nchunk]
+        # Get the original data
+        t.getcolnp(column_cp, msdata, startrow, nchunk)
+        # Create the new column data by copying polarisation data
+        np.take(msdata, polidx, axis=-1, out=msdata2)
+        # Check if data needs to be zeroed
+        if zero:
+            msdata2[..., 1:3] = 0
+        # Save the new column data
+        t.putcol(column, msdata2, startrow, nchunk)
     # Remove the old column
     t.removecols([column_cp])
     return
@@ -65,19 +82,19 @@ def update_pol(ms):
 
 # Convert a casa averaged MS from 1/2 pol to 4 pol
 
-def process(ms, msout):
+def process(ms, msout, chunksize=10000):
     os.system("rm -fr %s" %(msout))
     os.system("cp -R %s %s" %(ms, msout))
     
     t = table(msout, readonly=False)
     
-    make_4pol(t, "FLAG", False)
-    #make_4pol(t, "FLAG_CATEGORY", False)
-    make_4pol(t, "WEIGHT", False)
-    make_4pol(t, "SIGMA", False)
-    make_4pol(t, "DATA", True)
-    make_4pol(t, "WEIGHT_SPECTRUM", False)
-    make_4pol(t, "SIGMA_SPECTRUM", False)
+    make_4pol(t, "FLAG", False, chunksize=chunksize)
+    #make_4pol(t, "FLAG_CATEGORY", False, chunksize=chunksize)
+    make_4pol(t, "WEIGHT", False, chunksize=chunksize)
+    make_4pol(t, "SIGMA", False, chunksize=chunksize)
+    make_4pol(t, "DATA", True, chunksize=chunksize)
+    make_4pol(t, "WEIGHT_SPECTRUM", False, chunksize=chunksize)
+    make_4pol(t, "SIGMA_SPECTRUM", False, chunksize=chunksize)
     t.close()
     update_pol(msout)
 
@@ -92,12 +109,13 @@ def main(args):
     else:
         msout = args.outvis
 
-    process(ms, ms_out)
+    process(ms, msout, chunksize=args.chunksize)
 
 if __name__ == '__main__':
     a = argparse.ArgumentParser()
     a.add_argument("-vis", type=str, help="Path to the inp vis ms")
     a.add_argument("-outvis", type=str, help="Path to the output vis ms")
+    a.add_argument("-chunksize", type=int, help="Number of rows to expand at once (def: 10000)", default=10000)
 
     args = a.parse_args()
     main(args)
@@ -1,24 +1,36 @@
 ### get basic information for CRACO visibility data (without loading all blocks)
 
-from astropy.io import fits
 from casacore import tables
+from functools import cached_property
 import numpy as np
 
-from craco import plotbp
+import binsol
+from ms_writer import MOUNT_TYPES
 
 import warnings
 
+### speed of light in m/s, uvw in uvfits is in seconds
+SPEED_OF_LIGHT = 299792458.0
+### polarisations (XX, XY, YX, YY) of a baseline after swapping its antennas, XY becomes YX
+SWAPPED_POLS = [0, 2, 1, 3]
+
 class SimpleUvFits():
 
     def __init__(self, uvfits, ):
+        self.uvfits = uvfits
         self.hdul = self._load_fits(uvfits)
 
     def _load_fits(self, uvfits):
         """
         load fits file to hdulist
         """
+        from astropy.io import fits # astropy is slow to import, only load it for uvfits files
         return fits.open(uvfits)
 
+    @property
+    def header(self):
+        return self.hdul[0].header
+
     @property
     def tsamp(self):
         data = self.hdul[0].data[0] # only take the first block
@@ -30,148 +42,222 @@ class SimpleUvFits():
     def foff(self):
         return self.hdul[0].header["CDELT4"]
 
+    def _find_axis(self, ctype):
+        """
+        find the fits axis number (1-based) for a given CTYPE
+        """
+        for iaxis in range(1, self.header["NAXIS"] + 1):
+            if self.header.get(f"CTYPE{iaxis}", "").strip().startswith(ctype):
+                return iaxis
+        raise KeyError(f"no {ctype} axis found in {self.uvfits}...")
 
-class SimpleMeasurementSet():
-
-    def __init__(self, vistab):
-        # do some cleaning...
-        if vistab.endswith("/"): vistab = vistab[:-1]
-
-        self.dattab = self._load_data(vistab) 
-        self.freqtab = self._load_freq(vistab)
-
-        ### as we may need to change polarisation, don't use property to do that...
-        self.npol = self.dattab.getcell("DATA", 0).shape[-1]
-
-
-    def _load_data(self, vistab):
-        return tables.table(vistab)
+    def _axis_values(self, ctype):
+        iaxis = self._find_axis(ctype)
+        h = self.header
+        return h[f"CRVAL{iaxis}"] + (np.arange(h[f"NAXIS{iaxis}"]) + 1 - h[f"CRPIX{iaxis}"]) * h[f"CDELT{iaxis}"]
 
-    def _load_freq(self, vistab):
-        return tables.table("{}::SPECTRAL_WINDOW".format(vistab))
+    @property
+    def ngroup(self):
+        return self.header["GCOUNT"]
 
     @property
-    def tsamp(self):
-        return self.dattab.getcell("EXPOSURE", 0)
+    def nchan(self):
+        return self.header[f"NAXIS{self._find_axis('FREQ')}"]
 
     @property
-    def foff(self):
-        return self.freqtab.getcell("CHAN_WIDTH", 0)[0]
+    def npol(self):
+        return self.header[f"NAXIS{self._find_axis('STOKES')}"]
 
     @property
     def freqs(self):
         """
-        list of frequencies...
+        list of frequencies in Hz
         """
-        return self.freqtab.getcol("CHAN_FREQ")[0]
+        return self._axis_values("FREQ")
 
     @property
-    def nant(self):
+    def stokes(self):
         """
-        get the number of antennas
+        stokes/correlation code for each polarisation, e.g., -5 for XX, -6 for YY
         """
-        return np.unique(self.dattab.getcol("ANTENNA1")).shape[0]
+        return self._axis_values("STOKES").astype(int)
 
     @property
-    def nbl(self):
-        return self.nant * (self.nant + 1) // 2
-
-    # @property
-    # def npol(self):
-    #     return self.dattab.getcell("DATA", 0).shape[-1]
+    def phase_dir(self):
+        """
+        phase centre (ra, dec) in degree
+        """
+        try:
+            return self._axis_values("RA")[0], self._axis_values("DEC")[0]
+        except KeyError:
+            return self.header["OBSRA"], self.header["OBSDEC"]
 
     @property
-    def nchan(self):
-        return self.dattab.getcell("DATA", 0).shape[0]
+    def source(self):
+        return self.header.get("OBJECT", "UNKNOWN")
 
     @property
-    def nt(self):
-        return np.unique(self.dattab.getcol("TIME")).shape[0]
-
-    ### load data... this can be super slow...
-    def load_vis(self):
-        self.vis = self.dattab.getcol("DATA").reshape(
-            self.nt, self.nbl, self.nchan, self.npol
-        )
-
-        # if npol is 4, only select XX, YY
-        if self.npol == 4:
-            self.vis = self.vis[..., (0, 3)]
-            self.npol = 2
-
-        self.blant = self._load_bl_ant()
+    def antennas(self):
+        """
+        antenna information from the AIPS AN table
 
-    def _load_bl_ant(self):
+        Returns
+        ----------
+        names: list of str
+        positions: numpy.ndarray, (nant, 3), ITRF positions in metre
+        mounts: numpy.ndarray, (nant, ), AIPS mount type
         """
-        load antenna pairs as a numpy array, antennas are zero-based
+        antab = self.hdul["AIPS AN"]
+        arraycentre = np.array([antab.header.get(f"ARRAY{xyz}", 0.) for xyz in "XYZ"])
+        names = [name.strip() for name in antab.data["ANNAME"]]
+        positions = np.array(antab.data["STABXYZ"], dtype=float) + arraycentre
+        try: mounts = np.array(antab.data["MNTSTA"])
+        except KeyError: mounts = np.zeros(len(names), dtype=int)
+        return names, positions, mounts
+
+    ### raw random group access
+    def _group_layout(self):
         """
-        return np.array([
-            (i, j) for i in range(self.nant) for j in range(i, self.nant)
-        ])
-
-    def _load_gain(self, cal):
+        get parameter names and the numpy dtype for one random group record
         """
-        simple gain loader, as we will apply it to the original dataset,
-        we don't consider frequency here
+        h = self.header
+        assert h["BITPIX"] == -32, f"only float32 uvfits is supported... BITPIX={h['BITPIX']}"
+        parnames = [h[f"PTYPE{i}"].strip() for i in range(1, h["PCOUNT"] + 1)]
+        datashape = tuple(h[f"NAXIS{i}"] for i in range(h["NAXIS"], 1, -1))
+        recdtype = np.dtype([("par", ">f4", (h["PCOUNT"], )), ("data", ">f4", datashape)])
+        return parnames, recdtype
+
+    def _get_par(self, records, parnames, name):
         """
-        if cal.endswith(".bin"): # bin file
-            g = plotbp.Bandpass.load(cal).copy()[0]
-        elif cal.endswith(".smooth.npy"): # smoothed solution
-            g = np.load(cal)[0]
-
-        nant, nchan, npol = g.shape
-        assert self.nant <= nant, "not enough antenna in the solution table..."
-        assert self.nchan == nchan, "not equal number of channels in the solution table..."
-        if npol == 4: g = g[..., (0, 3)]; npol = 2
-        if npol == 2 and self.npol == 1:
-            g = g.mean(axis=-1, keepdims=True)
-        g = g[:self.nant, ...]
-
-        ### load it to baseline based
-        nant, nchan, npol = g.shape # reload npol...
-        solarr = np.zeros(
-            (self.nbl, self.nchan, self.npol),
-            dtype=complex,
-        )
-        for ibl, antpair in enumerate(self.blant):
-            ia1, ia2 = antpair
-            s1 = g[ia1, ...]
-            s2 = g[ia2, ...]
-            p = s1 * np.conj(s2)
-            solarr[ibl, ...] = p[:]
-
-        return 1./solarr
-### get basic information for CRACO visibility data (without loading all blocks)
-
-from astropy.io import fits
-from casacore import tables
-import numpy as np
-
-from craco import plotbp
-
-import warnings
-
-class SimpleUvFits():
-
-    def __init__(self, uvfits, ):
-        self.hdul = self._load_fits(uvfits)
-
-    def _load_fits(self, uvfits):
+        get scaled random parameter values, parameters with the same name (e.g., DATE) are added
         """
-        load fits file to hdulist
+        h = self.header
+        value = np.zeros(records.shape[0], dtype=float)
+        for i, parname in enumerate(parnames):
+            if parname != name: continue
+            value += records["par"][:, i].astype(float) * h.get(f"PSCAL{i+1}", 1.) + h.get(f"PZERO{i+1}", 0.)
+        return value
+
+    def _reshape_data(self, data):
         """
-        return fits.open(uvfits)
+        reshape the raw data to (nrow, nchan, npol, 3)
+        """
+        naxis = self.header["NAXIS"]
+        # numpy axis for fits axis n is (naxis - n + 1), with the first axis as row
+        ifreq, istokes, icomplex = [naxis - self._find_axis(ctype) + 1 for ctype in ("FREQ", "STOKES", "COMPLEX")]
+        data = np.moveaxis(data, (ifreq, istokes, icomplex), (-3, -2, -1))
+        return data.reshape(data.shape[0], self.nchan, self.npol, 3)
 
-    @property
-    def tsamp(self):
-        data = self.hdul[0].data[0] # only take the first block
-        try: ts = data["INTTIM"] # seconds
-        except KeyError: ts = 0. # assume that nothing...
-        return ts
+    def iter_blocks(self, blocksize=65536):
+        """
+        iterate over the random groups in blocks of `blocksize` rows without loading the whole file.
+        rows are returned with ANTENNA1 <= ANTENNA2 (data are conjugated, and XY/YX swapped, otherwise)
+
+        Returns
+        ----------
+        block: dict
+            time - (nrow, ) in MJD seconds, ant1/ant2 - (nrow, ) zero-based antenna index,
+            uvw - (nrow, 3) in metre, vis - (nrow, nchan, npol) complex64, weight - (nrow, nchan, npol) float32,
+            inttim - (nrow, ) integration time in seconds (0 if not recorded)
+        """
+        parnames, recdtype = self._group_layout()
+        datloc = self.hdul.fileinfo(0)["datLoc"]
+        records = np.memmap(self.uvfits, dtype=recdtype, mode="r", offset=datloc, shape=(self.ngroup, ))
+
+        for istart in range(0, self.ngroup, blocksize):
+            block = records[istart:istart+blocksize]
+
+            baseline = self._get_par(block, parnames, "BASELINE").astype(int)
+            # large antenna numbers are encoded differently, see AIPS memo 117
+            large = baseline > 65536
+            ant1 = np.where(large, (baseline - 65536) // 2048, baseline // 256) - 1
+            ant2 = np.where(large, (baseline - 65536) % 2048, baseline % 256) - 1
+
+            uvw = np.stack([
+                self._get_par(block, parnames, name) for name in ("UU", "VV", "WW")
+            ], axis=-1) * SPEED_OF_LIGHT
+            mjd = self._get_par(block, parnames, "DATE") - 2400000.5
+
+            data = self._reshape_data(np.asarray(block["data"], dtype=np.float32))
+            vis = data[..., 0] + 1j * data[..., 1]
+            weight = data[..., 2]
+
+            ### make sure ant1 <= ant2
+            swap = ant1 > ant2
+            if swap.any():
+                ant1[swap], ant2[swap] = ant2[swap], ant1[swap].copy()
+                uvw[swap] *= -1
+                vis[swap] = np.conj(vis[swap])
+                if vis.shape[-1] == 4:
+                    vis, weight = [np.where(swap[:, None, None], arr[..., SWAPPED_POLS], arr) for arr in (vis, weight)]
+
+            yield dict(
+                time=mjd * 86400., ant1=ant1, ant2=ant2, uvw=uvw,
+                vis=vis.astype(np.complex64), weight=weight,
+                inttim=self._get_par(block, parnames, "INTTIM") if "INTTIM" in parnames else np.zeros(block.shape[0]),
+            )
+
+
+class MeasurementSetSummary():
+    """
+    shape, frequency and timing information of a measurement set.
+    Everything is read from the subtables and a few cells of the main table, no full column scan is needed
+
+    Params
+    ----------
+    dattab: casacore.tables.table
+        main table of the measurement set
+    vistab: str
+        path to the measurement set
+    """
+    def __init__(self, dattab, vistab):
+        anttab = tables.table("{}::ANTENNA".format(vistab), ack=False)
+        self.ntabant = anttab.nrows()
+        anttab.close()
+
+        spwtab = tables.table("{}::SPECTRAL_WINDOW".format(vistab), ack=False)
+        self.freqs = spwtab.getcell("CHAN_FREQ", 0)
+        self.foff = spwtab.getcell("CHAN_WIDTH", 0)[0]
+        spwtab.close()
+        self.nchan = self.freqs.shape[0]
+
+        poltab = tables.table("{}::POLARIZATION".format(vistab), ack=False)
+        self.npol = poltab.getcell("NUM_CORR", 0)
+        poltab.close()
+
+        ### baselines from the rows sharing the first timestamp, the antenna table gives the upper limit
+        self.nrow = dattab.nrows()
+        nblmax = self.ntabant * (self.ntabant + 1) // 2
+        times = dattab.getcol("TIME", 0, min(self.nrow, nblmax + 1))
+        self.nbl = int((times == times[0]).sum())
+        ### integrations with missing rows (e.g., rows removed by split with keepflags=False) break the (nt, nbl) layout
+        self.regular = self.nrow % self.nbl == 0
+        if not self.regular:
+            warnings.warn(
+                f"{vistab} has {self.nrow} rows, not a multiple of the {self.nbl} baselines in the first integration, "
+                "nt is rounded down and the data can not be read as (nt, nbl)"
+            )
+        self.nt = self.nrow // self.nbl
+        self.ant1 = dattab.getcol("ANTENNA1", 0, self.nbl)
+        self.ant2 = dattab.getcol("ANTENNA2", 0, self.nbl)
+        self.nant = np.unique(np.concatenate([self.ant1, self.ant2])).shape[0]
+
+        self.tsamp = dattab.getcell("EXPOSURE", 0)
+        self.tstart = times[0]
+        self.tend = dattab.getcell("TIME", self.nrow - 1)
+
+    def check_regular(self):
+        """
+        make sure the main table can be reshaped to (nt, nbl), raise ValueError otherwise
+        """
+        if not self.regular:
+            raise ValueError(f"{self.nrow} rows can not be reshaped to integrations of {self.nbl} baselines...")
 
-    @property
-    def foff(self):
-        return self.hdul[0].header["CDELT4"]
+    def __repr__(self):
+        return (
+            f"MeasurementSetSummary(nant={self.nant}, nbl={self.nbl}, nt={self.nt}, nchan={self.nchan}, "
+            f"npol={self.npol}, tsamp={self.tsamp}, foff={self.foff})"
+        )
 
 
 class SimpleMeasurementSet():
@@ -179,12 +265,13 @@ class SimpleMeasurementSet():
     def __init__(self, vistab):
         # do some cleaning...
         if vistab.endswith("/"): vistab = vistab[:-1]
+        self.vistab = vistab
 
         self.dattab = self._load_data(vistab) 
         self.freqtab = self._load_freq(vistab)
 
         ### as we may need to change polarisation, don't use property to do that...
-        self.npol = self.dattab.getcell("DATA", 0).shape[-1]
+        self.npol = self.summary.npol
 
 
     def _load_data(self, vistab):
@@ -193,31 +280,38 @@ class SimpleMeasurementSet():
     def _load_freq(self, vistab):
         return tables.table("{}::SPECTRAL_WINDOW".format(vistab))
 
+    @cached_property
+    def summary(self):
+        """
+        metadata of the measurement set, computed once
+        """
+        return MeasurementSetSummary(self.dattab, self.vistab)
+
     @property
     def tsamp(self):
-        return self.dattab.getcell("EXPOSURE", 0)
+        return self.summary.tsamp
 
     @property
     def foff(self):
-        return self.freqtab.getcell("CHAN_WIDTH", 0)[0]
+        return self.summary.foff
 
     @property
     def freqs(self):
         """
         list of frequencies...
         """
-        return self.freqtab.getcol("CHAN_FREQ")[0]
+        return self.summary.freqs
 
     @property
     def nant(self):
         """
         get the number of antennas
         """
-        return np.unique(self.dattab.getcol("ANTENNA1")).shape[0]
+        return self.summary.nant
 
     @property
     def nbl(self):
-        return self.nant * (self.nant + 1) // 2
+        return self.summary.nbl
 
     # @property
     # def npol(self):
@@ -225,14 +319,88 @@ class SimpleMeasurementSet():
 
     @property
     def nchan(self):
-        return self.dattab.getcell("DATA", 0).shape[0]
+        return self.summary.nchan
 
     @property
     def nt(self):
-        return np.unique(self.dattab.getcol("TIME")).shape[0]
+        return self.summary.nt
+
+    @property
+    def phase_dir(self):
+        """
+        phase centre (ra, dec) in degree, same as `SimpleUvFits.phase_dir`
+        """
+        fieldtab = tables.table("{}::FIELD".format(self.vistab), ack=False)
+        ra, dec = np.rad2deg(fieldtab.getcell("PHASE_DIR", 0)[0])
+        fieldtab.close()
+        return ra % 360., dec
+
+    @property
+    def source(self):
+        fieldtab = tables.table("{}::FIELD".format(self.vistab), ack=False)
+        name = fieldtab.getcell("NAME", 0)
+        fieldtab.close()
+        return name
+
+    @property
+    def antennas(self):
+        """
+        antenna information from the ANTENNA subtable, same as `SimpleUvFits.antennas`
+
+        Returns
+        ----------
+        names: list of str
+        positions: numpy.ndarray, (nant, 3), ITRF positions in metre
+        mounts: numpy.ndarray, (nant, ), AIPS mount type
+        """
+        aipsmounts = {mount: aips for aips, mount in MOUNT_TYPES.items()}
+        anttab = tables.table("{}::ANTENNA".format(self.vistab), ack=False)
+        names = list(anttab.getcol("NAME"))
+        positions = anttab.getcol("POSITION")
+        mounts = np.array([aipsmounts.get(mount.lower(), 0) for mount in anttab.getcol("MOUNT")])
+        anttab.close()
+        return names, positions, mounts
+
+    def iter_blocks(self, blocksize=65536, column="DATA"):
+        """
+        iterate over the main table in blocks of `blocksize` rows, in the same format as `SimpleUvFits.iter_blocks`,
+        i.e., the measurement set can be averaged with `stream_average.VisAverager`.
+        The weight is WEIGHT_SPECTRUM if it is filled, WEIGHT otherwise, flag is FLAG (or FLAG_ROW)
+        """
+        colnames = self.dattab.colnames()
+        spectrum = "WEIGHT_SPECTRUM" in colnames and self.dattab.iscelldefined("WEIGHT_SPECTRUM", 0)
+        nrow = self.dattab.nrows()
+        for startrow in range(0, nrow, blocksize):
+            nblock = min(blocksize, nrow - startrow)
+            getcol = lambda name: self.dattab.getcol(name, startrow, nblock)
+
+            ant1, ant2 = getcol("ANTENNA1"), getcol("ANTENNA2")
+            uvw, vis = getcol("UVW"), getcol(column).astype(np.complex64)
+            if spectrum:
+                weight = getcol("WEIGHT_SPECTRUM").astype(np.float32)
+            else:
+                weight = np.broadcast_to(getcol("WEIGHT")[:, None, :], vis.shape).astype(np.float32)
+            flag = getcol("FLAG") | getcol("FLAG_ROW")[:, None, None]
+
+            ### make sure ant1 <= ant2
+            swap = ant1 > ant2
+            if swap.any():
+                ant1[swap], ant2[swap] = ant2[swap], ant1[swap].copy()
+                uvw[swap] *= -1
+                vis[swap] = np.conj(vis[swap])
+                if vis.shape[-1] == 4:
+                    vis, weight, flag = [
+                        np.where(swap[:, None, None], arr[..., SWAPPED_POLS], arr) for arr in (vis, weight, flag)
+                    ]
+
+            yield dict(
+                time=getcol("TIME"), ant1=ant1, ant2=ant2, uvw=uvw,
+                vis=vis, weight=weight, flag=flag, inttim=getcol("EXPOSURE"),
+            )
 
     ### load data... this can be super slow...
     def load_vis(self):
+        self.summary.check_regular()
         self.vis = self.dattab.getcol("DATA").reshape(
             self.nt, self.nbl, self.nchan, self.npol
         )
@@ -244,60 +412,98 @@ class SimpleMeasurementSet():
 
         self.blant = self._load_bl_ant()
 
+    def iter_vis(self, ntblock=10, cal=None, column="DATA"):
+        """
+        iterate over the visibilities in blocks of `ntblock` integrations,
+        only one block is loaded at a time, so that long scans can be processed in constant memory
+
+        Params
+        ----------
+        ntblock: int, 10 by default
+            number of integrations in each block
+        cal: str, optional
+            calibration solution (.bin or .smooth.npy) applied to each block if provided
+        column: str, "DATA" by default
+            column to load the visibilities from
+
+        Returns
+        ----------
+        generator of (it, vis)
+            it - index of the first integration in the block,
+            vis - (ntblock, nbl, nchan, npol), the last block can be shorter, only XX and YY (npol=2) for 4pol data
+        """
+        ### self.npol is not changed here, so that `load_vis` still works on the same object afterwards
+        self.summary.check_regular()
+        nt, nbl, nchan = self.nt, self.nbl, self.nchan
+        inpol = self.dattab.getcell(column, 0).shape[-1]
+
+        self.blant = self._load_bl_ant()
+        solarr = None if cal is None else self._load_gain(cal)
+
+        for it in range(0, nt, ntblock):
+            ntchunk = min(ntblock, nt - it)
+            vis = self.dattab.getcol(column, startrow=it * nbl, nrow=ntchunk * nbl).reshape(
+                ntchunk, nbl, nchan, inpol
+            )
+            if inpol == 4:
+                vis = vis[..., (0, 3)]
+            if solarr is not None:
+                vis *= solarr[None, ...]
+            yield it, vis
+
     def _load_bl_ant(self):
         """
-        load antenna pairs as a numpy array, antennas are zero-based
+        load antenna pairs (from ANTENNA1 and ANTENNA2 of the first integration) as a numpy array, antennas are zero-based
         """
-        return np.array([
-            (i, j) for i in range(self.nant) for j in range(i, self.nant)
-        ])
+        return np.stack([self.summary.ant1, self.summary.ant2], axis=-1)
 
     def _load_gain(self, cal):
         """
         simple gain loader, as we will apply it to the original dataset,
         we don't consider frequency here
+
+        Returns
+        ----------
+        solarr: numpy.ndarray, (nbl, nchan, npol)
+            inverse of the baseline gains, i.e., calibrated = vis * solarr
         """
         if cal.endswith(".bin"): # bin file
-            g = plotbp.Bandpass.load(cal).copy()[0]
+            g = binsol.load_gains(cal, isol=0)
         elif cal.endswith(".smooth.npy"): # smoothed solution
             g = np.load(cal)[0]
+        else:
+            raise ValueError(f"not supported file type... {cal}")
 
         nant, nchan, npol = g.shape
-        assert self.nant <= nant, "not enough antenna in the solution table..."
+        blant = self._load_bl_ant()
+        assert blant.max() < nant, "not enough antenna in the solution table..."
         assert self.nchan == nchan, "not equal number of channels in the solution table..."
         if npol == 4: g = g[..., (0, 3)]; npol = 2
         if npol == 2 and self.npol == 1:
             g = g.mean(axis=-1, keepdims=True)
-        g = g[:self.nant, ...]
 
         ### load it to baseline based
-        nant, nchan, npol = g.shape # reload npol...
-        solarr = np.zeros(
-            (self.nbl, self.nchan, self.npol),
-            dtype=complex,
-        )
-        for ibl, antpair in enumerate(self.blant):
-            ia1, ia2 = antpair
-            s1 = g[ia1, ...]
-            s2 = g[ia2, ...]
-            p = s1 * np.conj(s2)
-            solarr[ibl, ...] = p[:]
-
-        return 1./solarr
-
-    def apply_cal(self, cal):
-        solarr = self._load_gain(cal) # load solution table - (nbl, nchan, npol)
-        ### npol can be 1, 2
-        self.calvis = self.vis * solarr[None, ...]
+        return 1. / (g[blant[:, 0]] * np.conj(g[blant[:, 1]]))
 
-
-
-    
-
-
-
-
-    def apply_cal(self, cal):
+    def apply_cal(self, cal, inplace=False, ntblock=10):
+        """
+        apply calibration to the loaded visibilities, use `iter_vis(cal=cal)` for long scans
+
+        Params
+        ----------
+        inplace: bool, False by default
+            if True, calibrate `self.vis` directly (`self.calvis` is the same array),
+            `ntblock` integrations at a time, so that no extra copy of the visibilities is made
+        ntblock: int, 10 by default
+            number of integrations to calibrate at once if `inplace`
+        """
         solarr = self._load_gain(cal) # load solution table - (nbl, nchan, npol)
         ### npol can be 1, 2
-        self.calvis = self.vis * solarr[None, ...]
\ No newline at end of file
+        if not inplace:
+            self.calvis = self.vis * solarr[None, ...]
+            return
+
+        solarr = solarr.astype(self.vis.dtype)
+        for it in range(0, self.vis.shape[0], ntblock):
+            self.vis[it:it + ntblock] *= solarr[None, ...]
+        self.calvis = self.vis
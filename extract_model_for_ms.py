@@ -6,6 +6,8 @@ from astropy.table import Table
 from casacore.tables import *
 import argparse
 
+from catalog_index import cached_index, angular_separation
+
 
 class GaussianPB:
     
@@ -97,7 +99,115 @@ def flux_nu(S1, alpha, nu1, nu2):
     return S0 * np.power(nu2, alpha)
 
 
-def process(ms_name, pb_radii, flux_cutoff, spectral_index = -0.83, catalog_file="./racs-low.fits", freq_cat = 887.5e6):
+def sexagesimal(values, sep=":", plus=False, precision=8, wrap=None):
+    """
+    format angles (in hour or degree) as [+-]dd:mm:ss.ssssssss strings for an array of values
+
+    Params
+    ----------
+    plus: bool, False by default
+        write "+" for positive values, i.e., for declination
+    wrap: float, optional
+        wrap the value at `wrap`, e.g., 24 for right ascension in hour
+    """
+    values = np.asarray(values, dtype=float)
+    scale = 10 ** precision
+    ### round in the unit of the last digit to avoid 60 seconds
+    total = np.round(np.abs(values) * 3600. * scale).astype(np.int64)
+    if wrap is not None: total %= int(wrap * 3600 * scale)
+    degs, rem = np.divmod(total, 3600 * scale)
+    mins, secs = np.divmod(rem, 60 * scale)
+    secint, secfrac = np.divmod(secs, scale)
+    signs = np.where(values < 0, "-", "+" if plus else "")
+
+    fmt = f"%s%02d{sep}%02d{sep}%02d.%0{precision}d"
+    return [
+        fmt %(sign, deg, minute, sec, frac)
+        for sign, deg, minute, sec, frac in zip(signs, degs.tolist(), mins.tolist(), secint.tolist(), secfrac.tolist())
+    ]
+
+def make_model(sources, separations, freqs, flux_cutoff, spectral_index=-0.83, freq_cat=887.5e6, pb=None):
+    """
+    work out the apparent flux and spectral index of all `sources` in one go, sources fainter than `flux_cutoff` are removed
+
+    Params
+    ----------
+    sources: dict
+        catalogue columns of the sources, see `catalog_index.CatalogIndex.query`
+    separations: numpy.ndarray
+        separation between the sources and the beam centre in radian
+    freqs: numpy.ndarray
+        channel frequencies of the measurement set in Hz
+    pb: GaussianPB, optional
+        primary beam model, a 12m gaussian beam at the central frequency by default
+
+    Returns
+    ----------
+    model: dict
+        index (position in `sources`), RA, Dec, DC_Maj, DC_Min, DC_PA, S_ref, alpha of the selected sources,
+        and freqcent (reference frequency) and total_flux
+    """
+    freqcent = np.mean(freqs)
+    f0 = freqs[0]
+    fN = freqs[-1]
+    if pb is None: pb = GaussianPB(frequency = freqcent)
+
+    S_cat = np.asarray(sources["Total_flux_Gaussian"], dtype=float) / 1000.0
+    Sref = S_cat / np.power(freq_cat, spectral_index)
+    S0 = Sref * np.power(f0, spectral_index)
+    S0_pb = S0 * pb.evaluate(separations, freq=f0)
+    SN = Sref * np.power(fN, spectral_index)
+    SN_pb = SN * pb.evaluate(separations, freq=fN)
+
+    index = np.flatnonzero(S0_pb >= flux_cutoff)
+    S0, S0_pb, SN, SN_pb, S_cat = S0[index], S0_pb[index], SN[index], SN_pb[index], S_cat[index]
+    alpha = np.log(S0_pb / SN_pb) / np.log(f0 / fN)
+    S_ref = flux_nu(S0_pb, alpha, f0, freqcent)
+
+    sname = np.asarray(sources["Gaussian_ID"])[index]
+    seps = np.degrees(np.asarray(separations)[index])
+    print("".join([
+        "%4d %s s_cat=%.4f S0=%.4f %.4f SN=%.4f %.4f sep=%0.2f deg Sref=%.4f alpha=%.3f\n" %row
+        for row in zip(
+            index.tolist(), sname.tolist(), S_cat.tolist(), S0.tolist(), S0_pb.tolist(),
+            SN.tolist(), SN_pb.tolist(), seps.tolist(), S_ref.tolist(), alpha.tolist(),
+        )
+    ]), end="")
+
+    model = {column: np.asarray(sources[column])[index] for column in ("RA", "Dec", "DC_Maj", "DC_Min", "DC_PA")}
+    model.update(
+        index=index, S_ref=S_ref, alpha=alpha, freqcent=freqcent,
+        total_flux=((S0_pb + SN_pb) / 2.0).sum(),
+    )
+    return model
+
+def write_model(model_name, model):
+    """
+    write the sky model from `make_model` to `model_name` in a single write
+    """
+    ra_str = sexagesimal(model["RA"] / 15., wrap=24)
+    dec_str = sexagesimal(model["Dec"], sep=".", plus=True)
+    # If source is a gaussian put in type gaussian:
+    is_point = (model["DC_Maj"] < 1.0) & (model["DC_Min"] < 1.0)
+
+    lines = ["Format = Name, Type, Ra, Dec, I, SpectralIndex, LogarithmicSI, ReferenceFrequency='888500000.0', MajorAxis, MinorAxis, Orientation\n"]
+    for index, point, ra, dec, S_ref, alpha, dMaj, dMin, dPA in zip(
+        model["index"].tolist(), is_point.tolist(), ra_str, dec_str, model["S_ref"].tolist(), model["alpha"].tolist(),
+        model["DC_Maj"].tolist(), model["DC_Min"].tolist(), model["DC_PA"].tolist(),
+    ):
+        if point:
+            lines.append('s%05d,POINT,%s,%s,%f,[%f,0.0],true,%f,,,\n' %(index, ra, dec, S_ref, alpha, model["freqcent"]))
+        else:
+            lines.append('s%05d,GAUSSIAN,%s,%s,%f,[%f,0.0],true,%f,%f,%f,%f\n' %(index, ra, dec, S_ref, alpha, model["freqcent"], dMaj, dMin, dPA))
+
+    with open(model_name, "wt") as fout:
+        fout.write("".join(lines))
+
+def process(ms_name, pb_radii, flux_cutoff, spectral_index = -0.83, catalog_file="./racs-low.fits", freq_cat = 887.5e6, catalog_index=None):
+    """
+    write the sky model for `ms_name`, the catalogue is queried with a spatial index,
+    which is built next to `catalog_file` at the first run if `catalog_index` is not provided (see `catalog_index.py`)
+    """
 
     model_name = ms_name.replace(".ms", ".model")
     model_reg_name = ms_name.replace(".ms", ".model.reg")
@@ -121,81 +231,105 @@ def process(ms_name, pb_radii, flux_cutoff, spectral_index = -0.83, catalog_file
     radial_cutoff = pb_radii * np.degrees(pb.getFWHM()) # Go out just over 2 times the half-power point.
     print("Radial cutoff = %.3f degrees" %(radial_cutoff))
         
-    print("Reading RACS catalogue")
-    gsm_cat = Table.read(catalog_file)
+    print("Querying RACS catalogue")
+    if catalog_index is None:
+        catalog_index = cached_index(catalog_file)
+    cone = catalog_index.query(ra_point, dec_point, radial_cutoff)
     
-    n_sources = len(gsm_cat)
+    print("Found %d sources in the field" %(len(cone["ROW"])))
     
-    print("Generating source coordinates")
-    source_directions = SkyCoord(Angle(gsm_cat["RA"], unit=au.deg), Angle(gsm_cat["Dec"], unit=au.deg))
-    
-    within_field = np.where(direction.separation(source_directions).degree < radial_cutoff)
-    field_sources = source_directions[within_field]
-    print("Found %d sources in the field" %(len(field_sources)))
-    
-    source_separations = field_sources.separation(direction).radian
-    #print(gsm_cat[within_field])
-    sname = gsm_cat["Gaussian_ID"][within_field]
-    St = gsm_cat["Total_flux_Gaussian"][within_field]
-    dMaj = gsm_cat["DC_Maj"][within_field]
-    dMin = gsm_cat["DC_Min"][within_field]
-    dPA = gsm_cat["DC_PA"][within_field]
-    
-    fout = open(model_name, "wt")
-    fout.write("Format = Name, Type, Ra, Dec, I, SpectralIndex, LogarithmicSI, ReferenceFrequency='888500000.0', MajorAxis, MinorAxis, Orientation\n")
-    total_model_flux = 0.0
-    sub_field_sources = []
-    sub_dMaj = []
-    sub_dMin = []
-    sub_dPA = []
-    for index in range(len(field_sources)):
-        source_direction = field_sources[index]
-        dir_str = source_direction.to_string(style='hmsdms',sep=':')
-        ra_dec = dir_str.split()
-        dec_str = ra_dec[1].replace(':', ".")
-        S_cat=float(St[index])/1000.0
-        Sref = S_cat / np.power(freq_cat, spectral_index)
-        S0 = Sref * np.power(f0, spectral_index)
-        S0_pb = S0 * pb.evaluate(source_separations[index], freq=f0)
-        if S0_pb < flux_cutoff:
-            continue
-        SN = Sref * np.power(fN, spectral_index)
-        SN_pb = SN * pb.evaluate(source_separations[index], freq=fN)
-        alpha = np.log(S0_pb / SN_pb) / np.log(f0 / fN)
-        S_ref = flux_nu(S0_pb, alpha, f0, freqcent)
-        print("%4d %s s_cat=%.4f S0=%.4f %.4f SN=%.4f %.4f sep=%0.2f deg Sref=%.4f alpha=%.3f" %(index,sname[index],S_cat,S0,S0_pb,SN,SN_pb, np.degrees(source_separations[index]), S_ref, alpha))
-    #    alpha=-0.83
-        # If source is a gaussian put in type gaussian:
-        if dMaj[index] < 1.0 and dMin[index] < 1.0:
-            fout.write('s%05d,POINT,%s,%s,%f,[%f,0.0],true,%f,,,\n' %(index, ra_dec[0], dec_str, S_ref, alpha, freqcent))
-        else:
-            fout.write('s%05d,GAUSSIAN,%s,%s,%f,[%f,0.0],true,%f,%f,%f,%f\n' %(index, ra_dec[0], dec_str, S_ref, alpha, freqcent, dMaj[index], dMin[index], dPA[index]))
-        sub_field_sources.append(field_sources[index])
-        sub_dMaj.append(dMaj[index])
-        sub_dMin.append(dMin[index])
-        sub_dPA.append(dPA[index])
-        total_model_flux += (S0_pb + SN_pb) / 2.0
-    
-    fout.close()
-    #make_ds9(model_reg_name, sub_field_sources, sub_dMaj, sub_dMin, sub_dPA)
-    #print("Total modelled flux = %.3f Jy" %(total_model_flux))
+    model = make_model(
+        cone, cone["SEP"], freqs, flux_cutoff,
+        spectral_index=spectral_index, freq_cat=freq_cat, pb=pb,
+    )
+    write_model(model_name, model)
+    #make_ds9(model_reg_name, SkyCoord(model["RA"], model["Dec"], unit=au.deg), model["DC_Maj"], model["DC_Min"], model["DC_PA"])
+    #print("Total modelled flux = %.3f Jy" %(model["total_flux"]))
+
+def beam_from_uvfits(uvfits, freqbin=1):
+    """
+    phase centre and (averaged) channel frequencies of a uvfits file,
+    i.e., the same as those in the 4pol measurement set made from it
+    """
+    # only needed for the footprint mode
+    from craco_vis import SimpleUvFits
+    from stream_average import averaged_channels
+
+    uvf = SimpleUvFits(uvfits)
+    ra, dec = uvf.phase_dir
+    _, freqs, _ = averaged_channels(uvf, freqbin)
+    return SkyCoord(ra, dec, unit=au.deg), freqs
+
+def process_footprint(beams, pb_radii, flux_cutoff, spectral_index = -0.83, catalog_file="./racs-low.fits", freq_cat = 887.5e6, catalog_index=None):
+    """
+    write sky models for all beams of a footprint with a single catalogue query,
+    each beam gets the same model as that from `process` on its own
+
+    Params
+    ----------
+    beams: list of tuple
+        (model_name, direction, freqs) of each beam, direction is a SkyCoord,
+        see `dir_from_ms`/`freqs_from_ms` or `beam_from_uvfits`
+    """
+    if catalog_index is None:
+        catalog_index = cached_index(catalog_file)
+
+    beam_ra = np.radians([direction.ra.deg for _, direction, _ in beams])
+    beam_dec = np.radians([direction.dec.deg for _, direction, _ in beams])
+    pbs = [GaussianPB(frequency = np.mean(freqs)) for _, _, freqs in beams]
+    radial_cutoffs = np.array([pb_radii * np.degrees(pb.getFWHM()) for pb in pbs])
+
+    ### footprint centre from the mean unit vector of all beams
+    xyz = np.array([np.cos(beam_dec) * np.cos(beam_ra), np.cos(beam_dec) * np.sin(beam_ra), np.sin(beam_dec)]).mean(axis=1)
+    ra_centre = np.arctan2(xyz[1], xyz[0]) % (2 * np.pi)
+    dec_centre = np.arctan2(xyz[2], np.hypot(xyz[0], xyz[1]))
+    footprint_radius = (np.degrees(angular_separation(ra_centre, dec_centre, beam_ra, beam_dec)) + radial_cutoffs).max()
+
+    print("Querying RACS catalogue for %d beams within %.3f degrees" %(len(beams), footprint_radius))
+    footprint = catalog_index.query(np.degrees(ra_centre), np.degrees(dec_centre), footprint_radius)
+    print("Found %d sources in the footprint" %(len(footprint["ROW"])))
+    srcra, srcdec = np.radians(footprint["RA"]), np.radians(footprint["Dec"])
+
+    for ibeam, (model_name, direction, freqs) in enumerate(beams):
+        print("Extracting sky model for %s" %(model_name))
+        separations = angular_separation(beam_ra[ibeam], beam_dec[ibeam], srcra, srcdec)
+        within_field = separations < np.radians(radial_cutoffs[ibeam])
+        cone = {column: value[within_field] for column, value in footprint.items()}
+
+        model = make_model(
+            cone, separations[within_field], freqs, flux_cutoff,
+            spectral_index=spectral_index, freq_cat=freq_cat, pb=pbs[ibeam],
+        )
+        write_model(model_name, model)
+
+def process_beams(ms_names, pb_radii, flux_cutoff, spectral_index = -0.83, catalog_file="./racs-low.fits", freq_cat = 887.5e6, catalog_index=None):
+    """
+    footprint version of `process` for a list of measurement sets (i.e., all beams of a scan)
+    """
+    beams = [(ms_name.replace(".ms", ".model"), dir_from_ms(ms_name), freqs_from_ms(ms_name)) for ms_name in ms_names]
+    process_footprint(
+        beams, pb_radii, flux_cutoff, spectral_index=spectral_index,
+        catalog_file=catalog_file, freq_cat=freq_cat, catalog_index=catalog_index,
+    )
 
 def main(args):
     if args.vis is None:
         raise ValueError("Need to provide an input vis ms")
-    else:
-        ms_name = args.vis
     pb_radii = args.pb_radii
     flux_cutoff = args.flux_cutoff
     spectral_index = args.spectral_index
-    process(ms_name, pb_radii, flux_cutoff, spectral_index)
+    if len(args.vis) == 1:
+        process(args.vis[0], pb_radii, flux_cutoff, spectral_index, catalog_file=args.catalog)
+    else: # all beams share one catalogue query
+        process_beams(args.vis, pb_radii, flux_cutoff, spectral_index, catalog_file=args.catalog)
 
 if __name__ == '__main__':
     a = argparse.ArgumentParser()
-    a.add_argument("-vis", type=str, help="Input vis ms")
+    a.add_argument("-vis", type=str, nargs="+", help="Input vis ms, sky models of multiple beams are extracted together")
     a.add_argument("-pb_radii", type=float, help="PB radii (def: 2.0)", default=2.0)
     a.add_argument("-flux_cutoff", type=float, help="Flux cutoff in Jy (def: 0.005)", default = 0.005)
     a.add_argument("-spectral_index", type=float, help="Spectral index (def: -0.83)", default= -0.83)
+    a.add_argument("-catalog", type=str, help="Path to the catalogue (def: ./racs-low.fits)", default="./racs-low.fits")
 
     args = a.parse_args()
     main(args)
@@ -1,31 +1,220 @@
-from casacore.tables import *
+import numpy as np
 import argparse
 
-def process(ms, flag_extremes = True):
-    
+### statistical (RFI) flagging modes, see `flag_rfi`
+RFI_MODES = ["none", "mad", "sumthreshold"]
+### scale factor from the median absolute deviation to the standard deviation of a gaussian
+MAD_TO_STD = 1.4826
+
+def _nanmedian(x, axis=-1):
+    """
+    median along `axis` ignoring NaNs, vectorised with one sort (`np.nanmedian` loops over the other axes),
+    NaN is returned if all values are NaN
+    """
+    x = np.sort(x, axis=axis) # NaNs are sorted to the end
+    nvalid = (~np.isnan(x)).sum(axis=axis, keepdims=True)
+    lo = np.take_along_axis(x, np.maximum(nvalid - 1, 0) // 2, axis=axis)
+    hi = np.take_along_axis(x, nvalid // 2, axis=axis)
+    return np.squeeze((lo + hi) / 2., axis=axis)
+
+def _running_median(x, width, axis=-1):
+    """
+    running median of `x` along `axis` with a window of `width` samples (NaNs ignored, edges padded with NaNs)
+    """
+    x = np.moveaxis(x, axis, -1)
+    pad = [(0, 0)] * (x.ndim - 1) + [(width // 2, width - 1 - width // 2)]
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(x, pad, constant_values=np.nan), width, axis=-1)
+    return np.moveaxis(_nanmedian(windows, axis=-1), -1, axis)
+
+def normalised_deviation(vis, mask, bpwidth=9):
+    """
+    relative deviation of visibility amplitudes from a smooth bandpass
+
+    Params
+    ----------
+    vis: numpy.ndarray, (nt, nbl, nchan, npol)
+        complex visibilities, XX and the last polarisation (i.e., YY) are used
+    mask: numpy.ndarray, (nt, nbl, nchan)
+        data already flagged
+    bpwidth: int, 9 by default
+        number of channels of the running median used to smooth the time-median spectrum of each baseline,
+        narrow band RFI does not leak into the bandpass estimate
+
+    Returns
+    ----------
+    dev: numpy.ndarray, (nt, nbl, nchan, 2)
+        |vis| / bandpass - 1, NaN for flagged data
+    """
+    npol = vis.shape[-1]
+    amp = np.abs(vis[..., [0, npol - 1]]).astype(float)
+    amp[mask[..., None] | (amp == 0.)] = np.nan
+    spec = _nanmedian(amp, axis=0) # (nbl, nchan, 2)
+    bandpass = _running_median(spec, bpwidth, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return amp / bandpass - 1.
+
+def mad_flag(dev, threshold=5.0, niter=5):
+    """
+    iterative MAD clipping on the time-frequency plane of every baseline and polarisation at once
+
+    Params
+    ----------
+    dev: numpy.ndarray, (nt, nbl, nchan, npol)
+        deviation from the expected value, NaN for flagged data
+    threshold: float, 5.0 by default
+        values more than `threshold` robust standard deviations away from the median are flagged
+    niter: int, 5 by default
+        maximum number of iterations, it stops earlier if no new data is flagged
+
+    Returns
+    ----------
+    mask: numpy.ndarray of bool, same shape as `dev`
+        flagged data, including NaNs in `dev`
+    z: numpy.ndarray, same shape as `dev`
+        deviation in the unit of the robust standard deviation (from the last iteration)
+    """
+    mask = np.isnan(dev)
+    clipped = dev.copy()
+    for i in range(niter):
+        ### statistics over time and frequency, i.e., axes (0, 2)
+        plane = clipped.transpose(1, 3, 0, 2).reshape(dev.shape[1], dev.shape[3], -1)
+        median = _nanmedian(plane, axis=-1)
+        sigma = MAD_TO_STD * _nanmedian(np.abs(plane - median[..., None]), axis=-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = (dev - median[None, :, None, :]) / sigma[None, :, None, :]
+        new = (np.abs(z) > threshold) & ~mask
+        if not new.any(): break
+        mask |= new
+        clipped[new] = np.nan
+    return mask, z
+
+def sumthreshold(z, mask, threshold=5.0, maxwidth=16, rho=1.5, axis=0):
+    """
+    SumThreshold (Offringa et al. 2010) along `axis` of `z`, all other axes are processed at once.
+    Windows of 1, 2, 4, ... `maxwidth` samples are flagged if the mean of their unflagged samples
+    exceeds `threshold` / `rho` ** log2(width)
+
+    Params
+    ----------
+    z: numpy.ndarray
+        deviation in the unit of the standard deviation, see `mad_flag`
+    mask: numpy.ndarray of bool
+        data already flagged, updated in place
+
+    Returns
+    ----------
+    mask: numpy.ndarray of bool
+    """
+    ### work on the last axis, `masklast` is a view so that `mask` is updated
+    zlast = np.moveaxis(z, axis, -1).astype(np.float32)
+    masklast = np.moveaxis(mask, axis, -1)
+    n = zlast.shape[-1]
+    csum = np.zeros(zlast.shape[:-1] + (n + 1, ), dtype=np.float32)
+    ccount = np.zeros(zlast.shape[:-1] + (n + 1, ), dtype=np.int32)
+
+    width = 1
+    while width <= min(maxwidth, n):
+        chi = threshold / rho ** np.log2(width)
+        np.cumsum(np.where(masklast, 0., zlast), axis=-1, out=csum[..., 1:])
+        np.cumsum(~masklast, axis=-1, out=ccount[..., 1:])
+        wsum = csum[..., width:] - csum[..., :-width]
+        wcount = ccount[..., width:] - ccount[..., :-width]
+        hit = (wcount > 0) & (wsum > chi * wcount)
+        ### flag every sample covered by a window, by dilating window starts to `width` samples
+        covered = np.zeros(masklast.shape, dtype=bool)
+        covered[..., :n - width + 1] = hit
+        shift = 1
+        while shift < width:
+            covered[..., shift:] |= covered[..., :-shift].copy()
+            shift *= 2
+        masklast |= covered
+        width *= 2
+    return mask
+
+def flag_rfi(vis, fdata, mode="mad", threshold=5.0):
+    """
+    flag RFI in a time chunk of cross correlations, `fdata` is updated in place,
+    all polarisations are flagged if any of XX/YY is flagged
+
+    Params
+    ----------
+    vis: numpy.ndarray, (nt, nbl, nchan, npol)
+    fdata: numpy.ndarray of bool, (nt, nbl, nchan, npol)
+    mode: str, "mad" by default
+        "mad" - iterative MAD clipping, "sumthreshold" - SumThreshold along frequency and time
+        with the MAD clipped statistics
+    threshold: float, 5.0 by default
+        threshold in the unit of the robust standard deviation
+    """
+    if mode not in RFI_MODES:
+        raise ValueError(f"unknown rfi flagging mode {mode}... should be one of {RFI_MODES}")
+    if mode == "none": return fdata
+
+    dev = normalised_deviation(vis, fdata.all(axis=-1))
+    mask, z = mad_flag(dev, threshold=threshold)
+    if mode == "sumthreshold":
+        ### MAD clipping is only used to get the statistics here
+        mask = np.isnan(z)
+        sumthreshold(z, mask, threshold=threshold, axis=2) # frequency
+        sumthreshold(z, mask, threshold=threshold, axis=0) # time
+    fdata |= mask.any(axis=-1)[..., None]
+    return fdata
+
+def flag_chunk(uvw, ant1, ant2, cdata, fdata, flag_extremes=True, xythresh=8.0):
+    """
+    flag a chunk of rows in place (`fdata` is updated)
+    - autos (uv distance < 1 m), all channels and polarisations
+    - NaNs in non-autos
+    - extremes in non-autos if `flag_extremes`, i.e., |XX-YY| > `xythresh`, XX == 0 or YY == 0,
+      all polarisations of the channel are flagged
+    """
+    npol = cdata.shape[-1]
+    auto = (uvw[:, 0] ** 2 + uvw[:, 1] ** 2) < 1.0
+    cross = (ant1 != ant2)[:, None, None]
+
+    bad = np.isnan(cdata)
+    if flag_extremes:
+        xx, yy = cdata[..., 0], cdata[..., npol - 1]
+        badchan = (np.abs(xx - yy) > xythresh) | (xx == 0.0) | (yy == 0.0)
+        bad |= badchan[..., None]
+    bad &= cross
+    bad |= auto[:, None, None]
+    fdata |= bad
+    return fdata
+
+def process(ms, flag_extremes = True, chunksize=10000, column="CORRECTED_DATA", rfi="none", threshold=5.0):
+    """
+    flag `ms` in a single pass over the main table, `chunksize` rows at a time,
+    see `flag_chunk` for the flagging criteria
+
+    Params
+    ----------
+    rfi: str, "none" by default
+        statistical flagging mode, see `flag_rfi`, statistics are computed over the time-frequency plane of each chunk,
+        chunks are rounded to whole integrations (the measurement set should be time ordered)
+    threshold: float, 5.0 by default
+        threshold of the statistical flagging
+    """
+    from casacore.tables import table # only needed for measurement sets, RFI_MODES etc. are imported by command lines
     t = table(ms, readonly=False)
     
-    tf = table("%s/SPECTRAL_WINDOW" %(ms))
-    ta = table("%s/ANTENNA" %(ms))
+    ta = table("%s/ANTENNA" %(ms), ack=False)
     nant = len(ta)
+    ta.close()
     nbl = int((nant / 2) * (nant - 1))
-    
-    print("Flagging autos")
-    t1 = taql("select from $t where sumsqr(UVW[:2])<1.0")
-    fdata = t1.getcol("FLAG")
-    fdata[:,:,:] = True
-    t1.putcol("FLAG", fdata)
-    t1.close()
-    
-    # Select only non-autos
-    t1 = taql("select from $t where ANTENNA1 != ANTENNA2")
-    
-    cdata = t1.getcol("CORRECTED_DATA")
-    fdata = t1.getcol("FLAG")
-    
-    nvis = fdata.shape[0]
-    nchan = fdata.shape[1]
-    npol = fdata.shape[2]
+
+    nrow = t.nrows()
+    cell = t.getcell(column, 0)
+    nchan, npol = cell.shape
+    ### antennas are read per chunk below, the baselines of the first integration are enough for the counts,
+    ### rows of an integration share the same TIME
+    times = t.getcol("TIME", 0, min(nrow, nant * (nant + 1) // 2 + 1))
+    nrowint = int((times == times[0]).sum())
+    cross = np.where(t.getcol("ANTENNA1", 0, nrowint) != t.getcol("ANTENNA2", 0, nrowint))[0]
+    nrem = nrow % nrowint
+    nvis = (nrow // nrowint) * cross.shape[0]
+    if nrem > 0:
+        nvis += int((t.getcol("ANTENNA1", nrow - nrem, nrem) != t.getcol("ANTENNA2", nrow - nrem, nrem)).sum())
     nint = int(nvis / nbl)
     
     print("Antennas: %d" %(nant))
@@ -34,30 +223,45 @@ def process(ms, flag_extremes = True):
     print("Integrations: %d" %(nint))
     print("Channels: %d" %(nchan))
     print("Polarisations: %d\n" %(npol))
-    
-    print("Flagging NaNs")
-    # Flag any NaNs
-    bad = np.where(np.isnan(cdata))
-    fdata[bad] = True
-    
-    #print("Flagging extremes")
-    
-    if flag_extremes:
-        dxy = np.abs(cdata[:,:,0]-cdata[:,:,npol-1])
-        bad_xy = np.where(dxy > 8.0)
-        for pol in range(npol):
-            fdata[:,:,pol][bad_xy] = True
-        dxy = np.abs(cdata[:,:,0]-cdata[:,:,npol-1])
-        bad_xx = np.where(cdata[:,:,0] == 0.0)
-        for pol in range(npol):
-            fdata[:,:,pol][bad_xx] = True
-        bad_yy = np.where(cdata[:,:,0] == 0.0)
-        for pol in range(npol):
-            fdata[:,:,pol][bad_yy] = True
-    
-    t1.putcol("FLAG", fdata)
-    t1.close()
-    
+
+    print("Flagging autos, NaNs%s" %(" and extremes" if flag_extremes else ""))
+    if rfi != "none":
+        print("Flagging RFI with %s (threshold %.1f)" %(rfi, threshold))
+    ### chunks of whole integrations, only the last one can end with a partial integration
+    chunksize = max(1, min(chunksize, nrow) // nrowint) * nrowint
+    ### preallocate buffers for one chunk, reused for all chunks
+    uvwbuf = np.empty((chunksize, 3), dtype=float)
+    cbuf = np.empty((chunksize, nchan, npol), dtype=cell.dtype)
+    fbuf = np.empty((chunksize, nchan, npol), dtype=bool)
+    nflagged = 0
+    for startrow in range(0, nrow, chunksize):
+        nchunk = min(chunksize, nrow - startrow)
+        uvw, cdata, fdata = uvwbuf[:nchunk], cbuf[:nchunk], fbuf[:nchunk]
+        t.getcolnp("UVW", uvw, startrow, nchunk)
+        t.getcolnp(column, cdata, startrow, nchunk)
+        t.getcolnp("FLAG", fdata, startrow, nchunk)
+        ant1 = t.getcol("ANTENNA1", startrow, nchunk)
+        ant2 = t.getcol("ANTENNA2", startrow, nchunk)
+        flag_chunk(uvw, ant1, ant2, cdata, fdata, flag_extremes=flag_extremes)
+        nwhole = nchunk // nrowint * nrowint
+        if rfi != "none" and nwhole > 0:
+            ### (nt, nbl, nchan, npol) view of cross correlations, all baselines at once
+            shape = (nwhole // nrowint, nrowint, nchan, npol)
+            fwhole = fdata[:nwhole].reshape(shape)
+            fcross = fwhole[:, cross]
+            flag_rfi(cdata[:nwhole].reshape(shape)[:, cross], fcross, mode=rfi, threshold=threshold)
+            fwhole[:, cross] = fcross
+        if rfi != "none" and nwhole < nchunk:
+            ### partial integration at the end of the measurement set, flagged as a block of its own
+            print("Flagging RFI in the last %d rows (partial integration) separately" %(nchunk - nwhole))
+            rcross = nwhole + np.where(ant1[nwhole:] != ant2[nwhole:])[0]
+            fcross = fdata[rcross][None]
+            flag_rfi(cdata[rcross][None], fcross, mode=rfi, threshold=threshold)
+            fdata[rcross] = fcross[0]
+        t.putcol("FLAG", fdata, startrow, nchunk)
+        nflagged += fdata.sum()
+
+    print("Flagged: %.2f%%" %(nflagged / (nrow * nchan * npol) * 100))
     t.close()
 
 def main(args):
@@ -72,12 +276,16 @@ def main(args):
         flag_extremes = False
     else:
         raise ValueError("Unexpected value for -flag_extremes flag: {0}".format(args.flag_extremes))
-    process(ms, flag_extremes)
+    process(ms, flag_extremes, chunksize=args.chunksize, column=args.column, rfi=args.rfi, threshold=args.threshold)
 
 if __name__ == '__main__':
     a = argparse.ArgumentParser()
     a.add_argument("-vis", type=str, help="Input vis ms to flag")
     a.add_argument("-flag_extremes", type=str, help="Flag Extremes? (y/n) (def: y)", default="y")
+    a.add_argument("-chunksize", type=int, help="number of rows to flag at once (def: 10000)", default=10000)
+    a.add_argument("-column", type=str, help="data column to flag on (def: CORRECTED_DATA)", default="CORRECTED_DATA")
+    a.add_argument("-rfi", type=str, help="statistical RFI flagging mode (def: none)", default="none", choices=RFI_MODES)
+    a.add_argument("-threshold", type=float, help="threshold of the RFI flagging in robust sigma (def: 5.0)", default=5.0)
 
     args = a.parse_args()
     main(args)
@@ -1,38 +1,30 @@
 #!/usr/bin/env python
 
-import argparse, os
+import argparse, os, shutil
 import numpy as np
 import numpy as np
 
-from casatasks import importuvfits
-from average_the_ms import process as average
-from convert import process as convert
-from extract_model_for_ms import process as extract
-from flag import process as flag
-from craco_vis import SimpleMeasurementSet
-from smooth_cal import CracoBandPass
+### modules for each stage (casatasks, astropy, matplotlib...) are imported in the stage itself,
+### so that the command line starts quickly and skipped stages do not pay for their imports
+from manifest import Stage, StageManifest
+from instrument import StageRecorder
 
 ### craco related
-from craco import plotbp
+import binsol
 from craft.cmdline import strrange
+from flag import RFI_MODES
 
 def _load_binsol(binfile):
     """
     load bin calibration solution from `binfile`
     """
-    bp = plotbp.Bandpass.load(binfile)
-    return bp.bandpass.copy()
-
-from craco_vis import SimpleMeasurementSet
+    return binsol.load_gains(binfile)
 
 def main(args):
     if args.vis_ms:
         inp_vis = args.vis_ms
     elif args.vis_uvfits:
         inp_vis = args.vis_uvfits.strip("uvfits") + "ms"
-        if not os.path.exists(inp_vis):
-            print("------> Convering UV Fits ({0}) to MS ({1})".format(args.vis_uvfits, inp_vis))
-            importuvfits(fitsfile=args.vis_uvfits, vis=inp_vis)
 
     ### put all file names at the very beginning
     if inp_vis.endswith("/"): inp_vis=inp_vis[:-1]
@@ -43,43 +35,152 @@ def main(args):
     bin_name = four_pol_vis.strip("ms") + "bin"
     freq_name = four_pol_vis.replace(".ms", ".freq.npy")
     smooth_npy = bin_name.strip("bin") + "smooth.npy"
+    manifest_name = four_pol_vis.replace(".ms", ".manifest.json")
 
+    ### every stage is skipped if its outputs recorded in the manifest are still valid
+    manifest = StageManifest(manifest_name, force=args.force)
+    ### timing and resource usage of each stage, see `instrument.py` to aggregate them
+    recorder = StageRecorder(four_pol_vis.replace(".ms", ".stages.jsonl"), beam=os.path.abspath(inp_vis))
+    stages = []
 
-    print("------> Averaging MS ({0}) and saving to {1}".format(inp_vis, averaged_vis))
-    average(inp_vis, averaged_vis, timebin="10s", freqbin=1) # average it to 1 MHz
+    def _flag_rfi():
+        ### flag the 4pol MS in the stage writing it, so that its fingerprint in the manifest includes the flags
+        if args.rfi == "none": return
+        from flag import process as flag
+        print("------> Flagging RFI ({0}) in {1}".format(args.rfi, four_pol_vis))
+        flag(four_pol_vis, flag_extremes=False, column="DATA", rfi=args.rfi, threshold=args.rfi_threshold)
+    rfiparams = dict(rfi=args.rfi, rfi_threshold=args.rfi_threshold)
 
-    print("------> Converting MS ({0}) to 4pol ({1})".format(averaged_vis, four_pol_vis))
-    convert(averaged_vis, four_pol_vis)
+    ### phase centre and channels of the 4pol MS handed over from the averaging stage,
+    ### later stages only reopen the 4pol MS if the averaging stage is skipped
+    beam_meta = {}
 
-    print("------> Extracting sky model and saving to {0}".format(model_name))
-    extract(
-        four_pol_vis, pb_radii = 2.0, flux_cutoff = 0.005, spectral_index = -0.83,
-        catalog_file=args.catalog, freq_cat=args.catfreq*1e6,
-    )
+    if args.stream:
+        stream_input = args.vis_uvfits or inp_vis
+        def _stream_average():
+            from stream_average import process as stream_average, process_ms
+            print("------> Averaging {0} to 4pol MS ({1}) in one pass".format(stream_input, four_pol_vis))
+            average = stream_average if args.vis_uvfits else process_ms
+            beam_meta.update(average(stream_input, four_pol_vis, timebin=10., freqbin=1)) # average it to 1 MHz
+            _flag_rfi()
+        stages.append(Stage(
+            "stream_average", _stream_average, inputs=[stream_input], outputs=[four_pol_vis],
+            params=dict(timebin=10., freqbin=1, **rfiparams),
+        ))
+    else:
+        if args.vis_uvfits:
+            def _importuvfits():
+                from casatasks import importuvfits
+                print("------> Convering UV Fits ({0}) to MS ({1})".format(args.vis_uvfits, inp_vis))
+                if os.path.exists(inp_vis): shutil.rmtree(inp_vis)
+                importuvfits(fitsfile=args.vis_uvfits, vis=inp_vis)
+            stages.append(Stage("importuvfits", _importuvfits, inputs=[args.vis_uvfits], outputs=[inp_vis]))
+
+        def _average():
+            from average_the_ms import process as average
+            print("------> Averaging MS ({0}) and saving to {1}".format(inp_vis, averaged_vis))
+            if os.path.exists(averaged_vis): shutil.rmtree(averaged_vis)
+            average(inp_vis, averaged_vis, timebin="10s", freqbin=1, engine=args.average_engine) # average it to 1 MHz
+        stages.append(Stage(
+            "average", _average, inputs=[inp_vis], outputs=[averaged_vis],
+            params=dict(timebin="10s", freqbin=1, engine=args.average_engine),
+        ))
+
+        def _convert():
+            from convert import process as convert
+            print("------> Converting MS ({0}) to 4pol ({1})".format(averaged_vis, four_pol_vis))
+            convert(averaged_vis, four_pol_vis)
+            _flag_rfi()
+        stages.append(Stage("convert", _convert, inputs=[averaged_vis], outputs=[four_pol_vis], params=rfiparams))
+
+    if args.model:
+        ### sky model made for the whole footprint already, see `extract_model_for_ms.process_footprint`
+        print("------> Using existing sky model {0}".format(args.model))
+        model_name = args.model
+    else:
+        def _extract():
+            from extract_model_for_ms import process as extract, process_footprint
+            print("------> Extracting sky model and saving to {0}".format(model_name))
+            if beam_meta:
+                from astropy.coordinates import SkyCoord
+                direction = SkyCoord(*beam_meta["phase_dir"], unit="deg")
+                process_footprint(
+                    [(model_name, direction, beam_meta["freqs"])], pb_radii = 2.0, flux_cutoff = 0.005, spectral_index = -0.83,
+                    catalog_file=args.catalog, freq_cat=args.catfreq*1e6,
+                )
+                return
+            extract(
+                four_pol_vis, pb_radii = 2.0, flux_cutoff = 0.005, spectral_index = -0.83,
+                catalog_file=args.catalog, freq_cat=args.catfreq*1e6,
+            )
+        stages.append(Stage(
+            "extract", _extract, inputs=[four_pol_vis, args.catalog], outputs=[model_name],
+            params=dict(pb_radii=2.0, flux_cutoff=0.005, spectral_index=-0.83, catfreq=args.catfreq),
+        ))
 
     calibrate_cmd = "{build_dir}/calibrate -minuv 200.0 -m {model} {vis} {bin_name}".format(model=model_name, vis=four_pol_vis, build_dir=args.build_dir, bin_name=bin_name)
-    print("------> Calibrating using the sky model and saving soln to {0}\n------> Executing {1}".format(bin_name, calibrate_cmd))
-    os.system(calibrate_cmd)
+    def _calibrate():
+        if args.solver == "stefcal":
+            ### model visibilities are predicted in memory, nothing is written to the 4pol MS
+            from predict import ms_predictor
+            from stefcal import solve_ms
+            print("------> Calibrating in-process (stefcal) using the sky model and saving soln to {0}".format(bin_name))
+            gains, tstart, tend = solve_ms(four_pol_vis, model=ms_predictor(four_pol_vis, model_name), minuv=200.0)
+            binsol.write_gains(bin_name, gains, tstart=tstart, tend=tend)
+            return
+        print("------> Calibrating using the sky model and saving soln to {0}\n------> Executing {1}".format(bin_name, calibrate_cmd))
+        ### a solution left from an earlier run must not be taken as the output of a failed calibrate
+        if os.path.exists(bin_name): os.remove(bin_name)
+        returncode = os.waitstatus_to_exitcode(os.system(calibrate_cmd))
+        if returncode != 0:
+            raise RuntimeError(f"calibrate failed with exit code {returncode}... {calibrate_cmd}")
+    stages.append(Stage(
+        "calibrate", _calibrate, inputs=[four_pol_vis, model_name], outputs=[bin_name],
+        params=dict(cmd=calibrate_cmd) if args.solver == "calibrate" else dict(solver=args.solver, minuv=200.0),
+    ))
 
-    print("------> Exporting frequency from measurement sets....")
-    craco_ms = SimpleMeasurementSet(four_pol_vis)
-    np.save(freq_name, craco_ms.freqs)
+    def _export_freq():
+        print("------> Exporting frequency from measurement sets....")
+        if beam_meta:
+            np.save(freq_name, beam_meta["freqs"])
+            return
+        from craco_vis import SimpleMeasurementSet
+        craco_ms = SimpleMeasurementSet(four_pol_vis)
+        np.save(freq_name, craco_ms.freqs)
+    stages.append(Stage("export_freq", _export_freq, inputs=[four_pol_vis], outputs=[freq_name]))
+    manifest.run(stages, recorder=recorder)
 
     if args.clean:
         print("------> Cleaning the directory....")
         work_dir = os.path.dirname(bin_name)
         # print(f"rm -r {work_dir}/*.ms")
-        os.system(f"rm -r {work_dir}/*.ms")
+        manifest.mark_removed([inp_vis, averaged_vis, four_pol_vis])
+        with recorder.stage("clean"):
+            os.system(f"rm -r {work_dir}/*.ms")
 
-    print("------> Fitting calibration solution...")
-    plotdir = f"{work_dir}/bp_smooth/"
-    bp = CracoBandPass(bin_name, flagchan=args.flagchan)
-    bp.smooth_sol(plotdir=plotdir)
-    bp.dump_calibration(smooth_npy)
+    def _smooth():
+        from smooth_cal import CracoBandPass
+        print("------> Fitting calibration solution...")
+        plotdir = f"{work_dir}/bp_smooth/"
+        bp = CracoBandPass(bin_name, flagchan=args.flagchan, flagfile=args.flagfile)
+        bp.smooth_sol(
+            plot=False, batch=(args.smooth == "batch"),
+            multiproc=(args.smooth == "multiproc"), ncpu=args.ncpu,
+        )
+        ### diagnostic plots are rendered in the background, do not wait for them to save the solution
+        plotter = bp.plot_sol(plotdir=plotdir, mode=args.plot, ncpu=args.plot_ncpu, background=True)
+        bp.dump_calibration(smooth_npy)
+        plotter.wait()
+    ### the flag file is only an input if it exists, so that a missing one does not rerun the smoothing every time
+    smooth_inputs = [bin_name, freq_name] + ([args.flagfile] if os.path.exists(args.flagfile) else [])
+    manifest.run([Stage(
+        "smooth", _smooth, inputs=smooth_inputs, outputs=[smooth_npy],
+        params=dict(flagchan=[int(chan) for chan in args.flagchan], flagfile=args.flagfile),
+    )], recorder=recorder)
         
     print("-------> All Done!  We can now apply the solution saved in the soln file - {0}".format(bin_name))
 
-if __name__ == '__main__':
+def get_parser():
     a = argparse.ArgumentParser()
     group = a.add_mutually_exclusive_group()
     group.add_argument("-vis_ms", type=str, help="Path to visibility ms file")
@@ -88,6 +189,40 @@ if __name__ == '__main__':
     a.add_argument(
         "-flagchan", type=strrange, help="string range to indicate which channels to flag", default="",
     )
+    a.add_argument(
+        "-flagfile", type=str, help="file with frequency ranges to flag in the smoothing",
+        default="/home/craftop/share/fixed_freq_flags.txt",
+    )
+
+    a.add_argument(
+        "-stream", action="store_true",
+        help="average the input to the 4pol MS in one pass (the only MS written), without importuvfits/split/convert",
+    )
+
+    a.add_argument(
+        "-average_engine", type=str,
+        help="engine averaging the MS without -stream - casa (split) or numpy (no CASA, see average_the_ms.py) (def: casa)",
+        default="casa", choices=["casa", "numpy"],
+    )
+
+    a.add_argument(
+        "-rfi", type=str, help="statistical RFI flagging on the averaged 4pol MS before calibration (def: none)",
+        default="none", choices=RFI_MODES,
+    )
+    a.add_argument(
+        "-rfi_threshold", type=float, help="threshold of the RFI flagging in robust sigma (def: 5.0)", default=5.0,
+    )
+
+    a.add_argument(
+        "-solver", type=str,
+        help="gain solver - calibrate (external binary in -build_dir) or stefcal (in-process, see stefcal.py) (def: calibrate)",
+        default="calibrate", choices=["calibrate", "stefcal"],
+    )
+
+    a.add_argument(
+        "-force", action="store_true",
+        help="rerun all stages, even if the outputs recorded in the manifest are up to date",
+    )
 
     ### remove measurement sets...
     a.add_argument(
@@ -95,6 +230,21 @@ if __name__ == '__main__':
         default=True,
     )
     
+    a.add_argument(
+        "-smooth", type=str, help="smoothing mode - loop, multiproc or batch (def: loop)",
+        default="loop", choices=["loop", "multiproc", "batch"],
+    )
+    a.add_argument(
+        "-ncpu", type=int, help="number of processes for the multiproc smoothing mode (def: 36)", default=36,
+    )
+    a.add_argument(
+        "-plot", type=str, help="diagnostic plots - none, summary or antenna (def: antenna)",
+        default="antenna", choices=["none", "summary", "antenna"],
+    )
+    a.add_argument(
+        "-plot_ncpu", type=int, help="number of processes for rendering diagnostic plots (def: 4)", default=4,
+    )
+    
     a.add_argument(
         "-build_dir", type=str, help="Path to the build directory where the compiled scripts are kept", 
         default="/data/big/craco/wan342/craco_calib/scripts/"
@@ -107,7 +257,13 @@ if __name__ == '__main__':
         "-catfreq", type=float, help="central frequency of the catalogue provided",
         default=887.5
     )
+    a.add_argument(
+        "-model", type=str, help="Path to an existing sky model, skip the model extraction if provided",
+        default=None,
+    )
+    return a
 
-    args = a.parse_args()
+if __name__ == '__main__':
+    args = get_parser().parse_args()
     main(args)
 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# timing and resource usage of pipeline stages, written as json lines (one record per stage)
+# run it as a script to aggregate records of many beams, e.g., all beams in an SBID
+
+import os
+import sys
+import json
+import glob
+import time
+import socket
+import argparse
+import resource
+from contextlib import contextmanager
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+def _read_proc_io():
+    """
+    bytes read/written by this process (including reaped children) from /proc/self/io, empty if not available
+    """
+    try:
+        with open("/proc/self/io") as fp:
+            values = dict(line.split(":") for line in fp.read().splitlines() if ":" in line)
+    except OSError:
+        return {}
+    return {key: int(value) for key, value in values.items()}
+
+class ResourceSnapshot:
+    """
+    resource usage of this process and its (finished) child processes at a moment
+    """
+    def __init__(self, ):
+        self.walltime = time.perf_counter()
+        times = os.times()
+        self.cpu_self = times.user + times.system
+        self.cpu_children = times.children_user + times.children_system
+        ### ru_maxrss is in kB on linux
+        self.maxrss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        self.maxrss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.
+        self.io = _read_proc_io()
+
+    def delta(self, start):
+        """
+        usage between `start` and this snapshot
+
+        Note
+        ----------
+        the peak memory is the peak of the whole process (and the largest child) until now,
+        it is not reset between stages
+        """
+        usage = dict(
+            wall=self.walltime - start.walltime,
+            cpu_self=self.cpu_self - start.cpu_self,
+            cpu_children=self.cpu_children - start.cpu_children,
+            maxrss_self_mb=self.maxrss_self,
+            maxrss_children_mb=self.maxrss_children,
+        )
+        for key in ("read_bytes", "write_bytes", "rchar", "wchar"):
+            if key in self.io and key in start.io:
+                usage[key] = self.io[key] - start.io[key]
+        return usage
+
+class StageRecorder:
+    """
+    record timing and resource usage of stages to a json lines file
+
+    Params
+    ----------
+    path: str, optional
+        json lines file to append the records to, nothing is written if None
+    beam: str, optional
+        name of the beam (or any label) saved in each record
+    """
+    def __init__(self, path=None, beam=None):
+        self.path = path
+        self.beam = beam
+        self.records = []
+
+    def _write(self, record):
+        self.records.append(record)
+        if self.path is None: return
+        with open(self.path, "a") as fp:
+            fp.write(json.dumps(record) + "\n")
+
+    @contextmanager
+    def stage(self, name, **extra):
+        """
+        context manager to instrument a stage, the record is written even if the stage failed
+        """
+        record = dict(beam=self.beam, stage=name, host=socket.gethostname(), pid=os.getpid(), start=time.time())
+        record.update(extra)
+        start = ResourceSnapshot()
+        try:
+            yield record
+            record["status"] = "ok"
+        except BaseException as error:
+            record["status"] = f"failed: {error!r}"
+            raise
+        finally:
+            record.update(ResourceSnapshot().delta(start))
+            self._write(record)
+            log.info(f"""stage {name} {record["status"]} - wall {record["wall"]:.1f} s, cpu {record["cpu_self"] + record["cpu_children"]:.1f} s""")
+
+    def skip(self, name, **extra):
+        """
+        record a skipped stage
+        """
+        record = dict(beam=self.beam, stage=name, host=socket.gethostname(), pid=os.getpid(), start=time.time(), status="skipped")
+        record.update(extra)
+        self._write(record)
+
+def load_records(paths):
+    records = []
+    for path in paths:
+        with open(path) as fp:
+            records.extend(json.loads(line) for line in fp if line.strip())
+    return records
+
+def aggregate(records):
+    """
+    summarise records of all stages that were run (not skipped)
+
+    Returns
+    ----------
+    summary: dict
+        statistics for each stage - number of runs, failures, total/mean/max wall time,
+        total cpu time, largest peak memory, total bytes read and written
+    """
+    summary = {}
+    for name in dict.fromkeys(record["stage"] for record in records):
+        runs = [record for record in records if record["stage"] == name and record.get("status") != "skipped"]
+        if len(runs) == 0: continue
+        wall = np.array([record["wall"] for record in runs])
+        summary[name] = dict(
+            nrun=len(runs), nfail=sum(record["status"] != "ok" for record in runs),
+            wall_total=wall.sum(), wall_mean=wall.mean(), wall_max=wall.max(),
+            slowest=runs[int(wall.argmax())].get("beam"),
+            cpu_total=sum(record["cpu_self"] + record["cpu_children"] for record in runs),
+            maxrss_mb=max(max(record["maxrss_self_mb"], record["maxrss_children_mb"]) for record in runs),
+            read_gb=sum(record.get("read_bytes", 0) for record in runs) / 1024**3,
+            write_gb=sum(record.get("write_bytes", 0) for record in runs) / 1024**3,
+        )
+    return summary
+
+def print_summary(summary, fp=sys.stdout):
+    header = f"""{"stage":<16}{"nrun":>6}{"nfail":>6}{"wall(s)":>10}{"mean(s)":>10}{"max(s)":>10}{"cpu(s)":>10}{"rss(MB)":>10}{"read(GB)":>10}{"write(GB)":>10}  slowest"""
+    fp.write(header + "\n")
+    for name, stat in sorted(summary.items(), key=lambda item: -item[1]["wall_total"]):
+        fp.write(
+            f"""{name:<16}{stat["nrun"]:>6}{stat["nfail"]:>6}{stat["wall_total"]:>10.1f}{stat["wall_mean"]:>10.1f}"""
+            f"""{stat["wall_max"]:>10.1f}{stat["cpu_total"]:>10.1f}{stat["maxrss_mb"]:>10.0f}"""
+            f"""{stat["read_gb"]:>10.2f}{stat["write_gb"]:>10.2f}  {stat["slowest"]}\n"""
+        )
+
+def main(args):
+    paths = [path for pattern in args.records for path in sorted(glob.glob(pattern))]
+    if len(paths) == 0:
+        raise ValueError("no stage records found...")
+    summary = aggregate(load_records(paths))
+    print_summary(summary)
+    if args.json is not None:
+        with open(args.json, "w") as fp:
+            json.dump(summary, fp, indent=2)
+
+if __name__ == '__main__':
+    a = argparse.ArgumentParser()
+    a.add_argument("-records", type=str, nargs="+", help="stage record files (or glob patterns), e.g., SB*/scans/*/*/*/*.stages.jsonl")
+    a.add_argument("-json", type=str, help="save the summary to a json file", default=None)
+
+    args = a.parse_args()
+    main(args)
@@ -0,0 +1,186 @@
+# normal python script - not command line executable
+# per-beam manifest recording the inputs, outputs and parameters of each pipeline stage,
+# so that a rerun only redoes the stages whose outputs are out of date (similar to make)
+
+import os
+import json
+import hashlib
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+def _file_fingerprint(path, method):
+    stat = os.stat(path)
+    if method == "hash":
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1 << 24), b""):
+                sha1.update(chunk)
+        return dict(size=stat.st_size, sha1=sha1.hexdigest())
+    return dict(size=stat.st_size, mtime=stat.st_mtime)
+
+def fingerprint(path, method="mtime"):
+    """
+    fingerprint of a file or a directory (e.g., measurement set)
+
+    Params
+    ----------
+    method: str, "mtime" by default
+        "mtime" - size and modification time, "hash" - size and sha1 of the content.
+        Directories always use the total size, the latest modification time and the number of files
+
+    Returns
+    ----------
+    fingerprint: dict or None
+        None if `path` does not exist
+    """
+    path = os.path.realpath(path)
+    if not os.path.exists(path): return None
+    if not os.path.isdir(path):
+        return _file_fingerprint(path, method)
+
+    size, mtime, nfile = 0, 0., 0
+    for root, _, files in os.walk(path):
+        for fname in files:
+            stat = os.stat(os.path.join(root, fname))
+            size += stat.st_size; mtime = max(mtime, stat.st_mtime); nfile += 1
+    return dict(size=size, mtime=mtime, nfile=nfile)
+
+class Stage:
+    """
+    a pipeline stage
+
+    Params
+    ----------
+    name: str
+        name of the stage, used as the key in the manifest
+    func: callable
+        function (without arguments) to run the stage
+    inputs, outputs: list of str
+        files or directories read/written by the stage
+    params: dict
+        parameters of the stage, the stage is rerun if any of them is changed, values should be json serialisable
+    """
+    def __init__(self, name, func, inputs=(), outputs=(), params=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = {} if params is None else params
+
+class StageManifest:
+    """
+    manifest of all stages run for a beam, saved as a json file
+
+    Params
+    ----------
+    path: str
+        path to the manifest file, loaded if it exists
+    method: str, "mtime" by default
+        fingerprint method for files, see `fingerprint`
+    force: bool, False by default
+        rerun all stages regardless of the manifest
+    """
+    def __init__(self, path, method="mtime", force=False):
+        self.path = path
+        self.method = method
+        self.force = force
+
+        self.stages = {}
+        self.removed = {} # intermediate products removed on purpose, e.g., cleaned measurement sets
+        if os.path.exists(path):
+            with open(path) as fp:
+                manifest = json.load(fp)
+            self.stages = manifest.get("stages", {})
+            self.removed = manifest.get("removed", {})
+
+    def save(self, ):
+        tmppath = f"{self.path}.tmp"
+        with open(tmppath, "w") as fp:
+            json.dump(dict(stages=self.stages, removed=self.removed), fp, indent=2)
+        os.replace(tmppath, self.path)
+
+    def _matches(self, path, recorded):
+        current = fingerprint(path, self.method)
+        if current is None: # removed intermediate products are treated as unchanged
+            return path in self.removed and self.removed[path] == recorded
+        return current == recorded
+
+    def is_valid(self, stage):
+        """
+        check if the recorded outputs of `stage` are still valid, i.e., same parameters,
+        unchanged inputs and outputs (or removed as intermediate products)
+        """
+        if self.force: return False
+        record = self.stages.get(stage.name)
+        if record is None: return False
+        if record["params"] != json.loads(json.dumps(stage.params)): return False
+        if sorted(record["inputs"]) != sorted(stage.inputs): return False
+        if sorted(record["outputs"]) != sorted(stage.outputs): return False
+
+        for path, recorded in list(record["inputs"].items()) + list(record["outputs"].items()):
+            if not self._matches(path, recorded): return False
+        return True
+
+    def record(self, stage, elapsed=None):
+        for path in stage.outputs: self.removed.pop(path, None)
+        self.stages[stage.name] = dict(
+            params=stage.params,
+            inputs={path: fingerprint(path, self.method) for path in stage.inputs},
+            outputs={path: fingerprint(path, self.method) for path in stage.outputs},
+            elapsed=elapsed, time=time.time(),
+        )
+        self.save()
+
+    def mark_removed(self, paths):
+        """
+        mark `paths` as intermediate products that are removed on purpose,
+        stages using them are still valid unless they are needed again
+        """
+        for path in paths:
+            for record in self.stages.values():
+                for files in (record["inputs"], record["outputs"]):
+                    if path in files and files[path] is not None:
+                        self.removed[path] = files[path]
+        self.save()
+
+    def _plan(self, stages):
+        """
+        stages to run - those out of date, and those producing removed files needed by them
+        """
+        torun = set()
+        needed = set() # missing files needed by stages to run
+        for stage in reversed(stages):
+            missing_output = any(path in needed for path in stage.outputs)
+            if missing_output or not self.is_valid(stage):
+                torun.add(stage.name)
+                needed.update(path for path in stage.inputs if fingerprint(path) is None)
+        return torun
+
+    def run(self, stages, recorder=None):
+        """
+        run `stages` in order, skipping those with valid outputs recorded in the manifest
+
+        Params
+        ----------
+        recorder: instrument.StageRecorder, optional
+            record timing and resource usage of each stage if provided
+        """
+        torun = self._plan(stages)
+        for stage in stages:
+            ### upstream stages may have been rerun, check it again
+            if stage.name not in torun and self.is_valid(stage):
+                print("------> Skipping {0}, outputs are up to date".format(stage.name))
+                if recorder is not None: recorder.skip(stage.name)
+                continue
+            tstart = time.time()
+            if recorder is None:
+                stage.func()
+            else:
+                with recorder.stage(stage.name):
+                    stage.func()
+            missing = [path for path in stage.outputs if not os.path.exists(path)]
+            if missing:
+                raise RuntimeError(f"stage {stage.name} failed... no output found - {missing}")
+            self.record(stage, elapsed=time.time() - tstart)
@@ -0,0 +1,185 @@
+# normal python script - not command line executable
+# write a CRACO measurement set directly from arrays, without going through CASA
+
+import os
+import shutil
+import numpy as np
+from casacore.tables import table, default_ms, maketabdesc, makearrcoldesc
+
+### correlations of the 4 polarisations - XX, XY, YX, YY
+CORR_TYPES = [9, 10, 11, 12]
+CORR_PRODUCTS = [[0, 0], [0, 1], [1, 0], [1, 1]]
+
+### AIPS mount type (MNTSTA) to measurement set MOUNT
+MOUNT_TYPES = {
+    0: "alt-az", 1: "equatorial", 2: "orbiting", 3: "X-Y",
+    4: "alt-az+nasmyth-R", 5: "alt-az+nasmyth-L",
+}
+
+class MeasurementSetWriter:
+    """
+    write a single field, single spectral window measurement set row block by row block
+
+    Params
+    ----------
+    msname: str
+        path of the measurement set, removed first if it exists
+    freqs: numpy.ndarray
+        channel frequencies in Hz
+    chanwidth: float or numpy.ndarray
+        channel width in Hz
+    antnames: list of str
+    antpos: numpy.ndarray, (nant, 3)
+        ITRF antenna positions in metre
+    phase_dir: tuple
+        (ra, dec) of the phase centre in radian
+    mounts: numpy.ndarray, optional
+        AIPS mount type for each antenna, alt-az by default
+    """
+    def __init__(
+        self, msname, freqs, chanwidth, antnames, antpos, phase_dir,
+        source="UNKNOWN", mounts=None, dish_diameter=12., telescope="ASKAP", npol=4,
+    ):
+        if msname.endswith("/"): msname = msname[:-1]
+        self.msname = msname
+        self.freqs = np.array(freqs, dtype=float)
+        self.nchan = self.freqs.shape[0]
+        self.npol = npol
+        self.nant = len(antnames)
+        self.telescope = telescope
+
+        self.table = self._create_main()
+        self._fill_antenna(antnames, antpos, mounts, dish_diameter)
+        self._fill_spw(chanwidth)
+        self._fill_pol()
+        self._fill_field(phase_dir, source)
+
+        self.nrow = 0
+        self.time_range = [np.inf, -np.inf]
+
+    def _create_main(self, ):
+        if os.path.exists(self.msname):
+            shutil.rmtree(self.msname)
+        shape = [self.nchan, self.npol]
+        tabdesc = maketabdesc([
+            makearrcoldesc("DATA", 0j, shape=shape, valuetype="complex"),
+            makearrcoldesc("FLAG", False, shape=shape),
+            makearrcoldesc("WEIGHT_SPECTRUM", 0., shape=shape, valuetype="float"),
+            makearrcoldesc("SIGMA_SPECTRUM", 0., shape=shape, valuetype="float"),
+            makearrcoldesc("WEIGHT", 0., shape=[self.npol], valuetype="float"),
+            makearrcoldesc("SIGMA", 0., shape=[self.npol], valuetype="float"),
+        ])
+        t = default_ms(self.msname, tabdesc)
+        t.putcolkeyword("UVW", "MEASINFO", {"type": "uvw", "Ref": "J2000"})
+        return t
+
+    def _fill_subtable(self, name, nrow, **columns):
+        t = table(f"{self.msname}/{name}", readonly=False, ack=False)
+        t.addrows(nrow)
+        for column, value in columns.items():
+            t.putcol(column, value)
+        t.close()
+
+    def _fill_antenna(self, antnames, antpos, mounts, dish_diameter):
+        if mounts is None: mounts = np.zeros(self.nant, dtype=int)
+        self._fill_subtable(
+            "ANTENNA", self.nant,
+            NAME=list(antnames), STATION=list(antnames),
+            POSITION=np.array(antpos, dtype=float), OFFSET=np.zeros((self.nant, 3)),
+            TYPE=["GROUND-BASED"] * self.nant,
+            MOUNT=[MOUNT_TYPES.get(int(mount), "alt-az") for mount in mounts],
+            DISH_DIAMETER=np.ones(self.nant) * dish_diameter,
+            FLAG_ROW=np.zeros(self.nant, dtype=bool),
+        )
+        self._fill_subtable(
+            "FEED", self.nant,
+            ANTENNA_ID=np.arange(self.nant), FEED_ID=np.zeros(self.nant, dtype=int),
+            SPECTRAL_WINDOW_ID=-np.ones(self.nant, dtype=int), BEAM_ID=-np.ones(self.nant, dtype=int),
+            NUM_RECEPTORS=np.ones(self.nant, dtype=int) * 2,
+            POLARIZATION_TYPE=np.array([["X", "Y"]] * self.nant),
+            BEAM_OFFSET=np.zeros((self.nant, 2, 2)), RECEPTOR_ANGLE=np.zeros((self.nant, 2)),
+            POL_RESPONSE=np.tile(np.eye(2, dtype=complex), (self.nant, 1, 1)),
+            POSITION=np.zeros((self.nant, 3)), INTERVAL=np.ones(self.nant) * 1e30,
+        )
+
+    def _fill_spw(self, chanwidth):
+        chanwidth = np.ones(self.nchan) * chanwidth
+        self._fill_subtable(
+            "SPECTRAL_WINDOW", 1,
+            CHAN_FREQ=self.freqs[None, :], CHAN_WIDTH=chanwidth[None, :],
+            EFFECTIVE_BW=np.abs(chanwidth)[None, :], RESOLUTION=np.abs(chanwidth)[None, :],
+            NUM_CHAN=[self.nchan], REF_FREQUENCY=[self.freqs[0]],
+            TOTAL_BANDWIDTH=[np.abs(chanwidth).sum()], MEAS_FREQ_REF=[5], # TOPO
+            NET_SIDEBAND=[1], NAME=["CRACO"],
+        )
+        self._fill_subtable(
+            "DATA_DESCRIPTION", 1,
+            SPECTRAL_WINDOW_ID=[0], POLARIZATION_ID=[0], FLAG_ROW=[False],
+        )
+
+    def _fill_pol(self, ):
+        if self.npol == 4:
+            corrtype, corrproduct = CORR_TYPES, CORR_PRODUCTS
+        else: # XX, YY only
+            corrtype, corrproduct = [9, 12][:self.npol], [[0, 0], [1, 1]][:self.npol]
+        self._fill_subtable(
+            "POLARIZATION", 1,
+            NUM_CORR=[self.npol], CORR_TYPE=np.array([corrtype]),
+            CORR_PRODUCT=np.array([corrproduct]), FLAG_ROW=[False],
+        )
+
+    def _fill_field(self, phase_dir, source):
+        direction = np.array(phase_dir, dtype=float).reshape(1, 1, 2)
+        self._fill_subtable(
+            "FIELD", 1,
+            NAME=[source], CODE=[""], NUM_POLY=[0], SOURCE_ID=[-1],
+            DELAY_DIR=direction, PHASE_DIR=direction, REFERENCE_DIR=direction,
+        )
+
+    def write(self, time, ant1, ant2, uvw, data, flag, weight, interval, feed=0):
+        """
+        append rows to the main table, array columns should be in the (nrow, nchan, npol) shape
+
+        Params
+        ----------
+        weight: numpy.ndarray
+            weight spectrum, WEIGHT/SIGMA are derived from it
+        interval: numpy.ndarray
+            integration time of each row in seconds, used for INTERVAL and EXPOSURE
+        """
+        nrow = time.shape[0]
+        if nrow == 0: return
+        weight = weight.astype(np.float32)
+        with np.errstate(divide="ignore"):
+            sigma = np.where(weight > 0, 1. / np.sqrt(weight), 0.).astype(np.float32)
+        rowweight = weight.mean(axis=1)
+        with np.errstate(divide="ignore"):
+            rowsigma = np.where(rowweight > 0, 1. / np.sqrt(rowweight), 0.).astype(np.float32)
+
+        columns = dict(
+            TIME=time, TIME_CENTROID=time, INTERVAL=interval, EXPOSURE=interval,
+            ANTENNA1=ant1.astype(np.int32), ANTENNA2=ant2.astype(np.int32),
+            FEED1=np.ones(nrow, dtype=np.int32) * feed, FEED2=np.ones(nrow, dtype=np.int32) * feed,
+            UVW=uvw, DATA=data.astype(np.complex64), FLAG=flag,
+            WEIGHT_SPECTRUM=weight, SIGMA_SPECTRUM=sigma, WEIGHT=rowweight, SIGMA=rowsigma,
+            FLAG_ROW=flag.all(axis=(1, 2)),
+            DATA_DESC_ID=np.zeros(nrow, dtype=np.int32), FIELD_ID=np.zeros(nrow, dtype=np.int32),
+            ARRAY_ID=np.zeros(nrow, dtype=np.int32), OBSERVATION_ID=np.zeros(nrow, dtype=np.int32),
+            PROCESSOR_ID=-np.ones(nrow, dtype=np.int32), STATE_ID=-np.ones(nrow, dtype=np.int32),
+            SCAN_NUMBER=np.ones(nrow, dtype=np.int32),
+        )
+
+        self.table.addrows(nrow)
+        for column, value in columns.items():
+            self.table.putcol(column, value, startrow=self.nrow, nrow=nrow)
+        self.nrow += nrow
+        self.time_range = [min(self.time_range[0], time.min()), max(self.time_range[1], time.max())]
+
+    def close(self, ):
+        if self.nrow == 0: self.time_range = [0., 0.]
+        self._fill_subtable(
+            "OBSERVATION", 1,
+            TELESCOPE_NAME=[self.telescope], TIME_RANGE=np.array([self.time_range]),
+            OBSERVER=[""], PROJECT=[""], SCHEDULE_TYPE=[""], FLAG_ROW=[False], RELEASE_DATE=[0.],
+        )
+        self.table.close()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# predict model visibilities of a sky model (the `.model` file from `extract_model_for_ms.py`) with a direct Fourier transform
+# rows are processed in chunks small enough to stay in the cache, chunks run in parallel threads (numpy releases the GIL)
+#
+# convention (same as measurement sets) - vis = sum(S * exp(-2 pi i (u l + v m + w (n - 1)) / lambda)),
+# XX and YY are both Stokes I, XY and YX are zero
+
+import os
+import re
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+log = logging.getLogger(__name__)
+
+### speed of light in m/s
+SPEED_OF_LIGHT = 299792458.0
+### number of (row, source) elements in a chunk, 32768 complex128 values are 512 kB
+CHUNK_ELEMENTS = 32768
+### fwhm to sigma of a gaussian
+FWHM_TO_SIGMA = 1. / (2. * np.sqrt(2. * np.log(2.)))
+### columns of a component line, the spectral index is a list in brackets
+MODEL_LINE = re.compile(r"([^,]*),([^,]*),([^,]*),([^,]*),([^,]*),\[([^\]]*)\],([^,]*),([^,]*),([^,]*),([^,]*),([^,]*)")
+
+def parse_sexagesimal(value, hours=False):
+    """
+    convert `value` ([+-]dd:mm:ss.s, or dd.mm.ss.s for declination) to degree
+    """
+    value = value.strip()
+    sign = -1. if value.startswith("-") else 1.
+    parts = re.split("[:.]", value.lstrip("+-"), maxsplit=2)
+    degree = abs(float(parts[0])) + float(parts[1]) / 60. + float(parts[2]) / 3600.
+    return sign * degree * (15. if hours else 1.)
+
+def read_model(fname):
+    """
+    read a sky model written by `extract_model_for_ms.write_model`
+
+    Returns
+    ----------
+    model: dict
+        name, RA/Dec (degree), I (Jy at the reference frequency), alpha (nsrc, nterm), logsi, reffreq (Hz),
+        DC_Maj/DC_Min (fwhm in arcsec, 0 for point sources) and DC_PA (degree) of all components
+    """
+    rows = []
+    with open(fname) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith("#") or line.lower().startswith("format"): continue
+            match = MODEL_LINE.match(line)
+            if match is None:
+                raise ValueError(f"cannot parse sky model line in {fname} - {line}")
+            rows.append(match.groups())
+
+    nterm = max([len(row[5].split(",")) for row in rows], default=1)
+    tofloat = lambda values: np.array([float(value) if value.strip() else 0. for value in values])
+    model = dict(
+        name=[row[0] for row in rows],
+        RA=np.array([parse_sexagesimal(row[2], hours=True) for row in rows]),
+        Dec=np.array([parse_sexagesimal(row[3]) for row in rows]),
+        I=tofloat([row[4] for row in rows]),
+        alpha=np.array([
+            [float(value) for value in row[5].split(",")] + [0.] * (nterm - len(row[5].split(","))) for row in rows
+        ]).reshape(len(rows), nterm),
+        logsi=np.array([row[6].strip().lower() == "true" for row in rows]),
+        reffreq=tofloat([row[7] for row in rows]),
+        DC_Maj=tofloat([row[8] for row in rows]),
+        DC_Min=tofloat([row[9] for row in rows]),
+        DC_PA=tofloat([row[10] for row in rows]),
+    )
+    model["is_point"] = np.array([row[1].strip().upper() == "POINT" for row in rows])
+    return model
+
+def spectrum(model, freqs):
+    """
+    flux density (nsrc, nchan) of all components at `freqs`,
+    logarithmic spectral index - I * (nu / nu0) ** (a0 + a1 * log(nu / nu0) + ...), ordinary - I + a0 * (nu / nu0 - 1) + ...
+    """
+    ratio = freqs[None, :] / model["reffreq"][:, None]
+    power = np.arange(1, model["alpha"].shape[1] + 1)
+    logratio = np.log(ratio)
+    logflux = (model["alpha"][:, None, :] * logratio[..., None] ** power).sum(axis=-1)
+    linflux = (model["alpha"][:, None, :] * (ratio - 1.)[..., None] ** power).sum(axis=-1)
+    return np.where(model["logsi"][:, None], model["I"][:, None] * np.exp(logflux), model["I"][:, None] + linflux)
+
+def source_lmn(ra, dec, ra0, dec0):
+    """
+    direction cosines of sources (ra, dec) relative to the phase centre (ra0, dec0), all in radian
+    """
+    dra = ra - ra0
+    l = np.cos(dec) * np.sin(dra)
+    m = np.sin(dec) * np.cos(dec0) - np.cos(dec) * np.sin(dec0) * np.cos(dra)
+    n = np.sqrt(np.maximum(1. - l ** 2 - m ** 2, 0.))
+    return l, m, n
+
+class VisPredictor:
+    """
+    direct Fourier transform of a sky model for given channels and phase centre
+
+    Params
+    ----------
+    model: dict
+        components from `read_model`
+    freqs: numpy.ndarray
+        channel frequencies in Hz
+    phase_dir: tuple
+        (ra, dec) of the phase centre in degree
+    npol: int, 4 by default
+        number of polarisations of the output, see `__call__`
+    nthreads: int, optional
+        number of threads, all cpus by default
+    chunksize: int, optional
+        number of rows in each chunk, worked out from `CHUNK_ELEMENTS` and the number of sources by default
+    """
+    def __init__(self, model, freqs, phase_dir, npol=4, nthreads=None, chunksize=None):
+        self.freqs = np.asarray(freqs, dtype=float)
+        self.npol = npol
+        self.nthreads = nthreads or os.cpu_count()
+
+        ### gaussians first, so that their attenuation is applied to a contiguous slice
+        order = np.argsort(model["is_point"], kind="stable")
+        self.ngauss = int((~model["is_point"]).sum())
+        self.nsrc = order.shape[0]
+        self.chunksize = chunksize or max(1, CHUNK_ELEMENTS // max(self.nsrc, 1))
+
+        ra0, dec0 = np.radians(phase_dir[0]), np.radians(phase_dir[1])
+        l, m, n = source_lmn(np.radians(model["RA"][order]), np.radians(model["Dec"][order]), ra0, dec0)
+        self.lmn = np.stack([l, m, n - 1.]) # (3, nsrc)
+        self.flux = spectrum({key: np.asarray(value)[order] for key, value in model.items() if key != "name"}, self.freqs) # (nsrc, nchan)
+
+        ### gaussian shapes - sigma in radian along the major/minor axes, position angle from north through east
+        gorder = order[:self.ngauss]
+        self.sigma_maj = np.radians(model["DC_Maj"][gorder] / 3600.) * FWHM_TO_SIGMA
+        self.sigma_min = np.radians(model["DC_Min"][gorder] / 3600.) * FWHM_TO_SIGMA
+        self.pa = np.radians(model["DC_PA"][gorder])
+
+        ### channels on a regular grid can be done with a recursion instead of a complex exponential per channel
+        dfreq = np.diff(self.freqs)
+        self.regular = self.freqs.shape[0] > 1 and np.allclose(dfreq, dfreq[0], rtol=1e-9, atol=0.)
+
+    def _predict_chunk(self, uvw, out):
+        """
+        Stokes I visibilities of a chunk of rows, uvw (nrow, 3) in metre, saved to `out` (nrow, nchan)
+        """
+        ### phase per Hz for each row and source
+        delay = -2. * np.pi * (uvw @ self.lmn) / SPEED_OF_LIGHT # (nrow, nsrc)
+        if self.ngauss > 0:
+            u, v = uvw[:, 0:1], uvw[:, 1:2]
+            umaj = u * np.sin(self.pa) + v * np.cos(self.pa)
+            umin = u * np.cos(self.pa) - v * np.sin(self.pa)
+            ### gaussian taper per Hz^2, the uv distance in wavelength scales with the frequency
+            taper = 2. * np.pi ** 2 * ((self.sigma_maj * umaj) ** 2 + (self.sigma_min * umin) ** 2) / SPEED_OF_LIGHT ** 2
+
+        if self.regular:
+            phasor = np.exp(1j * delay * self.freqs[0])
+            step = np.exp(1j * delay * (self.freqs[1] - self.freqs[0]))
+        for ichan, freq in enumerate(self.freqs):
+            if not self.regular:
+                phasor = np.exp(1j * delay * freq)
+            term = phasor * self.flux[:, ichan]
+            if self.ngauss > 0:
+                term[:, :self.ngauss] *= np.exp(-taper * freq ** 2)
+            out[:, ichan] = term.sum(axis=1)
+            if self.regular: phasor *= step
+        return out
+
+    def predict(self, uvw):
+        """
+        Stokes I visibilities (nrow, nchan) for `uvw` (nrow, 3) in metre
+        """
+        uvw = np.asarray(uvw, dtype=float)
+        nrow = uvw.shape[0]
+        out = np.zeros((nrow, self.freqs.shape[0]), dtype=complex)
+        if self.nsrc == 0: return out
+        starts = range(0, nrow, self.chunksize)
+        run = lambda start: self._predict_chunk(uvw[start:start + self.chunksize], out[start:start + self.chunksize])
+        if self.nthreads > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+                list(executor.map(run, starts))
+        else:
+            for start in starts: run(start)
+        return out
+
+    def __call__(self, uvw):
+        """
+        model visibilities (nrow, nchan, npol), XX and YY (the first and last polarisations) are Stokes I
+        """
+        stokesi = self.predict(uvw)
+        out = np.zeros(stokesi.shape + (self.npol, ), dtype=complex)
+        out[..., 0] = stokesi
+        out[..., self.npol - 1] = stokesi
+        return out
+
+def ms_predictor(msname, modelfname, nthreads=None):
+    """
+    `VisPredictor` for the channels, phase centre and polarisations of the measurement set `msname`
+    """
+    from craco_vis import SimpleMeasurementSet
+    ms = SimpleMeasurementSet(msname)
+    return VisPredictor(read_model(modelfname), ms.freqs, ms.phase_dir, npol=ms.npol, nthreads=nthreads)
+
+def predict_ms(msname, modelfname, column="MODEL_DATA", blocksize=10000, nthreads=None):
+    """
+    predict model visibilities for `msname` and save them to `column` (added if it does not exist)
+    """
+    from casacore.tables import table, makecoldesc
+    predictor = ms_predictor(msname, modelfname, nthreads=nthreads)
+    log.info(f"predicting {predictor.nsrc} components ({predictor.ngauss} gaussians) for {msname}")
+
+    t = table(msname, readonly=False, ack=False)
+    if column not in t.colnames():
+        t.addcols(makecoldesc(column, t.getcoldesc("DATA")))
+    nrow = t.nrows()
+    for startrow in range(0, nrow, blocksize):
+        nblock = min(blocksize, nrow - startrow)
+        uvw = t.getcol("UVW", startrow, nblock)
+        t.putcol(column, predictor(uvw).astype(np.complex64), startrow, nblock)
+    t.close()
+
+def main(args):
+    if args.vis is None or args.model is None:
+        raise ValueError("Need to provide an input vis ms and a sky model")
+    predict_ms(args.vis, args.model, column=args.column, nthreads=args.nthreads)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    a = argparse.ArgumentParser()
+    a.add_argument("-vis", type=str, help="Input vis ms")
+    a.add_argument("-model", type=str, help="sky model, e.g., from extract_model_for_ms.py")
+    a.add_argument("-column", type=str, help="column to save the model visibilities (def: MODEL_DATA)", default="MODEL_DATA")
+    a.add_argument("-nthreads", type=int, help="number of threads (def: all cpus)", default=None)
+
+    args = a.parse_args()
+    main(args)
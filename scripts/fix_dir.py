@@ -84,12 +84,8 @@ class Skypos:
         :param float delta_lon: longitude (RA) offset in radians
         :param float delta_lat: latitude (DEC) offset in radians
         """
-        lat = self.dec
-        lon = self.ra
-        # vector along X axis (first point of Aries)
-        x0 = Skypos('0h0m0s', '0:0:0', 3, 3)
-        shifted_direction = x0.rotate_z(delta_lon).rotate_y(lat + delta_lat).rotate_z(lon)
-        return shifted_direction
+        ra, dec = shift_directions(self.ra, self.dec, delta_lon, delta_lat)
+        return Skypos(float(ra), float(dec))
 
     def get_ras(self):
         if self.ras is None:
@@ -107,6 +103,34 @@ class Skypos:
         return '{} {}'.format(self.get_ras(), self.get_decs())
 
 
+def shift_directions(ra, dec, delta_lon, delta_lat):
+    """
+    Array version of Skypos.shift - shift directions (ra, dec) by the longitude/latitude offsets,
+    all in radians, any shapes that broadcast together.
+    Returns the shifted (ra, dec) with ra in [0, 2pi)
+    """
+    ra, dec, delta_lon, delta_lat = np.broadcast_arrays(*map(np.asarray, (ra, dec, delta_lon, delta_lat)))
+    # vector along X axis (first point of Aries), rotated about Z, Y and Z again
+    x0 = [np.ones(ra.shape), np.zeros(ra.shape), np.zeros(ra.shape)]
+    x, y, z = _rotate_v_z(_rotatev_y(_rotate_v_z(x0, delta_lon), dec + delta_lat), ra)
+    return (2 * np.pi + np.arctan2(y, x)) % (2.0 * np.pi), np.arcsin(np.clip(z, -1.0, 1.0))
+
+
+def find_offsets(times, offset_times, offset_intervals):
+    """
+    Index of the FEED offset whose interval (TIME -/+ INTERVAL/2, exclusive) contains each of times,
+    -1 if there is none
+    """
+    starts = offset_times - offset_intervals / 2.0
+    ends = offset_times + offset_intervals / 2.0
+    order = np.argsort(starts, kind="stable")
+    # last interval starting before each time
+    pos = np.searchsorted(starts[order], times, side="left") - 1
+    index = order[np.maximum(pos, 0)]
+    found = (pos >= 0) & (times < ends[index])
+    return np.where(found, index, -1)
+
+
 def ras(ra):
     s = ra * (4.0 * 60.0 * RAD2DEG)
     hh = int(s / 3600.0)
@@ -143,7 +167,7 @@ def decs(dec):
 def _rotate_v_x(vec, a):
     """Return a skypos determined by rotating vec about the X-axis by 
     angle a."""
-    ca, sa = math.cos(a), math.sin(a)
+    ca, sa = np.cos(a), np.sin(a)
     x = vec[0]
     y = vec[1] * ca - vec[2] * sa
     z = vec[1] * sa + vec[2] * ca
@@ -153,7 +177,7 @@ def _rotate_v_x(vec, a):
 def _rotatev_y(vec, a):
     """Return a skypos determined by rotating vec about the Y-axis by 
     angle a."""
-    ca, sa = math.cos(a), math.sin(a)
+    ca, sa = np.cos(a), np.sin(a)
     x = vec[0] * ca - vec[2] * sa
     y = vec[1]
     z = vec[0] * sa + vec[2] * ca
@@ -163,7 +187,7 @@ def _rotatev_y(vec, a):
 def _rotate_v_z(vec, a):
     """Return a skypos determined by rotating vec about the Z-axis by 
     angle a."""
-    ca, sa = math.cos(a), math.sin(a)
+    ca, sa = np.cos(a), np.sin(a)
     x = vec[0] * ca - vec[1] * sa
     y = vec[0] * sa + vec[1] * ca
     z = vec[2]
@@ -256,50 +280,44 @@ tf = table("%s/FEED_OLD" %(ms), readonly=True, ack=False)
 # the offsets for one antenna and for the current beam. This should return offsets
 # required for each field.
 t1 = taql("select from $tf where ANTENNA_ID==0 and FEED_ID==$beam")
-n_offsets = t1.getcol("BEAM_OFFSET").shape[0]
+beam_offsets = t1.getcol("BEAM_OFFSET")
+n_offsets = beam_offsets.shape[0]
 offset_times = t1.getcol("TIME")
 offset_intervals = t1.getcol("INTERVAL")
 print("Found %d offsets in FEED table for beam %d" %(n_offsets, beam))
 for offset_index in range(n_offsets):
-    offset = t1.getcol("BEAM_OFFSET")[offset_index]
+    offset = beam_offsets[offset_index]
     print("Offset %d : t=%f-%f : (%fd,%fd)" %(offset_index, offset_times[offset_index]-offset_intervals[offset_index]/2.0,offset_times[offset_index]+offset_intervals[offset_index]/2.0, -offset[0][0]*180.0/np.pi, offset[0][1]*180.0/np.pi))
 
-# Update the beam position for each field
-for field in range(n_fields):
-    t = table(ms, readonly=True, ack=False)
-    # Get times for the specified field
-    tfdata = taql("select from $t where FIELD_ID==$field and FEED1==$beam and ANTENNA1==0 and ANTENNA2==0")
-    time_data = tfdata.getcol("TIME")
-    if len(time_data) == 0:
-#        print("Warning: Couldn't find valid data for field %d" %(field))
-        continue
-    
-    offset_index = -1
-    for offset in range(n_offsets):
-        if (time_data[0] > offset_times[offset]-offset_intervals[offset]/2.0) and (time_data[0] < offset_times[offset]+offset_intervals[offset]/2.0):
-            offset_index = offset
-            break
-
-#    print("Field %d : t=%f : offset=%d" %(field, time_data[0], offset_index))
-    # Obtain the offset for the current field.
-    offset = t1.getcol("BEAM_OFFSET")[offset_index]
-
-    # Get the pointing direction for the field
-    p_phase = ms_phase[field]
-    
-    # Shift the pointing centre by the beam offset
-    phase = Skypos(p_phase[0][0], p_phase[0][1], 9, 9)
-    new_pos = phase.shift(-offset[0][0], offset[0][1])
-    new_pos.rn = 15
-    new_pos.dn = 15
-    new_pos_str = "%s" %(new_pos)
-    print("Setting position of beam %d, field %d to %s (t=%f-%f, offset=%d)" %(beam, field, new_pos_str, time_data[0], time_data[-1], offset_index))
-    # Update the FIELD table with the beam position
-    new_ra = new_pos.ra
-    if new_ra > np.pi:
-        new_ra -= 2.0 * np.pi
-    ms_phase[field][0][0] = new_ra
-    ms_phase[field][0][1] = new_pos.dec
+# Get the time range of every field in one pass over the main table
+t = table(ms, readonly=True, ack=False)
+tfdata = taql("select TIME, FIELD_ID from $t where FEED1==$beam and ANTENNA1==0 and ANTENNA2==0")
+time_data = tfdata.getcol("TIME")
+field_data = tfdata.getcol("FIELD_ID")
+# rows of each field are grouped with a stable sort, so the first time of a field is the first one in the MS
+order = np.argsort(field_data, kind="stable")
+fields, first = np.unique(field_data[order], return_index=True)
+last = np.append(first[1:], len(order)) - 1
+field_tstart = time_data[order][first]
+field_tend = time_data[order][last]
+
+# Find the offset for each field (fields outside all intervals use the last offset, as before)
+offset_index = find_offsets(field_tstart, offset_times, offset_intervals)
+if np.any(offset_index < 0):
+    print("Warning: no offset interval found for field(s) %s, using the last offset" %(fields[offset_index < 0]))
+field_offsets = beam_offsets[offset_index]
+
+# Shift the pointing centres of all fields by the beam offsets
+p_phase = ms_phase[fields]
+new_ra, new_dec = shift_directions(p_phase[:, 0, 0], p_phase[:, 0, 1], -field_offsets[:, 0, 0], field_offsets[:, 0, 1])
+for ifield, field in enumerate(fields):
+    new_pos_str = "%s %s" %(ras(new_ra[ifield])[:15], decs(new_dec[ifield])[:15])
+    print("Setting position of beam %d, field %d to %s (t=%f-%f, offset=%d)" %(beam, field, new_pos_str, field_tstart[ifield], field_tend[ifield], offset_index[ifield]))
+
+# Update the FIELD table with the beam positions
+new_ra = np.where(new_ra > np.pi, new_ra - 2.0 * np.pi, new_ra)
+ms_phase[fields, 0, 0] = new_ra
+ms_phase[fields, 0, 1] = new_dec
 
 # Write the updated beam positions in to the MS.
 tp.putcol("DELAY_DIR", ms_phase)
@@ -54,18 +54,18 @@ class Bandpass:
                 
     def load(self, filename):
         dt = np.dtype('<i4')
-        fp = open(filename,'r')
+        fp = open(filename,'rb')
         header = np.fromfile(fp, dtype=dt, count=2)
         headerValues = np.fromfile(fp, dtype=dt, count=10)
         self.nsol = headerValues[2]
         self.nant = headerValues[3]
         self.nchan = headerValues[4]
         self.npol = headerValues[5]
-        self.bandpass = np.zeros((self.nsol, self.nant, self.nchan, self.npol), dtype=np.complex)
         dtc = np.dtype('<c16')
-        self.bandpass = np.array(np.fromfile(fp, dtype=dtc, count=self.nsol * self.nant * self.nchan * self.npol))
+        self.bandpass = np.fromfile(fp, dtype=dtc, count=self.nsol * self.nant * self.nchan * self.npol)
         self.bandpass = self.bandpass.reshape((self.nsol, self.nant, self.nchan, self.npol))
-        self.bandpass = np.sqrt(2.0) / self.bandpass
+        ### invert in place, no extra copy of the solution
+        np.divide(np.sqrt(2.0), self.bandpass, out=self.bandpass)
         fp.close()
         print("Read bandpass: %d solutions, %d antennas, %d channels, %d polarisations" %(self.nsol, self.nant, self.nchan, self.npol))
 
@@ -1,12 +1,12 @@
 # normal python script - not command line executable
 # make fitting for the bin file and return the results
 
-from craco import plotbp
+import binsol
 from craft.cmdline import strrange
 import numpy as np
 import os
 
-import matplotlib.pyplot as plt
+from smooth_plot import BandpassPlotter
 from multiprocessing import Pool, cpu_count
 
 import warnings
@@ -54,7 +54,7 @@ class UnWrapFit:
         
         self.yvalue = np.array(yvalue)
         if xvalue is None:
-            self.xvalue = np.arange(self.yvalue.shape[0])
+            self.xvalue = np.arange(self.yvalue.shape[-1])
         else:
             self.xvalue = np.array(xvalue)
             
@@ -87,6 +87,20 @@ class UnWrapFit:
             values[abs(med - values) > sigma * std] = np.nan
         return values
     
+    def _drop_outlier_wmedian_batch(self, values, sigma=None, loop=None):
+        """
+        drop outlier values with regard to median values for each row of a 2D array,
+        this is the batched version of `_drop_outlier_wmedian`
+        """
+        if sigma is None: sigma = self.outlier_sigma
+        if loop is None: loop = self.outlier_loop
+
+        for i in range(loop):
+            med = np.nanmedian(values, axis=-1, keepdims=True)
+            std = np.nanstd(values, axis=-1, keepdims=True)
+            values[abs(med - values) > sigma * std] = np.nan
+        return values
+
     def _get_unwraplinefit_residual(
         self, slope, drop_residual_outlier=True,
     ):        
@@ -95,8 +109,40 @@ class UnWrapFit:
         if drop_residual_outlier:
             res = self._drop_outlier_wmedian(res, sigma=self.outlier_sigma, loop=self.outlier_loop)
         return res
-    
-    def estimate_optimal_fit(self):
+
+    def _get_unwraplinefit_residual_batch(
+        self, slopes, drop_residual_outlier=True,
+    ):
+        """
+        get residuals for all trial slopes at once, the output has a shape of (ntrials, nx)
+        """
+        yy = slopes[:, None] * self.xvalue[None, :]
+        res = (self.yvalue[None, :] - yy) % self.period
+        if drop_residual_outlier:
+            res = self._drop_outlier_wmedian_batch(res, sigma=self.outlier_sigma, loop=self.outlier_loop)
+        return res
+
+    def estimate_optimal_fit(self, batch=True):
+        """
+        search for the best slope among `self.ktrials`
+
+        Params
+        ----------
+        batch: bool, True by default
+            evaluate all trial slopes as one (ntrials, nx) array if True,
+            otherwise loop over the trial slopes one by one
+        """
+        if not batch:
+            return self._estimate_optimal_fit_loop()
+
+        res_ktrials = self._get_unwraplinefit_residual_batch(self.ktrials)
+        stds_ktrails = np.nanstd(res_ktrials, axis=-1)
+
+        ibest = stds_ktrails.argmin()
+        self.slopebest = self.ktrials[ibest]
+        self.interbest = np.nanmedian(res_ktrials[ibest])
+
+    def _estimate_optimal_fit_loop(self):
             
         stds_ktrails = np.array([
             np.nanstd(self._get_unwraplinefit_residual(k, ))
@@ -144,7 +190,112 @@ class UnWrapFit:
         self.unwrap_data()
         self.unwrap_poly_fit()
         return self
-    
+
+
+class BatchUnWrapFit(UnWrapFit):
+    """
+    unwrap and fit a batch of phase vectors at once
+
+    `yvalue` has a shape of (nvec, nx), all vectors share the same `xvalue` and `ktrials`.
+    Vectors without enough valid values to fit a line get nan in `yfit` instead of raising
+    """
+
+    def __init__(self, yvalue, xvalue=None, chunksize=8, **kwargs):
+        super().__init__(yvalue, xvalue=xvalue, **kwargs)
+        self.yvalue = np.atleast_2d(self.yvalue)
+        self.nvec = self.yvalue.shape[0]
+        self.chunksize = chunksize # number of vectors evaluated together, (chunksize, ntrials, nx) arrays
+
+    def _clip_sorted(self, values, sigma, loop):
+        """
+        iterative sigma-clipping around the median along the last axis of a sorted array
+
+        as values are sorted (nan at the end), the clipped values are always at both ends,
+        the remaining values can be described by a window [lo, hi) along the last axis
+
+        Returns
+        ----------
+        med, std: numpy.ndarray
+            median and standard deviation of the remaining values after clipping
+        """
+        nvalid = (~np.isnan(values)).sum(axis=-1)
+        cleaned = np.where(np.isnan(values), 0., values)
+        zeros = np.zeros(values.shape[:-1] + (1, ))
+        cumsum = np.concatenate([zeros, np.cumsum(cleaned, axis=-1)], axis=-1)
+        cumsum2 = np.concatenate([zeros, np.cumsum(cleaned ** 2, axis=-1)], axis=-1)
+
+        def _window_stat(lo, hi):
+            n = hi - lo
+            ilo, ihi = lo[..., None], hi[..., None]
+            mean = (np.take_along_axis(cumsum, ihi, -1) - np.take_along_axis(cumsum, ilo, -1))[..., 0] / n
+            var = (np.take_along_axis(cumsum2, ihi, -1) - np.take_along_axis(cumsum2, ilo, -1))[..., 0] / n - mean ** 2
+            # median from the middle of the window
+            imid1 = np.clip(lo + (n - 1) // 2, 0, values.shape[-1] - 1)[..., None]
+            imid2 = np.clip(lo + n // 2, 0, values.shape[-1] - 1)[..., None]
+            med = 0.5 * (np.take_along_axis(values, imid1, -1) + np.take_along_axis(values, imid2, -1))[..., 0]
+            med[n == 0] = np.nan
+            return med, np.sqrt(np.maximum(var, 0.))
+
+        lo = np.zeros_like(nvalid); hi = nvalid.copy()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for i in range(loop):
+                med, std = _window_stat(lo, hi)
+                lo = np.maximum(lo, (values < (med - sigma * std)[..., None]).sum(axis=-1))
+                hi = np.minimum(hi, (values <= (med + sigma * std)[..., None]).sum(axis=-1))
+                hi = np.maximum(lo, hi)
+            return _window_stat(lo, hi)
+
+    def estimate_optimal_fit(self):
+        self.slopebest = np.zeros(self.nvec)
+        self.interbest = np.zeros(self.nvec)
+
+        for istart in range(0, self.nvec, self.chunksize):
+            yvalue = self.yvalue[istart:istart+self.chunksize]
+            res = yvalue[:, None, :] - self.ktrials[None, :, None] * self.xvalue
+            res -= np.floor(res / self.period) * self.period # much faster than `%` on large arrays
+            res.sort(axis=-1)
+            med, std = self._clip_sorted(res, sigma=self.outlier_sigma, loop=self.outlier_loop)
+
+            ### all nan vectors will pick up the first trial, and will be masked later
+            ibest = np.argmin(np.where(np.isnan(std), np.inf, std), axis=-1)
+            self.slopebest[istart:istart+self.chunksize] = self.ktrials[ibest]
+            self.interbest[istart:istart+self.chunksize] = med[np.arange(ibest.shape[0]), ibest]
+
+    def unwrap_data(self,):
+        besty = self.slopebest[:, None] * self.xvalue + self.interbest[:, None]
+        self.unwrapy = self.yvalue + np.rint((besty - self.yvalue) / self.period) * self.period
+
+    def unwrap_poly_fit(self, threshold=5):
+        """
+        clipped linear fit for all vectors, solved with the closed form least square solution
+        """
+        xvalue = np.broadcast_to(self.xvalue, self.unwrapy.shape)
+        valid = ~np.isnan(self.unwrapy)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for i in range(self.fit_loop):
+                n = valid.sum(axis=-1)
+                sx = np.where(valid, xvalue, 0.).sum(axis=-1)
+                sy = np.where(valid, self.unwrapy, 0.).sum(axis=-1)
+                sxx = np.where(valid, xvalue ** 2, 0.).sum(axis=-1)
+                sxy = np.where(valid, xvalue * self.unwrapy, 0.).sum(axis=-1)
+
+                slope = (n * sxy - sx * sy) / (n * sxx - sx ** 2)
+                inter = (sy - slope * sx) / n
+                yfit = slope[:, None] * self.xvalue + inter[:, None]
+
+                # get residual etc.
+                res = np.where(valid, yfit - self.unwrapy, np.nan)
+                resstd = np.nanstd(res, axis=-1, keepdims=True)
+                valid &= ~(
+                    (abs(res) > self.fit_sigma * resstd) &
+                    (abs(res) > np.deg2rad(threshold))
+                )
+
+        ### mask vectors that cannot be fitted
+        yfit[n < 2] = np.nan
+        self.yfit = yfit
+
 
 class CracoBandPass:
     def __init__(self, fname, refant=None, flagchan=None, flagfile="/home/craftop/share/fixed_freq_flags.txt"):
@@ -174,8 +325,7 @@ class CracoBandPass:
         """
         if fname.endswith(".bin"): # bin file from Emil scripts
             log.info(f"loading bandpass from {fname}...")
-            bpcls = plotbp.Bandpass.load(fname)
-            bp = bpcls.bandpass.copy()[0, ...]
+            bp = binsol.load_gains(fname, isol=0)
             
             ### add some code here if you want to deal with different npol
             # nant, nchan, npol = bp.shape
@@ -212,7 +362,8 @@ class CracoBandPass:
         assert valid_data_arr[ira] != 1., f"no reference antenna found in {self.fname}..."
         return ira
     
-    def _amplitude_fit(self, y, sigma=3, loop=3):
+    @staticmethod
+    def _amplitude_fit(y, sigma=3, loop=3):
         """
         fit a straight line...
         """
@@ -221,6 +372,16 @@ class CracoBandPass:
             res = y - ymedian
             y[abs(res) > np.nanstd(res)] = np.nan
         return np.nanmedian(y)
+
+    def _amplitude_fit_batch(self, y, sigma=3, loop=3):
+        """
+        batched version of `_amplitude_fit`, fit all rows of a (nvec, nchan) array at once
+        """
+        for i in range(loop):
+            ymedian = np.nanmedian(y, axis=-1, keepdims=True)
+            res = y - ymedian
+            y[abs(res) > np.nanstd(res, axis=-1, keepdims=True)] = np.nan
+        return np.nanmedian(y, axis=-1)
     
     def _load_amplitude(self, ):
         """
@@ -233,103 +394,215 @@ class CracoBandPass:
         load relative degree into bp.bpphase
         """
         self.bpphase = np.angle(self.bandpass / self.bandpass[self.ira, ...])
+
+    def _init_fit_result(self, ):
+        """
+        arrays to store the fitting results, used for diagnostic plots
+        - bpampfit: (nant, npol), smoothed amplitude
+        - bpunwrap: (nant, nchan, npol), unwrapped phase
+        - bpphasefit: (nant, nchan, npol), fitted phase
+        """
+        self.bpampfit = np.full((self.nant, self.npol), np.nan)
+        self.bpunwrap = np.full((self.nant, self.nchan, self.npol), np.nan)
+        self.bpphasefit = np.full((self.nant, self.nchan, self.npol), np.nan)
+
+    @property
+    def _fit_pols(self):
+        """
+        polarisations to be smoothed, cross-pols (i.e., 1 and 2) are not smoothed
+        """
+        return [ipol for ipol in range(self.npol) if ipol not in (1, 2)]
     
     ### fit part
-    def _smooth_sol_ant(self, ia, plot=True, plotdir="./bpsmooth"):
-#         print(f"smoothing bandpass solution for antenna ak{ia+1}")
-        
-        bpantsmooth = np.zeros((self.nchan, self.npol), dtype=complex)
-        
-        if plot: 
-            fig = plt.figure(figsize=(6, 8), facecolor="white")
-            axes = fig.subplots(2, 1)
-        
-        for ipol in range(self.npol):
+    @staticmethod
+    def _fit_sol_ant(bpamp, bpphase):
+        """
+        fit the bandpass solution for one antenna, no state is touched here,
+        so that it can be executed in a worker process
+
+        Params
+        ----------
+        bpamp, bpphase: numpy.ndarray
+            amplitude and relative phase of the solution for one antenna, with a shape of (nchan, npol)
+
+        Returns
+        ----------
+        bpantsmooth: numpy.ndarray, (nchan, npol)
+            smoothed solution
+        ampfit: numpy.ndarray, (npol, )
+            smoothed amplitude
+        unwrapy, phasefit: numpy.ndarray, (nchan, npol)
+            unwrapped phase and fitted phase
+        """
+        nchan, npol = bpamp.shape
+        bpantsmooth = np.zeros((nchan, npol), dtype=complex)
+        ampfit = np.full(npol, np.nan)
+        unwrapy = np.full((nchan, npol), np.nan)
+        phasefit = np.full((nchan, npol), np.nan)
+
+        for ipol in range(npol):
             if ipol == 1 or ipol == 2:
                 bpantsmooth[:, ipol] = np.nan + 1j * np.nan
             else:
-                smooth_amp = self._amplitude_fit(self.bpamp[ia, :, ipol])
+                smooth_amp = CracoBandPass._amplitude_fit(bpamp[:, ipol].copy())
 
                 # fit phase
-                phasefit = UnWrapFit(self.bpphase[ia, :, ipol]).run()
-                smooth_phase = phasefit.yfit
+                unwrapfit = UnWrapFit(bpphase[:, ipol]).run()
+                smooth_phase = unwrapfit.yfit
 
                 bpantsmooth[:, ipol] = smooth_amp * np.exp(1j * smooth_phase)
-                
-            if plot:
-            #                 print(f"plotting ak{ia+1} for pol{ipol}")
-                color = None
-                if ipol == 0: color = "black"
-                if ipol == 3: color = "red"
-
-                if color is not None:
-                    ### plot amplitude
-                    axes[0].scatter(
-                        np.arange(self.nchan), self.bpamp[ia, :, ipol],
-                        color=color, alpha=0.5, marker="x", s=20,
-                    )
-                    axes[0].plot(np.arange(self.nchan), np.ones(self.nchan)*smooth_amp)
-                    axes[0].set_xlabel("channel #")
-                    axes[0].set_ylabel("gain amplitude")
-
-                    ### plot phase
-                    axes[1].scatter(
-                        np.arange(self.nchan), np.rad2deg(self.bpphase[ia, :, ipol]),
-                        color=color, alpha=0.3, marker="x", s=20,
-                    )
-                    axes[1].scatter(
-                        np.arange(self.nchan), np.rad2deg(phasefit.unwrapy),
-                        color=color, alpha=0.5, marker="x", s=20,
-                    )
-                    axes[1].plot(np.arange(self.nchan), np.rad2deg(smooth_phase))
-                    axes[1].set_xlabel("channel #")
-                    axes[1].set_ylabel("gain phase")
-        if plot:
-        #             print(f"saving solution for ak{ia+1}...")
-            if not os.path.exists(plotdir):
-                os.makedirs(plotdir)
-            fig.savefig(f"{plotdir}/bp_ak{ia+1}.png", bbox_inches="tight")
-            plt.close()
+
+                ampfit[ipol] = smooth_amp
+                unwrapy[:, ipol] = unwrapfit.unwrapy
+                phasefit[:, ipol] = smooth_phase
+
+        return bpantsmooth, ampfit, unwrapy, phasefit
+
+    def _store_fit_ant(self, ia, fitresult):
+        bpantsmooth, self.bpampfit[ia], self.bpunwrap[ia], self.bpphasefit[ia] = fitresult
+        return bpantsmooth
+
+    def _smooth_sol_ant(self, ia):
+#         print(f"smoothing bandpass solution for antenna ak{ia+1}")
         
-        return ia, bpantsmooth
+        fitresult = self._fit_sol_ant(self.bpamp[ia], self.bpphase[ia])
+        bpantsmooth = self._store_fit_ant(ia, fitresult)
         
-    def smooth_sol(self, plot=True, plotdir="./bpsmooth", multiproc=False, ncpu=36):
+        return ia, bpantsmooth
+
+    def _smooth_sol_multiproc(self, ncpu=36):
         """
-        smooth solution
+        fit antennas in parallel with a process pool, only the per-antenna arrays are sent to workers,
+        results are returned in antenna order. failed antennas are left as zeros
         """
         bpsmooth = np.zeros((self.nant, self.nchan, self.npol), dtype=complex)
-        
-        if multiproc:
-            print("not sure why this is not working...")
-            raise NotImplementedError("MULTIPROCESSING NOT ALLOWED...")
-            ncpu_max = cpu_count()
-            if ncpu > ncpu_max: ncpu = ncpu_max
-            
-            pool = Pool(ncpu)
+
+        ncpu = max(1, min(ncpu, cpu_count(), self.nant))
+        log.info(f"smoothing {self.nant} antennas with {ncpu} processes...")
+        with Pool(ncpu) as pool:
             results = pool.map(
-                self._smooth_sol_ant,
-                [
-                    [ia, plot, plotdir] for ia in range(self.nant)
-                ],
+                _fit_sol_ant_worker,
+                [(ia, self.bpamp[ia], self.bpphase[ia]) for ia in range(self.nant)],
             )
-            
-            ### map the solution back
-            for ia, bpantsmooth in results:
-                bpsmooth[ia] = bpantsmooth
+
+        ### map the solution back
+        for ia, fitresult, error in results:
+            if fitresult is None:
+                log.warning(f"failed to fit calibration solution for ant{ia}... {error}")
+                continue
+            bpsmooth[ia] = self._store_fit_ant(ia, fitresult)
+
+        return bpsmooth
+
+    def _smooth_sol_batch(self, ):
+        """
+        smooth the whole bandpass (nant, nchan, npol) with one set of array operations,
+        antennas/polarisations that cannot be fitted are masked with nan
+        """
+        bpsmooth = np.full((self.nant, self.nchan, self.npol), np.nan + 1j * np.nan)
+
+        ipols = self._fit_pols
+        # (nant, nchan, nfitpol) -> (nant * nfitpol, nchan)
+        amp = self.bpamp[..., ipols].transpose(0, 2, 1).reshape(-1, self.nchan)
+        phase = self.bpphase[..., ipols].transpose(0, 2, 1).reshape(-1, self.nchan)
+
+        smooth_amp = self._amplitude_fit_batch(amp.copy())
+        phasefit = BatchUnWrapFit(phase).run()
+
+        smooth_amp = smooth_amp.reshape(self.nant, len(ipols))
+        unwrapy = phasefit.unwrapy.reshape(self.nant, len(ipols), self.nchan).transpose(0, 2, 1)
+        smooth_phase = phasefit.yfit.reshape(self.nant, len(ipols), self.nchan).transpose(0, 2, 1)
+
+        bpsmooth[..., ipols] = smooth_amp[:, None, :] * np.exp(1j * smooth_phase)
+        self.bpampfit[:, ipols] = smooth_amp
+        self.bpunwrap[..., ipols] = unwrapy
+        self.bpphasefit[..., ipols] = smooth_phase
+
+        nfailed = np.isnan(bpsmooth[..., ipols]).all(axis=(1, 2)).sum()
+        if nfailed > 0:
+            log.warning(f"{nfailed} antennas cannot be fitted in {self.fname}... masked with nan")
+
+        return bpsmooth
+
+    ### plot part
+    def plot_sol(self, plotdir="./bpsmooth", mode="antenna", ncpu=1, background=False):
+        """
+        make diagnostic plots from the stored fitting results, run after `smooth_sol`
+
+        Params
+        ----------
+        mode: str, "antenna" by default
+            "none", "summary" (one figure for all antennas) or "antenna" (one figure per antenna)
+        ncpu: int, 1 by default
+            number of processes used for rendering
+        background: bool, False by default
+            render in the background if True, call `wait` on the returned plotter to finish
+
+        Returns
+        ----------
+        plotter: smooth_plot.BandpassPlotter
+        """
+        plotter = BandpassPlotter(mode=mode, plotdir=plotdir, ncpu=ncpu, background=background)
+        return plotter.submit(self)
+
+    def smooth_sol(self, plot=True, plotdir="./bpsmooth", multiproc=False, ncpu=36, batch=False):
+        """
+        smooth solution
+
+        Params
+        ----------
+        plot: bool, True by default
+            make one diagnostic plot per antenna under `plotdir` once the fitting is done,
+            use `plot_sol` directly for other plotting modes or background plotting
+        multiproc: bool, False by default
+            fit antennas in parallel with a process pool if True
+        ncpu: int, 36 by default
+            maximum number of processes used when `multiproc` is True
+        batch: bool, False by default
+            smooth all antennas and polarisations at once with array operations if True,
+            `multiproc` is ignored in this case
+        """
+        bpsmooth = np.zeros((self.nant, self.nchan, self.npol), dtype=complex)
+        self._init_fit_result()
+
+        if batch:
+            bpsmooth = self._smooth_sol_batch()
+        
+        elif multiproc:
+            bpsmooth = self._smooth_sol_multiproc(ncpu=ncpu)
         
-        if not multiproc:
+        else:
             for ia in range(self.nant):
                 try:
-                    ia, bpantsmooth = self._smooth_sol_ant(ia, plot=plot, plotdir=plotdir)
+                    ia, bpantsmooth = self._smooth_sol_ant(ia)
                     bpsmooth[ia] = bpantsmooth
-                    plt.close()
                 except Exception as error:
-                    log.warning(f"failed to fit calibration solution for ant{ia}...")
+                    log.warning(f"failed to fit calibration solution for ant{ia}... {error!r}")
 
                 
         self.bpsmooth = bpsmooth.reshape((1, self.nant, self.nchan, self.npol))
+
+        ### plots are made from the stored fitting results after all fits are done
+        if plot:
+            self.plot_sol(plotdir=plotdir, mode="antenna")
         
     def dump_calibration(self, binname):
         ### add one dimension
         np.save(binname, self.bpsmooth)
 
+
+def _fit_sol_ant_worker(args):
+    """
+    worker for `CracoBandPass._smooth_sol_multiproc`, args - (ia, bpamp, bpphase)
+
+    Returns
+    ----------
+    ia, fitresult, error
+        fitresult is None if the fit failed, error is then the exception (as repr) for the parent to report
+    """
+    ia, bpamp, bpphase = args
+    try:
+        return ia, CracoBandPass._fit_sol_ant(bpamp, bpphase), None
+    except Exception as error:
+        return ia, None, repr(error)
+
@@ -0,0 +1,164 @@
+# normal python script - not command line executable
+# diagnostic plots for the bandpass smoothing, made from the fitting results stored in `CracoBandPass`
+
+import os
+import numpy as np
+from multiprocessing import Pool
+
+import logging
+log = logging.getLogger(__name__)
+
+PLOT_MODES = ("none", "summary", "antenna")
+
+### colors for XX and YY, cross-pols are not plotted
+POL_COLORS = {0: "black", 3: "red"}
+
+def _new_figure(**kwargs):
+    """
+    create a figure on an Agg canvas, only when we need to plot.
+    pyplot is not used, so that the matplotlib backend of the calling process is left unchanged
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+def fit_result(bp):
+    """
+    collect the raw solution and the fitting results from a smoothed `CracoBandPass`
+
+    Returns
+    ----------
+    result: dict
+        bpamp, bpphase, bpunwrap, bpphasefit - (nant, nchan, npol), bpampfit - (nant, npol)
+    """
+    return dict(
+        bpamp=bp.bpamp, bpphase=bp.bpphase, bpampfit=bp.bpampfit,
+        bpunwrap=bp.bpunwrap, bpphasefit=bp.bpphasefit,
+    )
+
+def _draw_ant(ampax, phaseax, result, ia, markersize=20):
+    """
+    draw amplitude and phase (with the fitting) of antenna `ia` on the given axes
+    """
+    nchan, npol = result["bpamp"].shape[1:]
+    chans = np.arange(nchan)
+    for ipol, color in POL_COLORS.items():
+        if ipol >= npol: continue
+        ### plot amplitude
+        ampax.scatter(
+            chans, result["bpamp"][ia, :, ipol],
+            color=color, alpha=0.5, marker="x", s=markersize,
+        )
+        ampax.plot(chans, np.ones(nchan) * result["bpampfit"][ia, ipol])
+
+        ### plot phase
+        phaseax.scatter(
+            chans, np.rad2deg(result["bpphase"][ia, :, ipol]),
+            color=color, alpha=0.3, marker="x", s=markersize,
+        )
+        phaseax.scatter(
+            chans, np.rad2deg(result["bpunwrap"][ia, :, ipol]),
+            color=color, alpha=0.5, marker="x", s=markersize,
+        )
+        phaseax.plot(chans, np.rad2deg(result["bpphasefit"][ia, :, ipol]))
+
+def plot_antennas(result, ants, plotdir="./bpsmooth"):
+    """
+    make one figure per antenna, the figure object is reused for all antennas in `ants`
+    """
+    fig = _new_figure(figsize=(6, 8), facecolor="white")
+    axes = fig.subplots(2, 1)
+
+    for ia in ants:
+        for ax in axes: ax.cla()
+        _draw_ant(axes[0], axes[1], result, ia)
+        axes[0].set_xlabel("channel #")
+        axes[0].set_ylabel("gain amplitude")
+        axes[1].set_xlabel("channel #")
+        axes[1].set_ylabel("gain phase")
+        fig.savefig(f"{plotdir}/bp_ak{ia+1}.png", bbox_inches="tight")
+
+def plot_summary(result, fname, ncol=6):
+    """
+    make a single figure with amplitude and phase for all antennas
+    """
+    nant = result["bpamp"].shape[0]
+    nrow = int(np.ceil(nant / ncol))
+    fig = _new_figure(figsize=(3 * ncol, 4 * nrow), facecolor="white")
+    axes = fig.subplots(nrow * 2, ncol, sharex=True, squeeze=False)
+
+    for ia in range(nant):
+        irow, icol = divmod(ia, ncol)
+        ampax, phaseax = axes[irow * 2, icol], axes[irow * 2 + 1, icol]
+        _draw_ant(ampax, phaseax, result, ia, markersize=2)
+        ampax.set_title(f"ak{ia+1:02d}", fontsize=8)
+        phaseax.set_ylim(-200., 200.)
+    for ia in range(nant, nrow * ncol):
+        irow, icol = divmod(ia, ncol)
+        axes[irow * 2, icol].set_axis_off(); axes[irow * 2 + 1, icol].set_axis_off()
+
+    fig.savefig(fname, bbox_inches="tight")
+
+class BandpassPlotter:
+    """
+    render diagnostic plots for a smoothed `CracoBandPass`, optionally in a background process pool
+
+    Params
+    ----------
+    mode: str, "antenna" by default
+        "none" - no plots, "summary" - a single figure per beam, "antenna" - one figure per antenna
+    plotdir: str
+        directory to save the plots
+    ncpu: int, 1 by default
+        number of processes used for rendering in the background
+    background: bool, True by default
+        render in a process pool and return immediately if True, call `wait` to finish the plotting
+    """
+    def __init__(self, mode="antenna", plotdir="./bpsmooth", ncpu=1, background=True):
+        if mode is None: mode = "none"
+        if mode not in PLOT_MODES:
+            raise ValueError(f"unknown plot mode {mode}... should be one of {PLOT_MODES}")
+        self.mode = mode
+        self.plotdir = plotdir
+        self.ncpu = max(1, ncpu)
+        self.background = background
+
+        self._pool = None
+        self._async = None
+
+    def _get_tasks(self, result):
+        if self.mode == "summary":
+            return plot_summary, [(result, f"{self.plotdir}/bp_summary.png")]
+        nant = result["bpamp"].shape[0]
+        antchunks = np.array_split(np.arange(nant), min(self.ncpu, nant))
+        return plot_antennas, [(result, [int(ia) for ia in ants], self.plotdir) for ants in antchunks]
+
+    def submit(self, bp):
+        if self.mode == "none": return self
+        if not os.path.exists(self.plotdir):
+            os.makedirs(self.plotdir)
+
+        func, tasks = self._get_tasks(fit_result(bp))
+        if not self.background:
+            for task in tasks: func(*task)
+            return self
+
+        self._pool = Pool(min(self.ncpu, len(tasks)))
+        self._async = self._pool.starmap_async(func, tasks)
+        self._pool.close()
+        return self
+
+    def wait(self):
+        """
+        wait for the background plotting to finish
+        """
+        if self._async is None: return
+        try:
+            self._async.get()
+        except Exception as error:
+            log.warning(f"failed to make diagnostic plots in {self.plotdir}... {error}")
+        finally:
+            self._pool.join()
+            self._pool = None; self._async = None
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# consolidated calibration solution archive for a whole SBID
+# one file holding the frequencies, raw (.bin) and smoothed gains of all beams and scans, with a json index
+#
+# layout - 8 bytes magic, uint64 length of the json index, json index, then all arrays,
+# every array starts at a multiple of `ARCHIVE_ALIGN` bytes so that it can be memory-mapped without any copy
+
+import os
+import json
+import argparse
+import numpy as np
+
+from binsol import BinSolution, find_sbid_bins
+
+import logging
+log = logging.getLogger(__name__)
+
+ARCHIVE_MAGIC = b"CRACOSOL"
+ARCHIVE_VERSION = 1
+ARCHIVE_ALIGN = 64
+
+def _align(offset):
+    return (offset + ARCHIVE_ALIGN - 1) // ARCHIVE_ALIGN * ARCHIVE_ALIGN
+
+def _beam_info(binfname):
+    """
+    scan, timestamp and beam of a solution, following the output structure of `calib_allbeam.py`,
+    i.e., <basedir>/SB<sbid>/scans/<scan>/<timestamp>/<beam>/b<beam>.aver.4pol.bin
+    """
+    subdir = os.path.abspath(binfname).split("/")
+    return dict(scan=subdir[-4], timestamp=subdir[-3], beam=subdir[-2])
+
+def _load_beam(binfname, lazy=False):
+    """
+    arrays of a beam to be archived, missing files are skipped
+
+    Params
+    ----------
+    lazy: bool, False by default
+        only memory-map the files if True (e.g., to get shapes and data types),
+        the gains are not inverted in this case
+    """
+    sol = BinSolution(binfname)
+    arrays = dict(gains=sol.raw if lazy else sol.gains)
+    mmap_mode = "r" if lazy else None
+    freqfname = binfname.replace(".bin", ".freq.npy")
+    smoothfname = binfname.replace(".bin", ".smooth.npy")
+    if os.path.exists(freqfname): arrays["freqs"] = np.load(freqfname, mmap_mode=mmap_mode)
+    if os.path.exists(smoothfname): arrays["smooth"] = np.load(smoothfname, mmap_mode=mmap_mode)
+    return arrays
+
+def write_archive(fname, binfnames, sbid=None):
+    """
+    write solutions from `binfnames` (and the `.freq.npy`, `.smooth.npy` next to them) to a single archive
+
+    Params
+    ----------
+    fname: str
+        path of the archive
+    binfnames: list of str
+        `.bin` solutions, see `binsol.find_sbid_bins`
+
+    Returns
+    ----------
+    index: dict
+        index saved in the archive
+    """
+    ### work out the layout first, only headers are read here, beams are then loaded one at a time when writing
+    entries = []
+    for binfname in binfnames:
+        entry = _beam_info(binfname)
+        entry["source"] = os.path.abspath(binfname)
+        entry["arrays"] = {}
+        entries.append(entry)
+
+    offset = 0
+    for entry in entries:
+        for name, value in _load_beam(entry["source"], lazy=True).items():
+            entry["arrays"][name] = dict(offset=offset, dtype=value.dtype.str, shape=list(value.shape))
+            offset = _align(offset + value.nbytes)
+
+    index = dict(version=ARCHIVE_VERSION, sbid=sbid, entries=entries)
+    indexbytes = json.dumps(index).encode()
+    dataoffset = _align(len(ARCHIVE_MAGIC) + 8 + len(indexbytes))
+
+    tmpfname = f"{fname}.tmp"
+    with open(tmpfname, "wb") as fp:
+        fp.write(ARCHIVE_MAGIC)
+        fp.write(np.uint64(len(indexbytes)).tobytes())
+        fp.write(indexbytes)
+        for entry in entries:
+            for name, value in _load_beam(entry["source"]).items():
+                fp.seek(dataoffset + entry["arrays"][name]["offset"])
+                fp.write(np.ascontiguousarray(value).tobytes())
+        fp.truncate(dataoffset + offset)
+    os.replace(tmpfname, fname)
+    log.info(f"{len(entries)} solutions saved to {fname}")
+    return index
+
+class SolutionArchive:
+    """
+    read a solution archive, the whole file is memory-mapped once and arrays are views on it
+
+    Params
+    ----------
+    fname: str
+        path to the archive
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as fp:
+            magic = fp.read(len(ARCHIVE_MAGIC))
+            if magic != ARCHIVE_MAGIC:
+                raise ValueError(f"{fname} is not a solution archive...")
+            nindex = int(np.frombuffer(fp.read(8), dtype=np.uint64)[0])
+            self.index = json.loads(fp.read(nindex).decode())
+        self.dataoffset = _align(len(ARCHIVE_MAGIC) + 8 + nindex)
+        self._mmap = np.memmap(fname, dtype=np.uint8, mode="r")
+
+    @property
+    def sbid(self):
+        return self.index["sbid"]
+
+    @property
+    def entries(self):
+        return self.index["entries"]
+
+    @property
+    def beams(self):
+        return sorted({entry["beam"] for entry in self.entries})
+
+    @property
+    def scans(self):
+        return sorted({(entry["scan"], entry["timestamp"]) for entry in self.entries})
+
+    def _array(self, desc):
+        dtype = np.dtype(desc["dtype"])
+        start = self.dataoffset + desc["offset"]
+        nbytes = int(np.prod(desc["shape"])) * dtype.itemsize
+        return self._mmap[start:start + nbytes].view(dtype).reshape(desc["shape"])
+
+    def find(self, beam, scan=None, timestamp=None):
+        """
+        find the index entry of a beam, the first scan is used if `scan`/`timestamp` is not specified
+        """
+        beam = "{:0>2}".format(beam)
+        for entry in self.entries:
+            if entry["beam"] != beam: continue
+            if scan is not None and entry["scan"] != "{:0>2}".format(scan): continue
+            if timestamp is not None and entry["timestamp"] != str(timestamp): continue
+            return entry
+        raise KeyError(f"no solution found for beam {beam} (scan {scan}, timestamp {timestamp}) in {self.fname}")
+
+    def get(self, beam, scan=None, timestamp=None):
+        """
+        solution of a beam
+
+        Returns
+        ----------
+        solution: dict
+            gains - (nsol, nant, nchan, npol) from the `.bin` file, smooth - smoothed gains, freqs - channel frequencies,
+            all of them are read-only memory-mapped arrays (smooth/freqs are missing if not archived)
+        """
+        entry = self.find(beam, scan=scan, timestamp=timestamp)
+        return {name: self._array(desc) for name, desc in entry["arrays"].items()}
+
+def main(args):
+    if args.sbid is None:
+        raise ValueError("Need to provide an SBID to archive")
+    sbid = args.sbid.replace("SB", "")
+    binfnames = find_sbid_bins(sbid, basedir=args.basedir)
+    if len(binfnames) == 0:
+        raise ValueError(f"no solution found for SB{sbid} under {args.basedir}")
+    outfname = args.out
+    if outfname is None:
+        outfname = "{}/SB{:0>6}/SB{:0>6}.calsol".format(args.basedir, sbid, sbid)
+    write_archive(outfname, binfnames, sbid=sbid)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    a = argparse.ArgumentParser()
+    a.add_argument("-sbid", type=str, help="sbid (without letter SB)")
+    a.add_argument("-basedir", type=str, help="base directory of the calibration results", default="/data/big/craco/calibration")
+    a.add_argument("-out", type=str, help="path of the archive (def: <basedir>/SB<sbid>/SB<sbid>.calsol)", default=None)
+
+    args = a.parse_args()
+    main(args)
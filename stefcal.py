@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# in-process antenna gain solver (StEFCal, Salvini & Wijnholds 2014), an alternative to the external `calibrate` binary
+# visibilities are reduced to one (nant, nant) matrix per channel and polarisation for each solution interval,
+# all channels and polarisations are then solved at once with the alternating least squares iteration
+#
+# gains follow the `calibrate` convention, i.e., vis = gain[ant1] * model * conj(gain[ant2]),
+# and are saved in the same `.bin` format, see `binsol.write_gains`
+
+import argparse
+import numpy as np
+
+import binsol
+
+import logging
+log = logging.getLogger(__name__)
+
+### speed of light in m/s
+SPEED_OF_LIGHT = 299792458.0
+### polarisations solved for a given input npol, and where the solutions go in the 4 output polarisations
+SOLVE_POLS = {1: [0], 2: [0, 1], 4: [0, 3]}
+GAIN_POLS = {1: [0, 0], 2: [0, 1], 4: [0, 1]}
+
+def uv_weight(uvw, freqs, minuv=0.):
+    """
+    baselines longer than `minuv` (in wavelength, same as `calibrate -minuv`)
+
+    Params
+    ----------
+    uvw: numpy.ndarray, (..., 3)
+        uvw in metre
+    freqs: numpy.ndarray, (nchan, )
+
+    Returns
+    ----------
+    weight: numpy.ndarray of bool, (..., nchan)
+    """
+    uvdist = np.hypot(uvw[..., 0], uvw[..., 1])
+    return uvdist[..., None] * (freqs / SPEED_OF_LIGHT) >= minuv
+
+def accumulate(vis, model, ant1, ant2, nant, weight=None, out=None):
+    """
+    reduce visibilities to the normal matrices of the gain problem, summed over time
+
+    Params
+    ----------
+    vis, model: numpy.ndarray, (nt, nbl, nchan, npol)
+        observed and model visibilities
+    ant1, ant2: numpy.ndarray, (nbl, )
+        antenna indices of each baseline, autos are ignored
+    weight: numpy.ndarray, optional
+        (nt, nbl, nchan, npol) or anything broadcastable to it, zero for flagged data
+    out: tuple, optional
+        (vm, mm) from an earlier call, the sums are added to them (e.g., for streamed time blocks)
+
+    Returns
+    ----------
+    vm: numpy.ndarray, (nchan, npol, nant, nant)
+        sum of weight * vis * conj(model), hermitian in the antenna axes
+    mm: numpy.ndarray, (nchan, npol, nant, nant)
+        sum of weight * |model|^2, symmetric in the antenna axes
+    """
+    nchan, npol = vis.shape[-2:]
+    cross = ant1 != ant2
+    if weight is None: weight = np.ones(vis.shape, dtype=np.float32)
+    weight = np.broadcast_to(weight, vis.shape)[:, cross]
+    vis, model, ant1, ant2 = vis[:, cross], model[:, cross], ant1[cross], ant2[cross]
+
+    ### (nbl, nchan, npol) after summing over time, with NaNs treated as flagged
+    weight = np.where(np.isfinite(vis) & np.isfinite(model), weight, 0.)
+    vmbl = (weight * np.nan_to_num(vis) * np.conj(np.nan_to_num(model))).sum(axis=0)
+    mmbl = (weight * np.abs(np.nan_to_num(model)) ** 2).sum(axis=0)
+
+    if out is None:
+        out = (
+            np.zeros((nchan, npol, nant, nant), dtype=complex),
+            np.zeros((nchan, npol, nant, nant), dtype=float),
+        )
+    vm, mm = out
+    ### baselines are unique, so fancy index assignment with += is safe here
+    vm[..., ant1, ant2] += vmbl.transpose(1, 2, 0)
+    vm[..., ant2, ant1] += np.conj(vmbl).transpose(1, 2, 0)
+    mm[..., ant1, ant2] += mmbl.transpose(1, 2, 0)
+    mm[..., ant2, ant1] += mmbl.transpose(1, 2, 0)
+    return vm, mm
+
+def stefcal(vm, mm, maxiter=100, tol=1e-6, refant=None):
+    """
+    StEFCal iteration on all channels and polarisations at once
+
+    Params
+    ----------
+    vm, mm: numpy.ndarray, (..., nant, nant)
+        normal matrices, see `accumulate`
+    maxiter: int, 100 by default
+    tol: float, 1e-6 by default
+        the iteration stops when the relative change of gains is below `tol` for all channels
+    refant: int, optional
+        the phase of this antenna is set to zero (where it has a solution)
+
+    Returns
+    ----------
+    gains: numpy.ndarray, (..., nant)
+        NaN for antennas without any unflagged baseline
+    """
+    gains = np.ones(vm.shape[:-1], dtype=complex)
+    valid = mm.sum(axis=-1) > 0
+    for i in range(maxiter):
+        num = (vm @ gains[..., None])[..., 0]
+        den = (mm @ (np.abs(gains) ** 2)[..., None])[..., 0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            new = np.where(valid, num / den, 0.)
+        ### average every other iteration, as in StEFCal, to avoid oscillating between two solutions
+        if i % 2 == 1: new = (new + gains) / 2.
+        change = np.linalg.norm(new - gains, axis=-1) / np.maximum(np.linalg.norm(new, axis=-1), 1e-30)
+        gains = new
+        if change.max() < tol: break
+    log.debug(f"stefcal stopped after {i + 1} iterations, max relative change {change.max():.2e}")
+
+    gains = np.where(valid, gains, np.nan)
+    if refant is not None:
+        phase = np.exp(-1j * np.angle(gains[..., refant]))[..., None]
+        gains = np.where(np.isfinite(phase), gains * phase, gains)
+    return gains
+
+def solve_gains(vis, model, ant1, ant2, nant=None, weight=None, maxiter=100, tol=1e-6, refant=None):
+    """
+    solve gains (nant, nchan, npol) for one solution interval, see `accumulate` and `stefcal`
+    """
+    if nant is None: nant = max(ant1.max(), ant2.max()) + 1
+    vm, mm = accumulate(vis, model, ant1, ant2, nant, weight=weight)
+    return stefcal(vm, mm, maxiter=maxiter, tol=tol, refant=refant).transpose(2, 0, 1)
+
+def expand_gains(gains, npol):
+    """
+    put gains solved from an `npol` measurement set to the 4 polarisations (XX, XY, YX, YY) of `.bin` files,
+    leakage terms (XY, YX) are not solved and set to NaN
+    """
+    out = np.full(gains.shape[:-1] + (4, ), np.nan, dtype=complex)
+    out[..., [0, 3]] = gains[..., GAIN_POLS[npol]]
+    return out
+
+def solve_ms(msname, model="MODEL_DATA", column="DATA", minuv=200., solint=None, ntblock=10, maxiter=100, tol=1e-6, refant=None):
+    """
+    solve gains for a (time ordered) measurement set, the visibilities are read `ntblock` integrations at a time
+
+    Params
+    ----------
+    model: str or callable, "MODEL_DATA" by default
+        column with the model visibilities, or a function of uvw (nrow, 3) returning them as (nrow, nchan, npol),
+        e.g., `predict.VisPredictor`
+    minuv: float, 200.0 by default
+        minimum baseline length in wavelength
+    solint: float, optional
+        solution interval in seconds, one solution for the whole measurement set if None
+
+    Returns
+    ----------
+    gains: numpy.ndarray, (nsol, nant, nchan, 4)
+    tstart, tend: float
+        time range (MJD seconds) of the measurement set
+    """
+    from craco_vis import SimpleMeasurementSet
+    ms = SimpleMeasurementSet(msname)
+    summary = ms.summary
+    summary.check_regular()
+    nt, nbl, nchan, npol = summary.nt, summary.nbl, summary.nchan, summary.npol
+    nant, freqs, pols = summary.ntabant, summary.freqs, SOLVE_POLS[npol]
+
+    times = ms.dattab.getcol("TIME")[::nbl]
+    isol = np.zeros(nt, dtype=int) if solint is None else ((times - times[0]) // solint).astype(int)
+    _, isol = np.unique(isol, return_inverse=True) # skip intervals without any data
+    nsol = isol.max() + 1
+    log.info(f"solving {nsol} interval(s) for {msname} - {nant} antennas, {nchan} channels, minuv {minuv} wavelength")
+
+    sums = [None] * nsol
+    for it in range(0, nt, ntblock):
+        ntchunk = min(ntblock, nt - it)
+        getcol = lambda name: ms.dattab.getcol(name, startrow=it * nbl, nrow=ntchunk * nbl)
+        shape = (ntchunk, nbl, nchan, npol)
+        uvw = getcol("UVW")
+        vis = getcol(column).reshape(shape)[..., pols]
+        modelvis = (model(uvw) if callable(model) else getcol(model)).reshape(shape)[..., pols]
+        weight = ~getcol("FLAG").reshape(shape)[..., pols]
+        weight = weight & uv_weight(uvw.reshape(ntchunk, nbl, 3), freqs, minuv)[..., None]
+        ### blocks may cross solution intervals
+        for sol in np.unique(isol[it:it + ntchunk]):
+            sel = isol[it:it + ntchunk] == sol
+            sums[sol] = accumulate(vis[sel], modelvis[sel], summary.ant1, summary.ant2, nant, weight=weight[sel], out=sums[sol])
+
+    gains = np.stack([
+        stefcal(vm, mm, maxiter=maxiter, tol=tol, refant=refant).transpose(2, 0, 1) for vm, mm in sums
+    ])
+    return expand_gains(gains, npol), summary.tstart, summary.tend
+
+def compare_gains(gains, reference, refant=0):
+    """
+    agreement of XX/YY gains with a `reference` solution (e.g., from `calibrate`), both (nsol, nant, nchan, 4),
+    phases are referenced to `refant` first as the absolute phase can not be solved
+
+    Returns
+    ----------
+    error: numpy.ndarray, (nsol, nant, nchan, 2)
+        |gains - reference| / |reference|
+    """
+    gains, reference = gains[..., [0, 3]], reference[..., [0, 3]]
+    gains = gains * np.exp(-1j * np.angle(gains[:, refant:refant + 1]))
+    reference = reference * np.exp(-1j * np.angle(reference[:, refant:refant + 1]))
+    return np.abs(gains - reference) / np.abs(reference)
+
+def main(args):
+    if args.vis is None:
+        raise ValueError("Need to provide an input vis ms to calibrate")
+    binname = args.out
+    if binname is None:
+        binname = args.vis.rstrip("/").replace(".ms", ".bin")
+    gains, tstart, tend = solve_ms(
+        args.vis, model=args.model, minuv=args.minuv, solint=args.solint,
+        maxiter=args.maxiter, tol=args.tol, refant=args.refant,
+    )
+    binsol.write_gains(binname, gains, tstart=tstart, tend=tend)
+    log.info(f"solution {gains.shape} saved to {binname}")
+
+    if args.compare is not None:
+        error = compare_gains(gains, binsol.load_gains(args.compare), refant=0 if args.refant is None else args.refant)
+        log.info(
+            f"agreement with {args.compare} - median relative difference {np.nanmedian(error):.2e}, "
+            f"95th percentile {np.nanpercentile(error, 95):.2e}"
+        )
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    a = argparse.ArgumentParser()
+    a.add_argument("-vis", type=str, help="Input vis ms to calibrate")
+    a.add_argument("-model", type=str, help="column with the model visibilities (def: MODEL_DATA)", default="MODEL_DATA")
+    a.add_argument("-out", type=str, help="output .bin solution (def: <vis>.bin)", default=None)
+    a.add_argument("-minuv", type=float, help="minimum baseline length in wavelength (def: 200.0)", default=200.)
+    a.add_argument("-solint", type=float, help="solution interval in seconds (def: whole measurement set)", default=None)
+    a.add_argument("-maxiter", type=int, help="maximum number of iterations (def: 100)", default=100)
+    a.add_argument("-tol", type=float, help="convergence tolerance (def: 1e-6)", default=1e-6)
+    a.add_argument("-refant", type=int, help="reference antenna (def: no phase referencing)", default=None)
+    a.add_argument("-compare", type=str, help="compare the solution with another .bin file, e.g., from calibrate", default=None)
+
+    args = a.parse_args()
+    main(args)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# average a CRACO uvfits file in time and frequency and write the 4pol measurement set in one pass
+# i.e., importuvfits + average_the_ms + convert without any intermediate measurement set
+# measurement sets can be averaged in the same way, see `process_ms`
+
+import argparse
+import numpy as np
+
+from craco_vis import SimpleUvFits, SimpleMeasurementSet
+from convert import expand_pol
+from ms_writer import MeasurementSetWriter
+
+import logging
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+### used to pack (antenna1, antenna2) into one integer key
+MAX_ANT = 4096
+
+class VisAverager:
+    """
+    flag and weight aware time and frequency averaging on streamed blocks of visibilities.
+
+    Rows are assumed to be time ordered. Partial sums of the last (possibly incomplete) time bin
+    are kept between blocks, so that the memory is bounded by the block size and one time bin
+
+    Params
+    ----------
+    timebin: float
+        time bin in seconds
+    width: int
+        number of channels to average together
+    """
+    def __init__(self, timebin, width=1):
+        self.timebin = timebin
+        self.width = max(1, int(width))
+        self.t0 = None
+        self._partial = None # partial sums of the last time bin
+
+    def _reduce_freq(self, block):
+        """
+        sum visibilities and weights over channel groups, flagged and non-finite data get zero weight
+        """
+        weight = block["weight"]
+        flag = block.get("flag")
+        if flag is None: flag = weight <= 0
+        ### NaN * 0 is still NaN, so flagged/non-finite samples are zeroed instead of only down-weighted
+        flag = flag | ~np.isfinite(block["vis"]) | ~np.isfinite(weight)
+        weight = np.where(flag, 0., weight).astype(np.float32)
+        vis = np.where(flag, 0., block["vis"])
+
+        nchan = weight.shape[1]
+        chanstarts = np.arange(0, nchan, self.width)
+        return (
+            np.add.reduceat(vis * weight, chanstarts, axis=1),
+            np.add.reduceat(weight, chanstarts, axis=1),
+        )
+
+    @staticmethod
+    def _reduce_groups(keys, sums):
+        """
+        add all rows with the same key together, output is sorted by key
+        """
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        return keys[starts], {name: np.add.reduceat(value[order], starts, axis=0) for name, value in sums.items()}
+
+    def add(self, block):
+        """
+        add a block of visibilities, see `SimpleUvFits.iter_blocks` for the format.
+
+        Returns
+        ----------
+        rows: dict or None
+            averaged rows for all time bins completed by this block
+        """
+        if self.t0 is None: self.t0 = block["time"][0]
+        vsum, wsum = self._reduce_freq(block)
+        nrow = vsum.shape[0]
+
+        tbin = np.floor((block["time"] - self.t0) / self.timebin).astype(np.int64)
+        keys = (tbin * MAX_ANT + block["ant1"]) * MAX_ANT + block["ant2"]
+        sums = dict(
+            vis=vsum, weight=wsum, uvw=block["uvw"], time=block["time"],
+            interval=block["inttim"], count=np.ones(nrow),
+        )
+
+        ### merge with partial sums from the last block
+        if self._partial is not None:
+            pkeys, psums = self._partial
+            keys = np.concatenate([pkeys, keys])
+            sums = {name: np.concatenate([psums[name], value]) for name, value in sums.items()}
+        keys, sums = self._reduce_groups(keys, sums)
+
+        ### the last time bin may continue in the next block
+        lastbin = keys >= (keys[-1] // (MAX_ANT * MAX_ANT)) * MAX_ANT * MAX_ANT
+        self._partial = keys[lastbin], {name: value[lastbin] for name, value in sums.items()}
+        complete = ~lastbin
+        if not complete.any(): return None
+        return self._average(keys[complete], {name: value[complete] for name, value in sums.items()})
+
+    def flush(self, ):
+        """
+        average the remaining time bin
+        """
+        if self._partial is None: return None
+        keys, sums = self._partial
+        self._partial = None
+        return self._average(keys, sums)
+
+    def _average(self, keys, sums):
+        wsum = sums["weight"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            vis = np.where(wsum > 0, sums["vis"] / wsum, 0.)
+        count = sums["count"]
+        return dict(
+            time=sums["time"] / count, uvw=sums["uvw"] / count[:, None],
+            ant1=(keys // MAX_ANT) % MAX_ANT, ant2=keys % MAX_ANT,
+            vis=vis.astype(np.complex64), weight=wsum, flag=wsum <= 0,
+            interval=sums["interval"],
+        )
+
+def write_4pol(writer, rows):
+    """
+    expand averaged rows to 4 polarisations (same as `convert.make_4pol`) and write them
+    """
+    if rows is None: return
+    writer.write(
+        time=rows["time"], ant1=rows["ant1"], ant2=rows["ant2"], uvw=rows["uvw"],
+        data=expand_pol(rows["vis"], zero=True), flag=expand_pol(rows["flag"]),
+        weight=expand_pol(rows["weight"]), interval=rows["interval"],
+    )
+
+def write_rows(writer, rows):
+    """
+    write averaged rows with their own polarisations
+    """
+    if rows is None: return
+    writer.write(
+        time=rows["time"], ant1=rows["ant1"], ant2=rows["ant2"], uvw=rows["uvw"],
+        data=rows["vis"], flag=rows["flag"], weight=rows["weight"], interval=rows["interval"],
+    )
+
+def _average_freqs(freqs, width):
+    chanstarts = np.arange(0, freqs.shape[0], width)
+    nchan = np.diff(np.r_[chanstarts, freqs.shape[0]])
+    return np.add.reduceat(freqs, chanstarts) / nchan, nchan
+
+def averaged_channels(uvf, freqbin=1):
+    """
+    channels of `uvf` (`SimpleUvFits`) after averaging to `freqbin` MHz
+
+    Returns
+    ----------
+    width: int
+        number of input channels averaged together
+    freqs: numpy.ndarray
+        output channel frequencies in Hz
+    chanwidth: numpy.ndarray
+        output channel width in Hz
+    """
+    foff = uvf.freqs[1] - uvf.freqs[0] if uvf.nchan > 1 else uvf.foff
+    width = max(1, int(freqbin * 1e6 // abs(foff)))
+    outfreqs, nchanavg = _average_freqs(uvf.freqs, width)
+    return width, outfreqs, foff * nchanavg
+
+def average_to_ms(vis, outvis, timebin=10., freqbin=1, blocksize=8192, npol=4, column=None):
+    """
+    average `vis` (`SimpleUvFits` or `SimpleMeasurementSet`) to `timebin` seconds and `freqbin` MHz,
+    and write it as a measurement set
+
+    Params
+    ----------
+    blocksize: int
+        number of input rows to read at once, the peak memory scales with it
+    npol: int or None, 4 by default
+        expand the output to 4 polarisations (see `convert.py`), keep the input polarisations if None
+    column: str, optional
+        data column to average, only for measurement sets (DATA by default)
+
+    Returns
+    ----------
+    meta: dict
+        phase_dir - (ra, dec) in degree, freqs/chanwidth - output channels in Hz, nrow - number of rows written,
+        i.e., what the later stages need without opening the output again
+    """
+    width, outfreqs, chanwidth = averaged_channels(vis, freqbin)
+
+    antnames, antpos, mounts = vis.antennas
+    ra, dec = vis.phase_dir
+    writer = MeasurementSetWriter(
+        outvis, freqs=outfreqs, chanwidth=chanwidth,
+        antnames=antnames, antpos=antpos, mounts=mounts,
+        phase_dir=(np.deg2rad(ra), np.deg2rad(dec)), source=vis.source,
+        npol=vis.npol if npol is None else npol,
+    )
+    write = write_rows if npol is None else write_4pol
+
+    averager = VisAverager(timebin=timebin, width=width)
+    tsamp = None
+    blocks = vis.iter_blocks(blocksize=blocksize) if column is None else vis.iter_blocks(blocksize=blocksize, column=column)
+    for block in blocks:
+        ### fill integration time if it is not recorded in the uvfits
+        if tsamp is None:
+            tsamp = block["inttim"][0]
+            if tsamp <= 0:
+                tsamp = np.median(np.diff(np.unique(block["time"]))) if np.unique(block["time"]).shape[0] > 1 else timebin
+        if (block["inttim"] <= 0).any():
+            block["inttim"] = np.where(block["inttim"] > 0, block["inttim"], tsamp)
+        write(writer, averager.add(block))
+    write(writer, averager.flush())
+
+    log.info(f"{writer.nrow} rows written to {outvis}")
+    meta = dict(phase_dir=(ra, dec), freqs=outfreqs, chanwidth=chanwidth, nrow=writer.nrow)
+    writer.close()
+    return meta
+
+def process(uvfits, outvis, timebin=10., freqbin=1, blocksize=8192):
+    """
+    average `uvfits` to `timebin` seconds and `freqbin` MHz, and write it as a 4pol measurement set,
+    see `average_to_ms`
+    """
+    uvf = SimpleUvFits(uvfits)
+    log.info(f"averaging {uvfits} with timebin={timebin}s, freqbin={freqbin}MHz -> {outvis}")
+    return average_to_ms(uvf, outvis, timebin=timebin, freqbin=freqbin, blocksize=blocksize)
+
+def process_ms(vis, outvis, timebin=10., freqbin=1, blocksize=8192, npol=4, column="DATA"):
+    """
+    average the measurement set `vis` to `timebin` seconds and `freqbin` MHz without CASA,
+    see `average_to_ms`, the output is a 4pol measurement set by default
+    """
+    ms = SimpleMeasurementSet(vis)
+    log.info(f"averaging {vis} with timebin={timebin}s, freqbin={freqbin}MHz -> {outvis}")
+    return average_to_ms(ms, outvis, timebin=timebin, freqbin=freqbin, blocksize=blocksize, npol=npol, column=column)
+
+def main(args):
+    if args.uvfits is None and args.vis is None:
+        raise ValueError("Need an input uvfits or ms to process")
+    if args.outvis is None:
+        outvis = args.uvfits.replace(".uvfits", ".aver.4pol.ms") if args.uvfits else args.vis.rstrip("/").replace(".ms", ".aver.4pol.ms")
+    else:
+        outvis = args.outvis
+
+    if args.uvfits:
+        process(args.uvfits, outvis, timebin=args.timebin, freqbin=args.freqbin, blocksize=args.blocksize)
+    else:
+        process_ms(args.vis, outvis, timebin=args.timebin, freqbin=args.freqbin, blocksize=args.blocksize)
+
+if __name__ == '__main__':
+    a = argparse.ArgumentParser()
+    group = a.add_mutually_exclusive_group()
+    group.add_argument("-uvfits", type=str, help="Input uvfits file")
+    group.add_argument("-vis", type=str, help="Input visibility ms")
+    a.add_argument("-outvis", type=str, help="Output 4pol visibility ms", default=None)
+    a.add_argument("-timebin", type=float, help="Sampling time (in seconds) of the output vis ms (def:10)", default=10)
+    a.add_argument("-freqbin", type=float, help="frequency resolution (in MHz) of the output vis ms (def: 1 MHz)", default=1)
+    a.add_argument("-blocksize", type=int, help="number of input rows to process at once (def: 8192)", default=8192)
+
+    args = a.parse_args()
+    main(args)
@@ -0,0 +1,70 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("casacore")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from synthetic import make_ms
+from craco_vis import SimpleMeasurementSet
+
+@pytest.mark.parametrize("npol", [2, 4])
+def test_iter_vis_then_load_vis(tmp_path, npol):
+    msname = str(tmp_path / "synthetic.ms")
+    make_ms(msname, nant=6, nt=5, nchan=8, npol=npol, corrected=False)
+    ms = SimpleMeasurementSet(msname)
+
+    blocks = [vis for _, vis in ms.iter_vis(ntblock=2)]
+    assert ms.npol == npol
+    ms.load_vis()
+    assert ms.vis.shape == (5, ms.nbl, 8, 2)
+    np.testing.assert_array_equal(np.concatenate(blocks), ms.vis)
+
+def test_iter_blocks_swapped_baselines(tmp_path):
+    from casacore.tables import table
+    msname = str(tmp_path / "synthetic.ms")
+    make_ms(msname, nant=4, nt=2, nchan=3, npol=4, corrected=False)
+    expected = list(SimpleMeasurementSet(msname).iter_blocks())[0]
+
+    ### store every other cross correlation as (ant2, ant1), i.e., conjugated with XY and YX swapped
+    t = table(msname, readonly=False, ack=False)
+    ant1, ant2 = t.getcol("ANTENNA1"), t.getcol("ANTENNA2")
+    rows = np.flatnonzero(ant1 != ant2)[::2]
+    data, flag, uvw = t.getcol("DATA"), t.getcol("FLAG"), t.getcol("UVW")
+    flag[rows, :, 1] = True
+    ant1[rows], ant2[rows] = ant2[rows], ant1[rows].copy()
+    uvw[rows] *= -1
+    data[rows] = np.conj(data[rows][..., [0, 2, 1, 3]])
+    flag[rows] = flag[rows][..., [0, 2, 1, 3]]
+    for name, value in dict(ANTENNA1=ant1, ANTENNA2=ant2, DATA=data, FLAG=flag, UVW=uvw).items():
+        t.putcol(name, value)
+    t.close()
+
+    block = list(SimpleMeasurementSet(msname).iter_blocks())[0]
+    np.testing.assert_array_equal(block["ant1"], expected["ant1"])
+    np.testing.assert_array_equal(block["ant2"], expected["ant2"])
+    np.testing.assert_allclose(block["uvw"], expected["uvw"])
+    np.testing.assert_array_equal(block["vis"], expected["vis"])
+    np.testing.assert_array_equal(block["flag"][rows, :, 1], True)
+    np.testing.assert_array_equal(block["flag"][rows, :, 2], expected["flag"][rows, :, 2])
+
+def test_missing_rows(tmp_path):
+    from casacore.tables import table
+    msname = str(tmp_path / "synthetic.ms")
+    make_ms(msname, nant=4, nt=3, nchan=2, npol=2, corrected=False)
+    t = table(msname, readonly=False, ack=False)
+    nrow = t.nrows()
+    t.removerows([nrow - 1])
+    t.close()
+
+    with pytest.warns(UserWarning, match="not a multiple"):
+        ms = SimpleMeasurementSet(msname)
+    with pytest.raises(ValueError):
+        next(ms.iter_vis())
+    with pytest.raises(ValueError):
+        ms.load_vis()
+    ### row based readers still work
+    assert sum(block["vis"].shape[0] for block in ms.iter_blocks()) == nrow - 1
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("casacore")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stream_average import VisAverager
+
+def test_nan_samples_do_not_propagate():
+    ### one baseline, two integrations in the same time bin, 3 channel pairs averaged together
+    vis = np.ones((2, 6, 1), dtype=np.complex64) * np.array([1, 3, 2, 4, 5, 6])[None, :, None]
+    vis[0, 0] = np.nan # flagged NaN
+    vis[1, 2] = np.nan # unflagged NaN
+    vis[:, 4:] = np.nan # only NaNs in the last output channel
+    flag = np.zeros(vis.shape, dtype=bool)
+    flag[0, 0] = True
+    block = dict(
+        time=np.array([0., 1.]), ant1=np.zeros(2, dtype=int), ant2=np.ones(2, dtype=int),
+        uvw=np.zeros((2, 3)), vis=vis, weight=np.ones(vis.shape, dtype=np.float32), flag=flag,
+        inttim=np.ones(2),
+    )
+
+    averager = VisAverager(timebin=10., width=2)
+    assert averager.add(block) is None
+    rows = averager.flush()
+    np.testing.assert_allclose(rows["vis"][0, :, 0], [(3 + 1 + 3) / 3, (4 + 2 + 4) / 3, 0])
+    np.testing.assert_array_equal(rows["weight"][0, :, 0], [3, 3, 0])
+    np.testing.assert_array_equal(rows["flag"][0, :, 0], [False, False, True])
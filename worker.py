@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# long-lived local worker running beam calibrations from a job directory
+# heavy modules (casatasks, casacore, astropy, matplotlib, craco) and the catalogue index are loaded once,
+# each job then runs in a forked child process, which inherits all of them without importing anything again
+#
+# job directory layout - pending/<jobid>.json (submitted), running/<jobid>.json (claimed by a worker),
+# done/<jobid>.json (job with its exit code), workers/<host>-<pid> (heartbeat of each worker),
+# a file named STOP asks all workers to exit once their jobs are finished
+#
+# workers touch their heartbeat and running jobs every poll, a job whose file is not touched for `WORKER_STALE` seconds
+# (worker killed or node down), or a pending job while no worker is alive, is reported as failed by `wait`
+
+import os
+import sys
+import json
+import time
+import uuid
+import shlex
+import socket
+import argparse
+import importlib
+import traceback
+import subprocess
+
+import logging
+log = logging.getLogger(__name__)
+
+### seconds without a heartbeat after which a worker is taken as dead, should be much longer than the poll interval
+WORKER_STALE = 60.
+### exit code reported for jobs that did not finish (timeout, no worker or dead worker), same as `timeout`
+LOST_RETURNCODE = 124
+### scripts run in the (warm) worker process instead of a new python process, script name -> module
+WARM_SCRIPTS = {"gen_calibration_soln.py": "gen_calibration_soln"}
+### modules loaded before serving any job, missing ones are skipped
+PRELOAD_MODULES = [
+    "casacore.tables", "casatasks", "astropy.coordinates", "astropy.table", "astropy.io.fits",
+    "matplotlib.pyplot", "craco", "craft.cmdline",
+    "gen_calibration_soln", "stream_average", "average_the_ms", "convert", "flag",
+    "extract_model_for_ms", "craco_vis", "smooth_cal", "smooth_plot",
+]
+
+def _makedirs(jobdir):
+    for state in ("pending", "running", "done", "workers"):
+        os.makedirs(f"{jobdir}/{state}", exist_ok=True)
+
+def _write_json(fname, value):
+    ### write to a temporary file first, so that a job file is never read half written
+    tmpfname = f"{os.path.dirname(fname)}/.{os.path.basename(fname)}.tmp"
+    with open(tmpfname, "w") as fp:
+        json.dump(value, fp)
+    os.replace(tmpfname, fname)
+
+def submit(jobdir, cmd, name=None, logfile=None, cwd=None):
+    """
+    submit a job to the worker(s) serving `jobdir`
+
+    Params
+    ----------
+    cmd: str
+        shell command of the job, e.g., from `calib_allbeam.prepare_calibration`.
+        Scripts in `WARM_SCRIPTS` run in the worker, anything else runs in a shell
+    logfile: str, optional
+        file for stdout/stderr of the job, <jobdir>/done/<jobid>.log by default
+    cwd: str, optional
+        working directory of the job, the current directory by default
+
+    Returns
+    ----------
+    jobid: str
+    """
+    _makedirs(jobdir)
+    jobid = "{}-{}".format(time.strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex[:8])
+    job = dict(
+        jobid=jobid, name=name or jobid, cmd=cmd, submitted=time.time(),
+        logfile=os.path.abspath(logfile or f"{jobdir}/done/{jobid}.log"),
+        cwd=os.path.abspath(cwd or os.getcwd()),
+    )
+    _write_json(f"{jobdir}/pending/{jobid}.json", job)
+    return jobid
+
+def _age(fname):
+    """
+    seconds since `fname` was last modified, None if it does not exist
+    """
+    try:
+        return time.time() - os.path.getmtime(fname)
+    except FileNotFoundError:
+        return None
+
+def alive_workers(jobdir, stale=WORKER_STALE):
+    """
+    workers (<host>-<pid>) serving `jobdir` with a heartbeat in the last `stale` seconds
+    """
+    workerdir = f"{jobdir}/workers"
+    if not os.path.isdir(workerdir): return []
+    ages = {name: _age(f"{workerdir}/{name}") for name in sorted(os.listdir(workerdir))}
+    return [name for name, age in ages.items() if age is not None and age < stale]
+
+def _lost(jobdir, jobid, state, reason):
+    """
+    move a job that will never finish from `state` to done with `LOST_RETURNCODE`,
+    None if it has just been moved by a worker (i.e., it is not lost)
+    """
+    fname = f"{jobdir}/{state}/{jobid}.json"
+    try:
+        with open(fname) as fp:
+            job = json.load(fp)
+        os.remove(fname)
+    except FileNotFoundError:
+        return None
+    job.update(returncode=LOST_RETURNCODE, error=reason)
+    _write_json(f"{jobdir}/done/{jobid}.json", job)
+    log.error(f"job {jobid} in {jobdir} failed... {reason}")
+    return job
+
+def wait(jobdir, jobid, poll=1.0, timeout=None, stale=WORKER_STALE):
+    """
+    wait for a job to finish
+
+    Params
+    ----------
+    timeout: float, optional
+        seconds to wait for, `TimeoutError` is raised after that (the job is left in the job directory)
+    stale: float, `WORKER_STALE` by default
+        the job is reported as failed if it is running but not touched by its worker for `stale` seconds,
+        or if it is pending and no worker has been alive for `stale` seconds
+
+    Returns
+    ----------
+    result: dict
+        the job with returncode, elapsed (in seconds), host and pid of the worker,
+        returncode is `LOST_RETURNCODE` (with an error message) if the job is lost
+    """
+    fname = f"{jobdir}/done/{jobid}.json"
+    tstart = tseen = time.time()
+    while not os.path.exists(fname):
+        now = time.time()
+        if timeout is not None and now - tstart > timeout:
+            raise TimeoutError(f"job {jobid} in {jobdir} is not finished after {timeout} s")
+        runage = _age(f"{jobdir}/running/{jobid}.json")
+        if runage is not None and runage > stale:
+            job = _lost(jobdir, jobid, "running", f"no heartbeat from its worker for {runage:.0f} s")
+            if job is not None: return job
+        if alive_workers(jobdir, stale=stale):
+            tseen = now
+        elif runage is None and now - tseen > stale:
+            job = _lost(jobdir, jobid, "pending", f"no worker serving {jobdir} for {now - tseen:.0f} s")
+            if job is not None: return job
+        time.sleep(poll)
+    with open(fname) as fp:
+        return json.load(fp)
+
+def run_job(jobdir, cmd, poll=1.0, timeout=None, stale=WORKER_STALE, **kwargs):
+    """
+    submit a job and wait for it, return the exit code (see `submit` for other parameters).
+    `LOST_RETURNCODE` is returned if the job is not finished after `timeout` seconds or it is lost, see `wait`
+    """
+    jobid = submit(jobdir, cmd, **kwargs)
+    try:
+        return wait(jobdir, jobid, poll=poll, timeout=timeout, stale=stale)["returncode"]
+    except TimeoutError as error:
+        log.error(str(error))
+        return LOST_RETURNCODE
+
+def preload(modules=PRELOAD_MODULES, catalogs=()):
+    """
+    import `modules` and load the index of `catalogs` in this process
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    for module in modules:
+        tstart = time.time()
+        try:
+            importlib.import_module(module)
+        except ImportError as error:
+            log.warning(f"cannot preload {module}... {error}")
+            continue
+        log.debug(f"{module} loaded in {time.time() - tstart:.2f} s")
+
+    from catalog_index import cached_index
+    for catalog in catalogs:
+        index = cached_index(catalog)
+        for column in index.columns: index.column(column)
+        log.info(f"catalogue index of {catalog} loaded")
+
+def _execute(job):
+    """
+    run a job in the current process (a forked child of the worker), return the exit code
+    """
+    argv = shlex.split(job["cmd"])
+    script = os.path.basename(argv[0])
+    if script not in WARM_SCRIPTS:
+        return subprocess.call(job["cmd"], shell=True)
+
+    module = importlib.import_module(WARM_SCRIPTS[script])
+    sys.argv = argv
+    try:
+        module.main(module.get_parser().parse_args(argv[1:]))
+    except SystemExit as error:
+        return error.code if isinstance(error.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+class BeamWorker:
+    """
+    serve jobs submitted to `jobdir`, see `submit`
+
+    Params
+    ----------
+    jobdir: str
+        job directory, several workers (e.g., one per node) can serve the same directory
+    njobs: int, 1 by default
+        maximum number of jobs running at the same time
+    poll: float, 1.0 by default
+        interval (in seconds) to look for new jobs and to touch the heartbeat, should be much shorter than `WORKER_STALE`
+    """
+    def __init__(self, jobdir, njobs=1, poll=1.0):
+        self.jobdir = jobdir
+        self.njobs = max(1, njobs)
+        self.poll = poll
+        self.running = {} # pid -> job
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        _makedirs(jobdir)
+
+    def _beat(self):
+        """
+        touch the heartbeat of this worker and its running jobs, see `wait`
+        """
+        with open(f"{self.jobdir}/workers/{self.name}", "w") as fp:
+            fp.write(f"{time.time()}\n")
+        for job in self.running.values():
+            try:
+                os.utime(f"""{self.jobdir}/running/{job["jobid"]}.json""")
+            except FileNotFoundError: # reported as lost by `wait` already
+                pass
+
+    @property
+    def stopped(self):
+        return os.path.exists(f"{self.jobdir}/STOP")
+
+    def _claim(self):
+        """
+        move the oldest pending job to running, None if there is no job (or another worker got it first)
+        """
+        for fname in sorted(os.listdir(f"{self.jobdir}/pending")):
+            if not fname.endswith(".json") or fname.startswith("."): continue
+            try:
+                os.rename(f"{self.jobdir}/pending/{fname}", f"{self.jobdir}/running/{fname}")
+                os.utime(f"{self.jobdir}/running/{fname}") # not stale, however long it was pending
+            except FileNotFoundError:
+                continue
+            with open(f"{self.jobdir}/running/{fname}") as fp:
+                job = json.load(fp)
+            job["worker"] = self.name
+            _write_json(f"{self.jobdir}/running/{fname}", job)
+            return job
+        return None
+
+    def _start(self, job):
+        log.info(f"""starting {job["name"]}, log in {job["logfile"]}""")
+        job["started"] = time.time()
+        sys.stdout.flush(); sys.stderr.flush()
+        pid = os.fork()
+        if pid > 0:
+            self.running[pid] = job
+            return
+        ### child process - send stdout/stderr (including subprocesses) to the log file
+        returncode = 1
+        try:
+            os.chdir(job["cwd"])
+            logfd = os.open(job["logfile"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.dup2(logfd, 1); os.dup2(logfd, 2)
+            returncode = _execute(job)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush(); sys.stderr.flush()
+            os._exit(returncode)
+
+    def _finish(self, pid, status):
+        job = self.running.pop(pid)
+        job["returncode"] = os.waitstatus_to_exitcode(status)
+        job["elapsed"] = time.time() - job["started"]
+        job["host"], job["pid"] = socket.gethostname(), pid
+        try:
+            os.remove(f"""{self.jobdir}/running/{job["jobid"]}.json""")
+        except FileNotFoundError:
+            log.warning(f"""{job["name"]} was reported as lost while running, overwriting its result""")
+        _write_json(f"""{self.jobdir}/done/{job["jobid"]}.json""", job)
+        status = "finished" if job["returncode"] == 0 else f"""FAILED (exit code {job["returncode"]})"""
+        log.info(f"""{job["name"]} {status} in {job["elapsed"]:.1f} s""")
+
+    def _reap(self):
+        while self.running:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0: break
+            if pid in self.running: self._finish(pid, status)
+
+    def serve(self, maxjobs=None):
+        """
+        run jobs until the STOP file appears (or `maxjobs` jobs are started), then wait for the running ones
+        """
+        log.info(f"serving jobs in {self.jobdir} with {self.njobs} slot(s) as {self.name}")
+        nstarted = 0
+        while not self.stopped and (maxjobs is None or nstarted < maxjobs):
+            self._beat()
+            self._reap()
+            job = None
+            if len(self.running) < self.njobs:
+                job = self._claim()
+            if job is None:
+                time.sleep(self.poll)
+                continue
+            self._start(job)
+            nstarted += 1
+
+        while self.running:
+            self._beat()
+            self._reap()
+            if self.running: time.sleep(self.poll)
+        os.remove(f"{self.jobdir}/workers/{self.name}")
+        log.info("worker stopped")
+
+def main(args):
+    if args.jobdir is None:
+        raise ValueError("Need to provide a job directory to serve")
+    ### modules under this directory (e.g., gen_calibration_soln) should be importable
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    tstart = time.time()
+    preload(catalogs=args.catalog)
+    log.info(f"worker ready in {time.time() - tstart:.1f} s")
+    BeamWorker(args.jobdir, njobs=args.njobs, poll=args.poll).serve(maxjobs=args.maxjobs)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    a = argparse.ArgumentParser()
+    a.add_argument("-jobdir", type=str, help="job directory to serve")
+    a.add_argument("-njobs", type=int, help="number of jobs running at the same time (def: 1)", default=1)
+    a.add_argument("-catalog", type=str, nargs="*", help="catalogues to load the index of in advance", default=[])
+    a.add_argument("-poll", type=float, help="interval in seconds to look for new jobs (def: 1.0)", default=1.0)
+    a.add_argument("-maxjobs", type=int, help="exit after running this number of jobs (def: no limit)", default=None)
+
+    args = a.parse_args()
+    main(args)